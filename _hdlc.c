@@ -0,0 +1,815 @@
+/*
+ * Optional C implementation of the HDLC framing core.
+ *
+ * hdlc.py uses this module when it has been built and falls back to its own
+ * pure Python code otherwise; both give the same output.  Build it in place
+ * with:
+ *
+ *     python setup.py build_ext --inplace
+ *
+ * Every function releases the GIL while it works on the data.
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+
+#include <stdint.h>
+#include <string.h>
+
+#define HDLC_FLAG 0x7E
+#define HDLC_ESC 0x7D
+#define HDLC_IDLE 0xFF
+#define HDLC_ESC_MOD 0x20
+
+#define FCS16_POLYNOMIAL 0x8408u
+#define FCS32_POLYNOMIAL 0xEDB88320u
+#define CRC32C_POLYNOMIAL 0x82F63B78u
+
+#define FCS32_INIT 0xFFFFFFFFu
+#define FCS32_GOOD_FINAL 0xDEBB20E3u
+
+/* Receiver states, numbered as hdlc.State. */
+enum { OUT_OF_SYNC, IDLE, GET_FRAME, GET_ESC };
+
+/* Results for frames that are not returned, as hdlc.FRAME_*. */
+enum { FRAME_EMPTY = 1, FRAME_SHORT, FRAME_FCS, FRAME_OVERSIZE };
+
+/* Slicing-by-8 tables for the 32 bit CRCs; fcs32_tables[0] is
+   hdlc.fcs32_table.  The FCS-16 only needs the one table. */
+static uint32_t fcs32_tables[8][256];
+static uint32_t crc32c_tables[8][256];
+static uint32_t fcs16_table[256];
+
+static void
+init_crc_table(uint32_t *table, uint32_t polynomial)
+{
+    int i, j;
+
+    for (i = 0; i < 256; i++) {
+        uint32_t fcs = (uint32_t)i;
+        for (j = 0; j < 8; j++)
+            fcs = (fcs & 1) ? (fcs >> 1) ^ polynomial : fcs >> 1;
+        table[i] = fcs;
+    }
+}
+
+static void
+init_slicing_tables(uint32_t tables[8][256], uint32_t polynomial)
+{
+    int i, j;
+
+    init_crc_table(tables[0], polynomial);
+    for (i = 0; i < 256; i++)
+        for (j = 1; j < 8; j++)
+            tables[j][i] = (tables[j - 1][i] >> 8) ^
+                tables[0][tables[j - 1][i] & 0xff];
+}
+
+static void
+init_fcs_tables(void)
+{
+    init_slicing_tables(fcs32_tables, FCS32_POLYNOMIAL);
+    init_slicing_tables(crc32c_tables, CRC32C_POLYNOMIAL);
+    init_crc_table(fcs16_table, FCS16_POLYNOMIAL);
+}
+
+static uint32_t
+crc32_update(uint32_t tables[8][256], uint32_t fcs, const unsigned char *p,
+             Py_ssize_t n)
+{
+    while (n >= 8) {
+        uint32_t lo = fcs ^ ((uint32_t)p[0] | (uint32_t)p[1] << 8 |
+                             (uint32_t)p[2] << 16 | (uint32_t)p[3] << 24);
+        uint32_t hi = (uint32_t)p[4] | (uint32_t)p[5] << 8 |
+                      (uint32_t)p[6] << 16 | (uint32_t)p[7] << 24;
+        fcs = tables[7][lo & 0xff] ^ tables[6][(lo >> 8) & 0xff] ^
+              tables[5][(lo >> 16) & 0xff] ^ tables[4][lo >> 24] ^
+              tables[3][hi & 0xff] ^ tables[2][(hi >> 8) & 0xff] ^
+              tables[1][(hi >> 16) & 0xff] ^ tables[0][hi >> 24];
+        p += 8;
+        n -= 8;
+    }
+    while (n-- > 0)
+        fcs = (fcs >> 8) ^ tables[0][(fcs ^ *p++) & 0xff];
+    return fcs;
+}
+
+static uint32_t
+fcs32_update(uint32_t fcs, const unsigned char *p, Py_ssize_t n)
+{
+    return crc32_update(fcs32_tables, fcs, p, n);
+}
+
+static uint32_t
+crc32c_update(uint32_t fcs, const unsigned char *p, Py_ssize_t n)
+{
+    return crc32_update(crc32c_tables, fcs, p, n);
+}
+
+static uint32_t
+fcs16_update(uint32_t fcs, const unsigned char *p, Py_ssize_t n)
+{
+    while (n-- > 0)
+        fcs = (fcs >> 8) ^ fcs16_table[(fcs ^ *p++) & 0xff];
+    return fcs;
+}
+
+/* The FCS types the deframer checks, by hdlc.FCS name, in fcs_types
+   order. */
+enum { FCS_NONE, FCS_16, FCS_32, FCS_32C };
+
+typedef struct {
+    const char *name;
+    Py_ssize_t size;
+    uint32_t (*update)(uint32_t, const unsigned char *, Py_ssize_t);
+    uint32_t good_final;    /* the register after a good frame */
+} fcs_type;
+
+static const fcs_type fcs_types[] = {
+    {"none", 0, NULL, 0},
+    {"fcs16", 2, fcs16_update, 0xF0B8u},
+    {"fcs32", 4, fcs32_update, FCS32_GOOD_FINAL},
+    {"crc32c", 4, crc32c_update, 0xB798B438u},
+    {NULL, 0, NULL, 0}
+};
+
+static const fcs_type *
+find_fcs_type(const char *name)
+{
+    const fcs_type *type;
+
+    for (type = fcs_types; type->name != NULL; type++)
+        if (strcmp(type->name, name) == 0)
+            return type;
+    PyErr_Format(PyExc_ValueError, "unknown FCS type: %s", name);
+    return NULL;
+}
+
+/* Escaping */
+
+/* The characters to escape: flag, escape and those in the ACCM. */
+typedef struct {
+    unsigned char map[256];
+    unsigned long accm;
+} escaper;
+
+static void
+init_escaper(escaper *e, unsigned long accm)
+{
+    int i;
+
+    memset(e->map, 0, sizeof(e->map));
+    e->map[HDLC_FLAG] = 1;
+    e->map[HDLC_ESC] = 1;
+    for (i = 0; i < 32; i++)
+        if (accm & (1ul << i))
+            e->map[i] = 1;
+    e->accm = accm & 0xFFFFFFFFul;
+}
+
+/* The position of the next flag or escape in [p, end), or end.  (*flag)
+   and (*esc) cache the next of each, as memchr() is only worth calling
+   again once p has passed them. */
+static const unsigned char *
+next_special(const unsigned char *p, const unsigned char *end,
+             const unsigned char **flag, const unsigned char **esc)
+{
+    if (*flag < p) {
+        *flag = memchr(p, HDLC_FLAG, end - p);
+        if (*flag == NULL)
+            *flag = end;
+    }
+    if (*esc < p) {
+        *esc = memchr(p, HDLC_ESC, end - p);
+        if (*esc == NULL)
+            *esc = end;
+    }
+    return *flag < *esc ? *flag : *esc;
+}
+
+static Py_ssize_t
+escaped_size(const unsigned char *p, Py_ssize_t n, const escaper *e)
+{
+    const unsigned char *end = p + n, *flag = NULL, *esc = NULL;
+    Py_ssize_t size = n;
+
+    if (e->accm) {
+        while (n-- > 0)
+            size += e->map[*p++];
+        return size;
+    }
+    while ((p = next_special(p, end, &flag, &esc)) < end) {
+        size++;
+        p++;
+    }
+    return size;
+}
+
+static unsigned char *
+escape_into(unsigned char *out, const unsigned char *p, Py_ssize_t n,
+            const escaper *e)
+{
+    const unsigned char *end = p + n, *flag = NULL, *esc = NULL;
+
+    if (e->accm) {
+        while (n-- > 0) {
+            unsigned char c = *p++;
+            if (e->map[c]) {
+                *out++ = HDLC_ESC;
+                *out++ = c ^ HDLC_ESC_MOD;
+            }
+            else {
+                *out++ = c;
+            }
+        }
+        return out;
+    }
+    while (p < end) {
+        const unsigned char *stop = next_special(p, end, &flag, &esc);
+        memcpy(out, p, stop - p);
+        out += stop - p;
+        if (stop == end)
+            break;
+        *out++ = HDLC_ESC;
+        *out++ = *stop ^ HDLC_ESC_MOD;
+        p = stop + 1;
+    }
+    return out;
+}
+
+/* The parts of a frame: the channel and control header, the data and the
+   FCS, which is computed over the other two. */
+typedef struct {
+    unsigned char header[2];
+    Py_buffer data;
+    unsigned char fcs[4];
+} frame_parts;
+
+/* Fill in the header for (parts->data).  Release the data and return -1
+   if (channel) or (control) is out of range. */
+static int
+init_frame(frame_parts *parts, long channel, long control)
+{
+    if (channel < 0 || channel > 255 || control < 0 || control > 255) {
+        PyBuffer_Release(&parts->data);
+        PyErr_SetString(PyExc_ValueError,
+                        "channel and control must be in range(256)");
+        return -1;
+    }
+    parts->header[0] = (unsigned char)channel;
+    parts->header[1] = (unsigned char)control;
+    return 0;
+}
+
+/* Fill in the FCS over the header and data.  This does not touch any
+   Python object, so it runs with the GIL released. */
+static void
+frame_fcs(frame_parts *parts)
+{
+    uint32_t fcs;
+
+    fcs = fcs32_update(FCS32_INIT, parts->header, 2);
+    fcs = fcs32_update(fcs, parts->data.buf, parts->data.len) ^ 0xFFFFFFFFu;
+    parts->fcs[0] = fcs & 0xff;
+    parts->fcs[1] = (fcs >> 8) & 0xff;
+    parts->fcs[2] = (fcs >> 16) & 0xff;
+    parts->fcs[3] = fcs >> 24;
+}
+
+/* The escaped size of a frame, without its flags. */
+static Py_ssize_t
+frame_size(frame_parts *parts, const escaper *e)
+{
+    return escaped_size(parts->header, 2, e) +
+           escaped_size(parts->data.buf, parts->data.len, e) +
+           escaped_size(parts->fcs, 4, e);
+}
+
+static unsigned char *
+frame_into(unsigned char *out, frame_parts *parts, const escaper *e)
+{
+    out = escape_into(out, parts->header, 2, e);
+    out = escape_into(out, parts->data.buf, parts->data.len, e);
+    out = escape_into(out, parts->fcs, 4, e);
+    *out++ = HDLC_FLAG;
+    return out;
+}
+
+/* Deframing */
+
+typedef struct {
+    Py_ssize_t start;
+    Py_ssize_t length;
+    int result;
+} frame_record;
+
+typedef struct {
+    unsigned char *out;         /* decoded frames, back to back */
+    Py_ssize_t pos;             /* end of the decoded data */
+    Py_ssize_t start;           /* start of the frame in progress */
+    frame_record *records;      /* frames closed by a flag */
+    Py_ssize_t count;
+    Py_ssize_t allocated;
+    Py_ssize_t limit;           /* most a frame may hold, or -1 */
+    const fcs_type *fcs;
+    int verify;                 /* check the FCS, or just strip it off */
+    Py_ssize_t unframed;
+    Py_ssize_t escaped_flag;
+    Py_ssize_t double_escape;
+    Py_ssize_t discarded;
+} deframer;
+
+/* Record the frame in progress, with (result), or 0 for deframe_check() to
+   fill in. */
+static int
+close_frame(deframer *d, int result)
+{
+    frame_record *record;
+
+    if (d->count == d->allocated) {
+        Py_ssize_t allocated = d->allocated * 2;
+        record = PyMem_RawRealloc(d->records, allocated * sizeof(*record));
+        if (record == NULL)
+            return -1;
+        d->records = record;
+        d->allocated = allocated;
+    }
+    record = &d->records[d->count++];
+    record->start = d->start;
+    record->length = d->pos - d->start;
+    record->result = result;
+    d->start = d->pos;
+    return 0;
+}
+
+/* Drop the frame in progress for outgrowing the MRU, as
+   Codec.abort_frame does. */
+static int
+abort_frame(deframer *d)
+{
+    d->pos = d->start;
+    return close_frame(d, FRAME_OVERSIZE);
+}
+
+/* Run (data) through the state machine; this is Codec.process_state for
+   every byte.  Return the new state, or -1 if out of memory. */
+static int
+deframe_run(deframer *d, int state, const unsigned char *p, Py_ssize_t n)
+{
+    const unsigned char *end = p + n, *flag = NULL, *esc = NULL;
+    unsigned char *out = d->out;
+
+    while (p < end) {
+        unsigned char c;
+        if (state == GET_FRAME) {
+            /* Copy the plain run up to the next flag or escape. */
+            const unsigned char *stop = next_special(p, end, &flag, &esc);
+            Py_ssize_t room = d->limit - (d->pos - d->start);
+            if (room < 0)
+                room = 0;
+            if (d->limit >= 0 && stop - p > room) {
+                /* The frame outgrows the MRU: drop it and skip to the next
+                   flag from the byte past the limit. */
+                p += room + 1;
+                if (abort_frame(d) < 0)
+                    return -1;
+                state = OUT_OF_SYNC;
+                continue;
+            }
+            memcpy(out + d->pos, p, stop - p);
+            d->pos += stop - p;
+            p = stop;
+            if (p == end)
+                break;
+        }
+
+        else if (state == OUT_OF_SYNC) {
+            /* Skip to the next flag. */
+            const unsigned char *next = memchr(p, HDLC_FLAG, end - p);
+            if (next == NULL)
+                next = end;
+            d->discarded += next - p;
+            p = next;
+            if (p == end)
+                break;
+        }
+
+        c = *p++;
+        switch (state) {
+        case GET_FRAME:
+            if (c == HDLC_FLAG) {
+                if (close_frame(d, 0) < 0)
+                    return -1;
+            }
+            else if (c == HDLC_ESC) {
+                state = GET_ESC;
+            }
+            else {
+                out[d->pos++] = c;
+            }
+            break;
+        case GET_ESC:
+            if (c == HDLC_FLAG) {
+                /* An escaped flag aborts the frame in progress. */
+                d->escaped_flag++;
+                d->pos = d->start;
+                state = GET_FRAME;
+            }
+            else if (c == HDLC_ESC) {
+                d->double_escape++;
+                state = OUT_OF_SYNC;
+            }
+            else {
+                out[d->pos++] = c ^ HDLC_ESC_MOD;
+                state = GET_FRAME;
+                if (d->limit >= 0 && d->pos - d->start > d->limit) {
+                    if (abort_frame(d) < 0)
+                        return -1;
+                    state = OUT_OF_SYNC;
+                }
+            }
+            break;
+        case IDLE:
+            if (c == HDLC_FLAG)
+                state = GET_FRAME;
+            else if (c != HDLC_IDLE)
+                d->unframed++;
+            break;
+        default:
+            if (c == HDLC_FLAG) {
+                d->pos = d->start;
+                state = GET_FRAME;
+            }
+            break;
+        }
+    }
+    return state;
+}
+
+/* Check the closed frames, as Codec.end_frame does. */
+static void
+deframe_check(deframer *d)
+{
+    Py_ssize_t i;
+
+    for (i = 0; i < d->count; i++) {
+        frame_record *record = &d->records[i];
+        if (record->result)
+            continue;
+        if (record->length == 0)
+            record->result = FRAME_EMPTY;
+        else if (record->length < d->fcs->size)
+            record->result = FRAME_SHORT;
+        else if (d->verify && d->fcs->update != NULL &&
+                 d->fcs->update((uint32_t)-1 >> (32 - 8 * d->fcs->size),
+                                d->out + record->start, record->length) !=
+                 d->fcs->good_final)
+            record->result = FRAME_FCS;
+        else
+            record->result = 0;
+    }
+}
+
+/* Module functions */
+
+/* Compute an FCS of (type) over the data in (args). */
+static PyObject *
+compute_fcs(PyObject *args, const char *format, const fcs_type *type)
+{
+    Py_buffer data;
+    PyObject *seed = Py_None;
+    uint32_t fcs = (uint32_t)-1 >> (32 - 8 * type->size);
+
+    if (!PyArg_ParseTuple(args, format, &data, &seed))
+        return NULL;
+    if (seed != Py_None) {
+        unsigned long value = PyLong_AsUnsignedLongMask(seed);
+        if (value == (unsigned long)-1 && PyErr_Occurred()) {
+            PyBuffer_Release(&data);
+            return NULL;
+        }
+        fcs = (uint32_t)value;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    fcs = type->update(fcs, data.buf, data.len);
+    Py_END_ALLOW_THREADS
+
+    PyBuffer_Release(&data);
+    return PyLong_FromUnsignedLong(fcs);
+}
+
+PyDoc_STRVAR(fcs32_doc,
+"fcs32(data, fcs=None) -> int\n\
+\n\
+Compute the FCS-32 of data, continuing from fcs if given.");
+
+static PyObject *
+hdlc_fcs32(PyObject *module, PyObject *args)
+{
+    return compute_fcs(args, "y*|O:fcs32", &fcs_types[FCS_32]);
+}
+
+PyDoc_STRVAR(fcs16_doc,
+"fcs16(data, fcs=None) -> int\n\
+\n\
+Compute the FCS-16 of data, continuing from fcs if given.");
+
+static PyObject *
+hdlc_fcs16(PyObject *module, PyObject *args)
+{
+    return compute_fcs(args, "y*|O:fcs16", &fcs_types[FCS_16]);
+}
+
+PyDoc_STRVAR(crc32c_doc,
+"crc32c(data, fcs=None) -> int\n\
+\n\
+Compute the CRC-32C of data, continuing from fcs if given.");
+
+static PyObject *
+hdlc_crc32c(PyObject *module, PyObject *args)
+{
+    return compute_fcs(args, "y*|O:crc32c", &fcs_types[FCS_32C]);
+}
+
+PyDoc_STRVAR(escape_doc,
+"escape(data, accm=0) -> bytes\n\
+\n\
+Byte stuff data, as hdlc.escape.");
+
+static PyObject *
+hdlc_escape(PyObject *module, PyObject *args)
+{
+    Py_buffer data;
+    unsigned long accm = 0;
+    escaper e;
+    Py_ssize_t size;
+    PyObject *result;
+
+    if (!PyArg_ParseTuple(args, "y*|k:escape", &data, &accm))
+        return NULL;
+    init_escaper(&e, accm);
+
+    Py_BEGIN_ALLOW_THREADS
+    size = escaped_size(data.buf, data.len, &e);
+    Py_END_ALLOW_THREADS
+
+    result = PyBytes_FromStringAndSize(NULL, size);
+    if (result != NULL) {
+        Py_BEGIN_ALLOW_THREADS
+        escape_into((unsigned char *)PyBytes_AS_STRING(result), data.buf,
+                    data.len, &e);
+        Py_END_ALLOW_THREADS
+    }
+    PyBuffer_Release(&data);
+    return result;
+}
+
+PyDoc_STRVAR(encode_frame_doc,
+"encode_frame(channel, control, data, accm=0) -> bytes\n\
+\n\
+Build a complete frame, as hdlc.encode_frame.");
+
+static PyObject *
+hdlc_encode_frame(PyObject *module, PyObject *args)
+{
+    frame_parts parts;
+    long channel, control;
+    unsigned long accm = 0;
+    escaper e;
+    Py_ssize_t size;
+    PyObject *result;
+
+    if (!PyArg_ParseTuple(args, "lly*|k:encode_frame", &channel, &control,
+                          &parts.data, &accm))
+        return NULL;
+    if (init_frame(&parts, channel, control) < 0)
+        return NULL;
+    init_escaper(&e, accm);
+
+    Py_BEGIN_ALLOW_THREADS
+    frame_fcs(&parts);
+    size = frame_size(&parts, &e) + 2;
+    Py_END_ALLOW_THREADS
+
+    result = PyBytes_FromStringAndSize(NULL, size);
+    if (result != NULL) {
+        unsigned char *out = (unsigned char *)PyBytes_AS_STRING(result);
+        Py_BEGIN_ALLOW_THREADS
+        *out++ = HDLC_FLAG;
+        frame_into(out, &parts, &e);
+        Py_END_ALLOW_THREADS
+    }
+    PyBuffer_Release(&parts.data);
+    return result;
+}
+
+PyDoc_STRVAR(encode_frames_doc,
+"encode_frames(frames, accm=0) -> bytes\n\
+\n\
+Build back-to-back frames from (channel, control, data) tuples, as\n\
+hdlc.encode_frames.");
+
+static PyObject *
+hdlc_encode_frames(PyObject *module, PyObject *args)
+{
+    PyObject *frames, *seq, *result = NULL;
+    unsigned long accm = 0;
+    escaper e;
+    frame_parts *parts;
+    Py_ssize_t count, ready = 0, size = 1, i;
+
+    if (!PyArg_ParseTuple(args, "O|k:encode_frames", &frames, &accm))
+        return NULL;
+    seq = PySequence_Fast(frames, "frames must be iterable");
+    if (seq == NULL)
+        return NULL;
+    count = PySequence_Fast_GET_SIZE(seq);
+    parts = PyMem_New(frame_parts, count ? count : 1);
+    if (parts == NULL) {
+        Py_DECREF(seq);
+        return PyErr_NoMemory();
+    }
+
+    for (; ready < count; ready++) {
+        long channel, control;
+        PyObject *item = PySequence_Fast_GET_ITEM(seq, ready);
+        if (!PyArg_ParseTuple(item, "lly*:encode_frames", &channel, &control,
+                              &parts[ready].data))
+            goto done;
+        if (init_frame(&parts[ready], channel, control) < 0)
+            goto done;
+    }
+    init_escaper(&e, accm);
+
+    Py_BEGIN_ALLOW_THREADS
+    for (i = 0; i < count; i++) {
+        frame_fcs(&parts[i]);
+        size += frame_size(&parts[i], &e) + 1;
+    }
+    Py_END_ALLOW_THREADS
+
+    result = PyBytes_FromStringAndSize(NULL, size);
+    if (result != NULL) {
+        unsigned char *out = (unsigned char *)PyBytes_AS_STRING(result);
+        Py_BEGIN_ALLOW_THREADS
+        *out++ = HDLC_FLAG;
+        for (i = 0; i < count; i++)
+            out = frame_into(out, &parts[i], &e);
+        Py_END_ALLOW_THREADS
+    }
+
+done:
+    for (i = 0; i < ready; i++)
+        PyBuffer_Release(&parts[i].data);
+    PyMem_Free(parts);
+    Py_DECREF(seq);
+    return result;
+}
+
+PyDoc_STRVAR(deframe_doc,
+"deframe(data, state, frame, mru, fcs='fcs32', verify=True)\n\
+    -> (state, results, unframed, escaped_flag, double_escape, discarded)\n\
+\n\
+Run data through the receiver state machine from state, continuing the\n\
+partial frame in the bytearray frame, which is left holding the new\n\
+partial frame.  An mru below 0 means no limit; frames that outgrow it\n\
+are dropped on the spot.  fcs names the frame check sequence (see\n\
+hdlc.fcs_types); if verify is false it is stripped off unchecked.\n\
+\n\
+results has an entry for every closing flag or dropped frame: the frame\n\
+(without its FCS) as bytes if it is good, else one of the hdlc.FRAME_*\n\
+codes.  The counts are of the bytes and escape errors seen, as in\n\
+hdlc.Statistics.");
+
+static PyObject *
+hdlc_deframe(PyObject *module, PyObject *args)
+{
+    Py_buffer data;
+    int state;
+    Py_buffer view;
+    PyObject *frame, *results = NULL, *result = NULL;
+    Py_ssize_t mru, length, i;
+    const char *name = "fcs32";
+    const fcs_type *fcs;
+    int verify = 1;
+    deframer d;
+
+    if (!PyArg_ParseTuple(args, "y*iO!n|sp:deframe", &data, &state,
+                          &PyByteArray_Type, &frame, &mru, &name, &verify))
+        return NULL;
+    if (state < OUT_OF_SYNC || state > GET_ESC) {
+        PyBuffer_Release(&data);
+        PyErr_SetString(PyExc_ValueError, "invalid receiver state");
+        return NULL;
+    }
+    fcs = find_fcs_type(name);
+    if (fcs == NULL) {
+        PyBuffer_Release(&data);
+        return NULL;
+    }
+
+    memset(&d, 0, sizeof(d));
+    view.obj = NULL;
+    d.limit = mru < 0 ? -1 : mru + fcs->size;
+    d.fcs = fcs;
+    d.verify = verify;
+    d.allocated = 16;
+    d.records = PyMem_RawMalloc(d.allocated * sizeof(frame_record));
+    if (d.records == NULL) {
+        PyErr_NoMemory();
+        goto done;
+    }
+
+    /* Decode straight into frame, after the partial frame it holds, so a
+       long frame read in small pieces is not copied again on every call.
+       (The bytearray over-allocates, so growing it is amortised.)  The
+       buffer export keeps other threads from resizing it meanwhile. */
+    length = PyByteArray_GET_SIZE(frame);
+    if (PyByteArray_Resize(frame, length + data.len) < 0)
+        goto done;
+    if (PyObject_GetBuffer(frame, &view, PyBUF_WRITABLE) < 0) {
+        view.obj = NULL;
+        goto restore;
+    }
+    d.out = view.buf;
+    d.pos = length;
+
+    Py_BEGIN_ALLOW_THREADS
+    state = deframe_run(&d, state, data.buf, data.len);
+    if (state >= 0)
+        deframe_check(&d);
+    Py_END_ALLOW_THREADS
+
+    if (state < 0) {
+        PyErr_NoMemory();
+        goto restore;
+    }
+
+    results = PyList_New(d.count);
+    if (results == NULL)
+        goto done;
+    for (i = 0; i < d.count; i++) {
+        frame_record *record = &d.records[i];
+        PyObject *item;
+        if (record->result)
+            item = PyLong_FromLong(record->result);
+        else
+            item = PyBytes_FromStringAndSize((char *)d.out + record->start,
+                                             record->length -
+                                             fcs->size);
+        if (item == NULL)
+            goto restore;
+        PyList_SET_ITEM(results, i, item);
+    }
+
+    /* Only the new partial frame moves: it was all decoded in this call
+       if any frame closed before it. */
+    length = d.pos - d.start;
+    memmove(d.out, d.out + d.start, length);
+    PyBuffer_Release(&view);
+    if (PyByteArray_Resize(frame, length) < 0)
+        goto done;
+
+    result = Py_BuildValue("iOnnnn", state, results, d.unframed,
+                           d.escaped_flag, d.double_escape, d.discarded);
+    goto done;
+
+restore:
+    /* Leave frame no longer than it was; the state is lost anyway. */
+    if (view.obj != NULL)
+        PyBuffer_Release(&view);
+    if (PyByteArray_GET_SIZE(frame) > length)
+        PyByteArray_Resize(frame, length);
+
+done:
+    Py_XDECREF(results);
+    PyMem_RawFree(d.records);
+    PyBuffer_Release(&data);
+    return result;
+}
+
+static PyMethodDef hdlc_methods[] = {
+    {"fcs32", hdlc_fcs32, METH_VARARGS, fcs32_doc},
+    {"fcs16", hdlc_fcs16, METH_VARARGS, fcs16_doc},
+    {"crc32c", hdlc_crc32c, METH_VARARGS, crc32c_doc},
+    {"escape", hdlc_escape, METH_VARARGS, escape_doc},
+    {"encode_frame", hdlc_encode_frame, METH_VARARGS, encode_frame_doc},
+    {"encode_frames", hdlc_encode_frames, METH_VARARGS, encode_frames_doc},
+    {"deframe", hdlc_deframe, METH_VARARGS, deframe_doc},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef hdlc_module = {
+    PyModuleDef_HEAD_INIT,
+    "_hdlc",
+    "C implementation of the HDLC framing core used by hdlc.py.",
+    -1,
+    hdlc_methods
+};
+
+PyMODINIT_FUNC
+PyInit__hdlc(void)
+{
+    init_fcs_tables();
+    return PyModule_Create(&hdlc_module);
+}
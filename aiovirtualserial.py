@@ -0,0 +1,253 @@
+'''
+asyncio front end for HDLC framing and virtual serial channels.
+
+Many links can share one event loop instead of running a reader thread per
+port. Requires Python 3 (asyncio).
+'''
+import asyncio
+import hdlc
+
+
+class HDLCProtocol(asyncio.Protocol):
+    '''
+    An asyncio protocol that deframes received data with an hdlc.Codec.
+
+    Every frame is passed to frame_received() (None for a bad frame).
+    (fcs) and (verify_fcs) select the frame check sequence, as for
+    hdlc.Codec.
+
+    Without a (loop), the protocol uses the running loop, from
+    connection_made() or the first read or drain.
+    '''
+    def __init__(self, accm=hdlc.ACCM_NONE, mru=None, loop=None,
+                 fcs='fcs32', verify_fcs=True):
+        self.loop = loop
+        self.transport = None
+        self.codec = hdlc.Codec(accm=accm, mru=mru, fcs=fcs,
+                                verify_fcs=verify_fcs)
+        self.statistics = self.codec.statistics
+        self._write_paused = False
+        self._drain_waiters = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self._get_loop()
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self._wake_drain_waiters()
+
+    def data_received(self, data):
+        '''
+        Run the received data through the deframer and hand on every completed
+        frame.
+        '''
+        for frame in self.codec.feed(data):
+            self.frame_received(frame)
+
+    def frame_received(self, frame):
+        '''
+        Handle a received frame. Override in subclasses.
+        '''
+
+    def send(self, channel, control, data):
+        '''
+        Build and send a data frame through the HDLC.
+        '''
+        if self.transport is None:
+            raise ConnectionError('HDLC transport is not connected.')
+        self.transport.write(self.codec.encode(channel, control, data))
+
+    def pause_writing(self):
+        self._write_paused = True
+
+    def resume_writing(self):
+        self._write_paused = False
+        self._wake_drain_waiters()
+
+    def drain(self):
+        '''
+        Return a future that is done once the transport is ready for more
+        data (immediately unless the transport has paused writing).
+        '''
+        waiter = self._get_loop().create_future()
+        if self._write_paused and self.transport is not None:
+            self._drain_waiters.append(waiter)
+        else:
+            waiter.set_result(None)
+        return waiter
+
+    def _get_loop(self):
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        return self.loop
+
+    def _wake_drain_waiters(self):
+        waiters, self._drain_waiters = self._drain_waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+
+class AsyncChannel(object):
+    '''
+    An object representing a virtual serial channel on an AsyncVirtualSerial.
+    '''
+    def __init__(self, vsObj, num, name=None, maxsize=0):
+        self.vs = vsObj
+        self.num = num
+        self.name = name
+        self.maxsize = maxsize
+        self.buffer = bytearray()
+        self.closed = False
+        self._readers = []
+
+    def read(self, length):
+        '''
+        Read from the channel for (length) bytes.
+
+        Return a future for the data. It completes once (length) bytes are
+        available, or with whatever is left if the connection is lost.
+        Cancelling the future (for example with asyncio.wait_for) leaves the
+        data in the channel.
+        '''
+        reader = self.vs._get_loop().create_future()
+        reader.add_done_callback(self._read_done)
+        self._readers.append((length, reader))
+        self._wake_readers()
+        return reader
+
+    def write(self, data):
+        '''
+        Write (data) to the channel.
+
+        Await drain() to respect the transport's flow control.
+        '''
+        self.vs.channel_write(self.num, data)
+
+    def drain(self):
+        '''
+        Return a future that is done once the link can take more data.
+        '''
+        return self.vs.drain()
+
+    def isFull(self):
+        '''
+        Return True if the channel is full, False if it is not.
+        '''
+        return self.maxsize > 0 and len(self.buffer) >= self.maxsize
+
+    def isEmpty(self):
+        '''
+        Return True if the channel is empty, False if it is not.
+        '''
+        return not self.buffer
+
+    def _feed(self, data):
+        self.buffer += data
+        self._wake_readers()
+        if self.isFull() and not self._waiting():
+            self.vs._update_reading()
+
+    def _close(self):
+        self.closed = True
+        self._wake_readers()
+
+    def _read_done(self, reader):
+        # A cancelled read may have been all that kept reading going.
+        if reader.cancelled():
+            self.vs._update_reading()
+
+    def _waiting(self):
+        '''
+        Return True if a read is waiting, dropping cancelled ones.
+        '''
+        self._readers = [(length, reader) for length, reader in self._readers
+                         if not reader.done()]
+        return bool(self._readers)
+
+    def _wake_readers(self):
+        readers = self._readers
+        buffer = self.buffer
+        while readers:
+            length, reader = readers[0]
+            if reader.cancelled():
+                readers.pop(0)
+                continue
+            if len(buffer) < length and not self.closed:
+                break
+            readers.pop(0)
+            reader.set_result(bytes(buffer[:length]))
+            del buffer[:length]
+
+        if self.vs._read_paused:
+            self.vs._update_reading()
+
+
+class AsyncVirtualSerial(HDLCProtocol):
+    '''
+    An asyncio virtual serial connection handler for communication with the
+    HDLC.
+
+    Use it as the protocol of any transport, for example:
+
+        transport, vs = await loop.create_connection(AsyncVirtualSerial,
+                                                     sock=sock)
+        channel = vs.open(0)
+        data = await channel.read(3)
+
+    Frames for channels that have not been opened are dropped. When a channel
+    with a maxsize holds that many bytes, reading from the transport is paused
+    until the channel is read from.  A pending read that needs more than
+    the channel holds keeps reading going.
+    '''
+    def __init__(self, accm=hdlc.ACCM_NONE, mru=None, loop=None,
+                 fcs='fcs32', verify_fcs=True):
+        super(AsyncVirtualSerial, self).__init__(accm=accm, mru=mru, loop=loop,
+                                                 fcs=fcs,
+                                                 verify_fcs=verify_fcs)
+        self.channels = {}
+        self._read_paused = False
+
+    def open(self, num, name=None, maxsize=0):
+        '''
+        Open and return an AsyncChannel object.
+        '''
+        channel = AsyncChannel(self, num, name=name, maxsize=maxsize)
+        self.channels[num] = channel
+        return channel
+
+    def channel_write(self, chanNo, data):
+        '''
+        Write to a channel on the HDLC.
+        '''
+        self.send(chanNo, 0, data)
+
+    def frame_received(self, frame):
+        if frame:
+            # (channel num)(cmd num)(data)
+            channel = self.channels.get(frame[0])
+            if channel is not None:
+                channel._feed(frame[2:])
+
+    def connection_lost(self, exc):
+        super(AsyncVirtualSerial, self).connection_lost(exc)
+        for channel in self.channels.values():
+            channel._close()
+
+    def _update_reading(self):
+        '''
+        Pause reading from the transport while any channel is full with no
+        reader waiting on it, and resume it once none are.
+        '''
+        if self.transport is None:
+            return
+
+        full = any(channel.isFull() and not channel._waiting()
+                   for channel in self.channels.values())
+        if full and not self._read_paused:
+            self._read_paused = True
+            self.transport.pause_reading()
+        elif not full and self._read_paused:
+            self._read_paused = False
+            self.transport.resume_reading()
@@ -0,0 +1,254 @@
+'''
+Throughput and latency benchmarks for hdlc and virtualserial.
+
+Runs over an in-memory loopback device and prints one JSON document with
+the results, so runs can be stored and compared:
+
+    python benchmark.py > results.json
+    python benchmark.py --quick --only fcs32 deframe
+'''
+import argparse
+import json
+import platform
+import random
+import sys
+import threading
+import time
+
+import hdlc
+import virtualserial
+
+timer = getattr(time, 'perf_counter', time.time)
+
+FRAME_SIZES = [16, 64, 256, 1500]
+
+# Fraction of payload bytes that are flags or escapes (and so get escaped).
+ESCAPE_DENSITIES = [0.0, 0.01, 0.1]
+
+
+class LoopbackDevice(object):
+    '''
+    An in-memory device: everything written to it can be read back.
+
+    Reads behave like pyserial with a timeout: they return up to (count)
+    bytes as soon as any are available, or nothing after (timeout) seconds.
+    '''
+    def __init__(self, timeout=0.1):
+        self.timeout = timeout
+        self.data = bytearray()
+        self.condition = threading.Condition()
+
+    @property
+    def in_waiting(self):
+        return len(self.data)
+
+    def read(self, count):
+        with self.condition:
+            if not self.data:
+                self.condition.wait(self.timeout)
+            result = bytes(self.data[:count])
+            del self.data[:count]
+            return result
+
+    def write(self, data):
+        with self.condition:
+            self.data += data
+            self.condition.notify()
+
+
+def _payload(rand, size, density):
+    '''
+    Build a random payload where (density) of the bytes need escaping.
+    '''
+    plain = [c for c in range(256) if c not in (0x7D, 0x7E)]
+    return bytes(bytearray(
+        rand.choice((0x7D, 0x7E)) if rand.random() < density
+        else rand.choice(plain)
+        for i in range(size)))
+
+
+def _best(func, repeat):
+    '''
+    Return the shortest of (repeat) timed calls of func.
+    '''
+    best = None
+    for i in range(repeat):
+        start = timer()
+        func()
+        elapsed = timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def _percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def bench_fcs32(size=1 << 20, repeat=5):
+    '''
+    Measure each FCS-32 backend in MB/s.
+    '''
+    data = _payload(random.Random(32), size, 0.0)
+    results = []
+    for name, compute in sorted(hdlc.fcs32_backends.items()):
+        # The pure Python backends are slow; give them a tenth of the data.
+        chunk = data if name == 'crc32' else data[:size // 10]
+        elapsed = _best(lambda: compute(chunk), repeat)
+        results.append({
+            'benchmark': 'fcs32',
+            'backend': name,
+            'bytes': len(chunk),
+            'mb_per_s': len(chunk) / elapsed / 1e6,
+        })
+    return results
+
+
+def bench_deframe(total=1 << 20, repeat=3):
+    '''
+    Measure Codec.process_data over a mix of frame sizes and escape
+    densities.
+    '''
+    rand = random.Random(1662)
+    results = []
+    for size in FRAME_SIZES:
+        for density in ESCAPE_DENSITIES:
+            count = max(1, total // size)
+            stream = b''.join(hdlc.encode_frame(1, 0, _payload(rand, size,
+                                                               density))
+                              for i in range(count))
+
+            def run():
+                hdlc.Codec().process_data(stream)
+
+            elapsed = _best(run, repeat)
+            results.append({
+                'benchmark': 'deframe',
+                'frame_size': size,
+                'escape_density': density,
+                'frames': count,
+                'mb_per_s': len(stream) / elapsed / 1e6,
+                'frames_per_s': count / elapsed,
+            })
+    return results
+
+
+def bench_encode(total=1 << 20, repeat=3):
+    '''
+    Measure encode_frame over a mix of frame sizes and escape densities.
+    '''
+    rand = random.Random(1661)
+    results = []
+    for size in FRAME_SIZES:
+        for density in ESCAPE_DENSITIES:
+            count = max(1, total // size)
+            payloads = [_payload(rand, size, density)
+                        for i in range(min(count, 64))]
+
+            def run():
+                encode = hdlc.encode_frame
+                for i in range(count):
+                    encode(1, 0, payloads[i % len(payloads)])
+
+            elapsed = _best(run, repeat)
+            results.append({
+                'benchmark': 'encode',
+                'frame_size': size,
+                'escape_density': density,
+                'frames': count,
+                'mb_per_s': count * size / elapsed / 1e6,
+                'frames_per_s': count / elapsed,
+            })
+    return results
+
+
+def bench_latency(channels=(1, 8), messages=2000, size=64):
+    '''
+    Measure Channel.write to Channel.read round trips through a
+    VirtualSerial on a loopback device, cycling over N channels.
+    '''
+    rand = random.Random(7)
+    results = []
+    for count in channels:
+        payloads = [_payload(rand, size, 0.01) for i in range(16)]
+        samples = []
+        with virtualserial.VirtualSerial(LoopbackDevice(),
+                                         read_size=4096) as vs:
+            opened = [vs.open(num) for num in range(count)]
+            for i in range(messages):
+                channel = opened[i % count]
+                data = payloads[i % len(payloads)]
+                start = timer()
+                channel.write(data)
+                result = channel.read(len(data), timeout=5)
+                samples.append(timer() - start)
+                if result != data:
+                    raise RuntimeError('Channel %d returned bad data.' %
+                                       channel.num)
+
+        samples.sort()
+        results.append({
+            'benchmark': 'latency',
+            'channels': count,
+            'messages': messages,
+            'message_size': size,
+            'p50_us': _percentile(samples, 0.50) * 1e6,
+            'p90_us': _percentile(samples, 0.90) * 1e6,
+            'p99_us': _percentile(samples, 0.99) * 1e6,
+            'max_us': samples[-1] * 1e6,
+        })
+    return results
+
+
+BENCHMARKS = {
+    'fcs32': bench_fcs32,
+    'deframe': bench_deframe,
+    'encode': bench_encode,
+    'latency': bench_latency,
+}
+
+QUICK = {
+    'fcs32': {'size': 1 << 16, 'repeat': 1},
+    'deframe': {'total': 1 << 14, 'repeat': 1},
+    'encode': {'total': 1 << 14, 'repeat': 1},
+    'latency': {'channels': (1, 4), 'messages': 100},
+}
+
+
+def run(names=None, quick=False):
+    '''
+    Run the named benchmarks (all by default) and return the report.
+    '''
+    results = []
+    for name in names or sorted(BENCHMARKS):
+        kwargs = QUICK[name] if quick else {}
+        results.extend(BENCHMARKS[name](**kwargs))
+    return {
+        'python': platform.python_implementation(),
+        'python_version': platform.python_version(),
+        'framing_core': hdlc.framing_core,
+        'platform': platform.platform(),
+        'time': time.time(),
+        'results': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS),
+                        help='benchmarks to run (default: all)')
+    parser.add_argument('--quick', action='store_true',
+                        help='small sizes, for a smoke test')
+    parser.add_argument('--output', help='write the JSON here, not stdout')
+    args = parser.parse_args(argv)
+
+    report = json.dumps(run(args.only, args.quick), indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        sys.stdout.write(report + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,432 @@
+'''
+Offline decoding of HDLC captures.
+
+A raw capture is a file of the bytes received on a link. decode_capture()
+splits it at flags and deframes the pieces in a pool of processes, so
+replaying a large capture scales with the number of cores:
+
+    decoder = CaptureDecoder('link.raw')
+    for frame in decoder.frames():
+        ...
+    print(decoder.statistics.snapshot())
+
+The receiver is in the same state after every flag (GET_FRAME, with an
+empty frame), so each piece after the first can be decoded independently
+and the results give exactly what a single Receiver reading the whole
+capture would.
+
+Captures are written with a CaptureWriter (or by wrapping a device in a
+RecordingDevice), and decoded frames with a FrameWriter. Both write the
+data back to back, plus a sidecar index (path + '.idx') with one
+INDEX_RECORD per write or frame, holding its offset, length, channel and
+timestamp. CaptureFile and FrameFile read them back through mmap: frame N
+or the data at a given time is found from the index without deframing
+anything. FrameFile.replay() hands stored frames to the channels of a
+VirtualSerial, and a CaptureDevice replays a raw capture into a Receiver
+or a VirtualSerial:
+
+    frames = FrameFile('link.frames')
+    frame = frames[1000]
+    control = [frames[n] for n in frames.channel_frames(2)]
+
+    vs = VirtualSerial(CaptureDevice(b''))
+    channel = vs.open(2)
+    frames.replay(vs, channel=2)
+
+    vs = VirtualSerial(CaptureFile('link.raw').device(), start=False)
+    channel = vs.open(2)
+    vs.start()
+
+Frames for channels that are not open yet are dropped, so open them before
+replaying (or before starting the VirtualSerial).
+'''
+import mmap
+import os
+import struct
+import time
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import hdlc
+
+CHUNK_SIZE = 1 << 22
+
+# Index records: the offset and length of a write in the data file, its
+# channel (frame files only) and its timestamp (0 if unknown).
+INDEX_RECORD = struct.Struct('<QIB3xd')
+
+
+def find_chunks(path, chunk_size=CHUNK_SIZE):
+    '''
+    Split the capture at (path) into (offset, length) pieces of about
+    (chunk_size) bytes. Every piece but the last ends with a flag.
+    '''
+    size = os.path.getsize(path)
+    chunks = []
+    start = 0
+    with open(path, 'rb') as f:
+        while start < size:
+            end = start + chunk_size
+            if end < size:
+                f.seek(end)
+                while True:
+                    block = f.read(1 << 16)
+                    if not block:
+                        end = size
+                        break
+                    flag = block.find(hdlc.HDLC_FLAG)
+                    if flag >= 0:
+                        end += flag + 1
+                        break
+                    end += len(block)
+            end = min(end, size)
+            chunks.append((start, end - start))
+            start = end
+    return chunks
+
+
+def decode_chunk(path, offset, length, mru=None, fcs='fcs32'):
+    '''
+    Deframe (length) bytes of the capture at (path) from (offset), which is
+    0 or just after a flag, with the FCS named (fcs) (see hdlc.fcs_types).
+
+    Return the frames (None for bad ones), the receiver statistics, and the
+    state and partial frame left at the end.
+    '''
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read(length)
+
+    codec = hdlc.Codec(mru=mru, fcs=fcs)
+    if offset:
+        codec.state = hdlc.GET_FRAME
+    return (codec.feed(data), codec.statistics, int(codec.state),
+            bytes(codec.frame))
+
+
+class CaptureDecoder(object):
+    '''
+    Decode the raw capture at (path) in a pool of (workers) processes (the
+    number of CPUs by default; 0 decodes in this process). (fcs) names the
+    frame check sequence of the link, as in hdlc.fcs_types.
+
+    Frames come out in capture order. Once frames() is exhausted,
+    statistics, state and frame hold what a single Receiver would have after
+    reading the whole capture.
+    '''
+    def __init__(self, path, workers=None, chunk_size=CHUNK_SIZE, mru=None,
+                 fcs='fcs32'):
+        self.path = path
+        self.workers = os.cpu_count() if workers is None else workers
+        self.chunk_size = chunk_size
+        self.mru = mru
+        self.fcs = fcs
+        self.statistics = hdlc.create_statistics()
+        self.state = hdlc.IDLE
+        self.frame = b''
+
+    def frames(self):
+        '''
+        Generate the frames of the capture (None for bad frames).
+        '''
+        chunks = find_chunks(self.path, self.chunk_size)
+        if not self.workers:
+            for offset, length in chunks:
+                for frame in self._merge(decode_chunk(self.path, offset,
+                                                      length, self.mru,
+                                                      self.fcs)):
+                    yield frame
+            return
+
+        with ProcessPoolExecutor(self.workers) as pool:
+            # Keep a few pieces in flight per worker, not the whole capture.
+            pending = deque()
+            chunks = iter(chunks)
+            while True:
+                while len(pending) < 2 * self.workers:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    pending.append(pool.submit(decode_chunk, self.path,
+                                               chunk[0], chunk[1], self.mru,
+                                               self.fcs))
+                if not pending:
+                    return
+                for frame in self._merge(pending.popleft().result()):
+                    yield frame
+
+    def write(self, path):
+        '''
+        Decode the capture into a frame file at (path) (see FrameWriter).
+        Bad frames are left out. Return the number of frames written.
+        '''
+        count = 0
+        with FrameWriter(path) as writer:
+            for frame in self.frames():
+                if frame is not None:
+                    writer.write(frame)
+                    count += 1
+        return count
+
+    def _merge(self, result):
+        frames, statistics, state, partial = result
+        self.statistics.merge(statistics)
+        self.state = hdlc.STATES[state]
+        self.frame = partial
+        return frames
+
+
+def decode_capture(path, workers=None, chunk_size=CHUNK_SIZE, mru=None,
+                   fcs='fcs32'):
+    '''
+    Generate the frames of the raw capture at (path); see CaptureDecoder.
+    '''
+    return CaptureDecoder(path, workers=workers, chunk_size=chunk_size,
+                          mru=mru, fcs=fcs).frames()
+
+
+class _IndexedWriter(object):
+    '''
+    Write data to (path), back to back, with a sidecar index at
+    (path + '.idx') of one INDEX_RECORD per write.
+    '''
+    def __init__(self, path):
+        self.data = open(path, 'wb')
+        self.index = open(path + '.idx', 'wb')
+        self.offset = 0
+
+    def _write(self, data, channel, timestamp):
+        self.data.write(data)
+        self.index.write(INDEX_RECORD.pack(self.offset, len(data), channel,
+                                           timestamp))
+        self.offset += len(data)
+
+    def flush(self):
+        self.data.flush()
+        self.index.flush()
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CaptureWriter(_IndexedWriter):
+    '''
+    Record the raw bytes received on a link to (path), indexed by the time
+    they were read.
+    '''
+    def write(self, data, timestamp=None):
+        '''
+        Add (data) read at (timestamp) (now by default).
+        '''
+        if data:
+            if timestamp is None:
+                timestamp = time.time()
+            self._write(data, 0, timestamp)
+
+
+class FrameWriter(_IndexedWriter):
+    '''
+    Write decoded frames to (path), indexed by frame.
+    '''
+    def write(self, frame, timestamp=0.0):
+        '''
+        Add a frame (channel, control and payload) received at (timestamp).
+        '''
+        self._write(frame, frame[0] if frame else 0, timestamp)
+
+
+class RecordingDevice(object):
+    '''
+    Wrap a device and record everything read from it with a CaptureWriter.
+    '''
+    def __init__(self, device, writer):
+        self.device = device
+        self.writer = writer
+
+    @property
+    def in_waiting(self):
+        return self.device.in_waiting
+
+    def fileno(self):
+        return self.device.fileno()
+
+    def read(self, count):
+        data = self.device.read(count)
+        self.writer.write(data)
+        return data
+
+    def write(self, data):
+        return self.device.write(data)
+
+
+class _IndexedFile(object):
+    '''
+    Read a file written by an _IndexedWriter, with both the data and the
+    index mapped into memory.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.data = self._map(path)
+        self.index = self._map(path + '.idx')
+
+    @staticmethod
+    def _map(path):
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.index) // INDEX_RECORD.size
+
+    def record(self, n):
+        '''
+        Return the (offset, length, channel, timestamp) index record of entry
+        (n).
+        '''
+        if n < 0:
+            n += len(self)
+        if not 0 <= n < len(self):
+            raise IndexError(n)
+        return INDEX_RECORD.unpack_from(self.index, n * INDEX_RECORD.size)
+
+    def __getitem__(self, n):
+        offset, length, channel, timestamp = self.record(n)
+        return self.data[offset:offset + length]
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self[n]
+
+    def timestamp(self, n):
+        return self.record(n)[3]
+
+    def find_time(self, timestamp):
+        '''
+        Return the number of the first entry at or after (timestamp), or
+        len(self) if there is none. Timestamps must not go backwards.
+        '''
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self.timestamp(middle) < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def close(self):
+        for mapped in (self.data, self.index):
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CaptureFile(_IndexedFile):
+    '''
+    A raw capture written by a CaptureWriter.
+    '''
+    def device(self, start=0, timeout=0.01):
+        '''
+        Return a CaptureDevice replaying the capture from entry (start) (see
+        find_time()).
+        '''
+        offset = self.record(start)[0] if start < len(self) else len(self.data)
+        return CaptureDevice(self.data, offset, timeout=timeout)
+
+
+class CaptureDevice(object):
+    '''
+    A Receiver-compatible device reading a raw capture (any bytes-like
+    object, such as CaptureFile.data) from (offset).
+
+    Reads return what is asked for (as a serial port would once the data has
+    arrived). Once the capture is exhausted they return nothing after
+    (timeout) seconds, like a serial port's read timeout, so a VirtualSerial
+    reading the device does not spin. Writes are discarded.
+    '''
+    def __init__(self, data, offset=0, timeout=0.01):
+        self.data = data
+        self.offset = offset
+        self.timeout = timeout
+
+    @property
+    def in_waiting(self):
+        return len(self.data) - self.offset
+
+    def read(self, count):
+        data = self.data[self.offset:self.offset + count]
+        if not data and self.timeout:
+            time.sleep(self.timeout)
+        self.offset += len(data)
+        return data
+
+    def write(self, data):
+        pass
+
+
+class FrameFile(_IndexedFile):
+    '''
+    Decoded frames written by a FrameWriter (or CaptureDecoder.write()).
+
+    frame_file[n] is frame n, found through the index in O(1).
+    '''
+    def __init__(self, path):
+        super(FrameFile, self).__init__(path)
+        self._channels = None
+
+    def channel(self, n):
+        return self.record(n)[2]
+
+    def channel_frames(self, channel):
+        '''
+        Return the numbers of the frames on (channel), in order.
+
+        The first call builds a table of every channel from the index alone;
+        later calls are a lookup.
+        '''
+        if self._channels is None:
+            channels = {}
+            for n in range(len(self)):
+                channels.setdefault(self.channel(n), []).append(n)
+            self._channels = channels
+        return self._channels.get(channel, [])
+
+    def frames(self, channel=None, start=0):
+        '''
+        Generate the frames (on (channel) only, if given) from frame number
+        (start).
+        '''
+        if channel is None:
+            numbers = range(start, len(self))
+        else:
+            numbers = [n for n in self.channel_frames(channel) if n >= start]
+        for n in numbers:
+            yield self[n]
+
+    def replay(self, vs, channel=None, start=0, batch=256):
+        '''
+        Deliver the frames to the channels of VirtualSerial (vs), (batch)
+        frames at a time, as if they had just been received.
+        '''
+        frames = []
+        for frame in self.frames(channel=channel, start=start):
+            frames.append(frame)
+            if len(frames) == batch:
+                vs.deliver(frames)
+                frames = []
+        if frames:
+            vs.deliver(frames)
@@ -1,5 +1,27 @@
+import re
+import struct
+import time
+
 from collections import deque
 
+try:
+    from binascii import crc32 as _crc32
+except ImportError:
+    try:
+        from zlib import crc32 as _crc32
+    except ImportError:
+        _crc32 = None
+
+try:
+    from binascii import crc_hqx as _crc_hqx
+except ImportError:
+    _crc_hqx = None
+
+try:
+    import _hdlc
+except ImportError:
+    _hdlc = None
+
 # Taken from RFC 1662.
 # The FCS-32 generator polynomial: x**0 + x**1 + x**2 + x**4 + x**5
 #                      + x**7 + x**8 + x**10 + x**11 + x**12 + x**16
@@ -76,67 +98,625 @@ fcs32_table = [
 FCS32_GOOD_FINAL=0xdebb20e3
 
 
-def compute_fcs32(data, fcs=None):
+def compute_fcs32_table(data, fcs=None):
+    '''
+    Reference FCS-32 implementation: one fcs32_table lookup per byte.
+    '''
     if fcs is None:
         fcs = 0xFFFFFFFF
 
-    for i in range(len(data)):
-       fcs = (fcs >> 8) ^ fcs32_table[(fcs ^ ord(data[i])) & 0xff]
+    for c in data:
+        fcs = (fcs >> 8) ^ fcs32_table[(fcs ^ c) & 0xff]
 
     return fcs
 
 
+# Generator polynomials, in reflected form.
+FCS16_POLYNOMIAL = 0x8408
+FCS32_POLYNOMIAL = 0xEDB88320
+CRC32C_POLYNOMIAL = 0x82F63B78
+
+# Tables for reflected CRCs, by polynomial, built on first use.
+_crc_tables = {FCS32_POLYNOMIAL: fcs32_table}
+
+
+def crc_table(polynomial):
+    '''
+    Return the byte-at-a-time table of the reflected CRC with generator
+    (polynomial), building it on first use.
+    '''
+    table = _crc_tables.get(polynomial)
+    if table is None:
+        table = []
+        for value in range(256):
+            for k in range(8):
+                value = (value >> 1) ^ polynomial if value & 1 else value >> 1
+            table.append(value)
+        _crc_tables[polynomial] = table
+    return table
+
+
+# Slicing-by-8 tables, by polynomial, built from crc_table() on first use.
+_slicing_tables = {}
+
+
+def _get_slicing_tables(polynomial=FCS32_POLYNOMIAL):
+    tables = _slicing_tables.get(polynomial)
+    if tables is None:
+        table = crc_table(polynomial)
+        tables = [table]
+        for k in range(7):
+            tables.append([(v >> 8) ^ table[v & 0xff] for v in tables[-1]])
+        _slicing_tables[polynomial] = tables
+    return tables
+
+
+def compute_fcs32_slicing8(data, fcs=None, polynomial=FCS32_POLYNOMIAL):
+    '''
+    Pure Python FCS-32 processing eight bytes per step (slicing-by-8).
+
+    Any other 32 bit reflected CRC (polynomial) works the same way.
+    '''
+    if fcs is None:
+        fcs = 0xFFFFFFFF
+
+    t0, t1, t2, t3, t4, t5, t6, t7 = _get_slicing_tables(polynomial)
+    blocks = len(data) >> 3
+
+    if blocks:
+        words = iter(struct.unpack_from('<%dI' % (blocks * 2), data))
+        for lo in words:
+            hi = next(words)
+            fcs ^= lo
+            fcs = (t7[fcs & 0xff] ^ t6[(fcs >> 8) & 0xff] ^
+                   t5[(fcs >> 16) & 0xff] ^ t4[fcs >> 24] ^
+                   t3[hi & 0xff] ^ t2[(hi >> 8) & 0xff] ^
+                   t1[(hi >> 16) & 0xff] ^ t0[hi >> 24])
+
+    for c in data[blocks * 8:]:
+        fcs = (fcs >> 8) ^ t0[(fcs ^ c) & 0xff]
+
+    return fcs
+
+
+def compute_fcs32_crc32(data, fcs=None):
+    '''
+    FCS-32 using the C crc32 from binascii (or zlib).
+
+    The RFC 1662 FCS-32 is the same CRC as crc32(), which takes and returns
+    the complemented register, so complement the seed and the result.
+    '''
+    if fcs is None:
+        fcs = 0xFFFFFFFF
+
+    return (_crc32(data, fcs ^ 0xFFFFFFFF) & 0xFFFFFFFF) ^ 0xFFFFFFFF
+
+
+fcs32_backends = {
+    'table': compute_fcs32_table,
+    'slicing8': compute_fcs32_slicing8,
+}
+if _crc32 is not None:
+    fcs32_backends['crc32'] = compute_fcs32_crc32
+if _hdlc is not None:
+    fcs32_backends['native'] = _hdlc.fcs32
+
+
+def set_fcs32_backend(name):
+    '''
+    Select the FCS-32 implementation (a key of fcs32_backends) used by
+    compute_fcs32.
+    '''
+    global compute_fcs32
+    compute_fcs32 = fcs32_backends[name]
+
+
+# compute_fcs32(data, fcs=None) is the selected backend; default to the
+# fastest one available.
+compute_fcs32 = fcs32_backends.get('crc32', compute_fcs32_slicing8)
+
+
 def append_fcs32(data):
     # Note: the complement of the FCS is appended to the data, LSB first.
     # ~0xB5E84EA9 = 0x4A17B156
     fcs = compute_fcs32(data) ^ 0xFFFFFFFF
-    for i in xrange(4):
-        data += chr(fcs & 0xFF)
-        fcs >>= 8
-    return data
+    return data + struct.pack('<I', fcs)
+
+
+def compute_fcs16_table(data, fcs=None):
+    '''
+    Reference FCS-16 implementation (RFC 1662): one table lookup per byte.
+    '''
+    if fcs is None:
+        fcs = 0xFFFF
+
+    table = crc_table(FCS16_POLYNOMIAL)
+    for c in data:
+        fcs = (fcs >> 8) ^ table[(fcs ^ c) & 0xff]
+
+    return fcs
+
+
+# Every byte value with its bits reversed.
+_bit_reversed = bytes(int('{:08b}'.format(i)[::-1], 2) for i in range(256))
 
 
-class State(object):
-    def __init__(self, name):
-        self._name = name
+def compute_fcs16_hqx(data, fcs=None):
+    '''
+    FCS-16 using the C crc_hqx from binascii.
+
+    crc_hqx() is the same CRC-CCITT shifted the other way, so run it over the
+    data with the bits of every byte reversed, and reverse the bits of the
+    register going in and coming out.
+    '''
+    if fcs is None:
+        fcs = 0xFFFF
+
+    reverse = _bit_reversed
+    fcs = _crc_hqx(bytes(data).translate(reverse),
+                   reverse[fcs >> 8] | reverse[fcs & 0xff] << 8)
+    return reverse[fcs >> 8] | reverse[fcs & 0xff] << 8
+
+
+def compute_crc32c_slicing8(data, fcs=None):
+    '''
+    Pure Python CRC-32C (Castagnoli), slicing-by-8.
+    '''
+    return compute_fcs32_slicing8(data, fcs, CRC32C_POLYNOMIAL)
+
+
+def _compute_fcs32(data, fcs=None):
+    # FCS-32 through whichever backend set_fcs32_backend() selected.
+    return compute_fcs32(data, fcs)
+
+
+def _compute_none(data, fcs=None):
+    return 0
+
+
+class State(int):
+    '''
+    A receiver state: a small int, so states compare and hash as ints, that
+    keeps its name for printing.
+    '''
+    __slots__ = ()
+    _names = {}
+
+    def __new__(cls, value, name):
+        state = int.__new__(cls, value)
+        cls._names[value] = name
+        return state
 
     def __str__(self):
-        return self._name
+        return self._names[int(self)]
 
     def __repr__(self):
-        return '<State {0}>'.format(self._name)
+        return '<State {0}>'.format(self)
 
-    def __hash__(self):
-        return hash(repr(self))
 
+OUT_OF_SYNC = State(0, "Out-of-Sync")
+IDLE = State(1, "Idle")
+GET_FRAME = State(2, "Get Frame")
+GET_ESC = State(3, "Get Esc")
 
-OUT_OF_SYNC = State("Out-of-Sync")
-IDLE = State("Idle")
-GET_FRAME = State("Get Frame")
-GET_ESC = State("Get Esc")
+STATES = (OUT_OF_SYNC, IDLE, GET_FRAME, GET_ESC)
 
-HDLC_IDLE = '\xFF'
-HDLC_FLAG = '\x7E'
-HDLC_ESC = '\x7D'
+# What the C deframer reports for a closing flag that does not complete a
+# good frame.
+FRAME_EMPTY = 1
+FRAME_SHORT = 2
+FRAME_FCS = 3
+FRAME_OVERSIZE = 4
+
+HDLC_IDLE = b'\xFF'
+HDLC_FLAG = b'\x7E'
+HDLC_ESC = b'\x7D'
 HDLC_ESC_MOD = 0x20
 
+# The same characters as ints, as bytes are indexed and iterated.
+HDLC_IDLE_CHAR = 0xFF
+HDLC_FLAG_CHAR = 0x7E
+HDLC_ESC_CHAR = 0x7D
+
+# Async-Control-Character-Map (RFC 1662): bit n set means character n
+# (0x00-0x1F) is escaped on transmit.  Flag and escape are always escaped.
+ACCM_NONE = 0x00000000
+ACCM_ALL = 0xFFFFFFFF
+
+# Compiled escape patterns and replacement tables, by ACCM.
+_escape_patterns = {}
+
+
+def _get_escape_pattern(accm):
+    entry = _escape_patterns.get(accm)
+    if entry is None:
+        codes = [HDLC_FLAG_CHAR, HDLC_ESC_CHAR]
+        codes.extend(i for i in range(32) if accm & (1 << i))
+        pattern = re.compile(b'[' + re.escape(bytes(codes)) + b']')
+        escaped = dict((bytes((i,)), bytes((HDLC_ESC_CHAR, i ^ HDLC_ESC_MOD)))
+                       for i in codes)
+        entry = _escape_patterns[accm] = (pattern, escaped)
+    return entry
+
+
+def escape(data, accm=ACCM_NONE):
+    '''
+    Byte stuff data: replace every flag, escape and ACCM character with an
+    HDLC_ESC followed by the character XOR HDLC_ESC_MOD.
+
+    Data with nothing to escape is returned as is.
+    '''
+    if not accm:
+        # Escape the escapes first so the escaped flags are left alone.
+        return data.replace(HDLC_ESC, HDLC_ESC + b'\x5D').replace(
+            HDLC_FLAG, HDLC_ESC + b'\x5E')
+
+    pattern, escaped = _get_escape_pattern(accm)
+    return pattern.sub(lambda m: escaped[m.group()], data)
+
+
+def encode_frame(channel, control, data, accm=ACCM_NONE):
+    '''
+    Build a complete frame: an HDLC_FLAG, then the channel, the control, the
+    data and the FCS (all escaped), then a closing HDLC_FLAG.
+
+    The FCS is computed over the pieces in place and the frame is assembled
+    with a single join, so the payload is only copied into the final frame.
+    '''
+    header = struct.pack('BB', channel, control)
+    fcs = compute_fcs32(data, compute_fcs32(header)) ^ 0xFFFFFFFF
+    return b''.join((HDLC_FLAG, escape(header, accm), escape(data, accm),
+                    escape(struct.pack('<I', fcs), accm), HDLC_FLAG))
+
+
+def encode_frames(frames, accm=ACCM_NONE):
+    '''
+    Build back-to-back frames from (channel, control, data) tuples.
+
+    As RFC 1662 allows, a single HDLC_FLAG closes each frame and opens the
+    next, and the whole batch is assembled with a single join.
+    '''
+    pieces = [HDLC_FLAG]
+    for channel, control, data in frames:
+        header = struct.pack('BB', channel, control)
+        fcs = compute_fcs32(data, compute_fcs32(header)) ^ 0xFFFFFFFF
+        pieces.extend((escape(header, accm), escape(data, accm),
+                       escape(struct.pack('<I', fcs), accm), HDLC_FLAG))
+    return b''.join(pieces)
+
+
+class FCS(object):
+    '''
+    A frame check sequence: a reflected CRC of (size) bytes. As RFC 1662
+    does for FCS-16 and FCS-32, the register starts as all ones and its
+    complement is sent after the frame, LSB first.
+
+    (polynomial) is the generator in reflected form (0x8408 for FCS-16).
+    (compute)(data, fcs=None) gives the register after (data), starting
+    from all ones or (fcs); by default it uses the crc_table() of the
+    polynomial. (native) means the C deframer knows this FCS by (name).
+    An FCS of size 0 is no FCS at all.
+    '''
+    def __init__(self, name, size, polynomial=0, compute=None,
+                 native=False):
+        self.name = name
+        self.size = size
+        self.polynomial = polynomial
+        self.mask = (1 << (8 * size)) - 1
+        if compute is not None:
+            self.compute = compute
+        self.native = native
+        self._good_final = None
+
+    def __repr__(self):
+        return '<FCS %s>' % self.name
+
+    def compute(self, data, fcs=None):
+        if fcs is None:
+            fcs = self.mask
+
+        table = crc_table(self.polynomial)
+        for c in data:
+            fcs = (fcs >> 8) ^ table[(fcs ^ c) & 0xff]
+
+        return fcs
+
+    @property
+    def good_final(self):
+        '''
+        The register after a good frame and its FCS (FCS32_GOOD_FINAL for
+        FCS-32).
+        '''
+        if self._good_final is None:
+            self._good_final = self.compute(bytes(self.size))
+        return self._good_final
+
+    def pack(self, fcs):
+        '''
+        Return the bytes sent for the register value (fcs).
+        '''
+        return ((fcs ^ self.mask) & self.mask).to_bytes(self.size, 'little')
+
+    def append(self, data):
+        return data + self.pack(self.compute(data))
+
+    def encode_frame(self, channel, control, data, accm=ACCM_NONE):
+        '''
+        encode_frame() with this FCS.
+        '''
+        return HDLC_FLAG + self._encode(channel, control, data, accm)
+
+    def encode_frames(self, frames, accm=ACCM_NONE):
+        '''
+        encode_frames() with this FCS.
+        '''
+        pieces = [HDLC_FLAG]
+        for channel, control, data in frames:
+            pieces.append(self._encode(channel, control, data, accm))
+        return b''.join(pieces)
+
+    def _encode(self, channel, control, data, accm):
+        # A frame and its closing flag.
+        header = struct.pack('BB', channel, control)
+        fcs = self.pack(self.compute(data, self.compute(header)))
+        return b''.join((escape(header, accm), escape(data, accm),
+                         escape(fcs, accm), HDLC_FLAG))
+
+
+FCS_NONE = FCS('none', 0, compute=_compute_none, native=_hdlc is not None)
+FCS16 = FCS('fcs16', 2, FCS16_POLYNOMIAL,
+            compute=(_hdlc.fcs16 if _hdlc is not None else
+                     compute_fcs16_hqx if _crc_hqx is not None else
+                     compute_fcs16_table),
+            native=_hdlc is not None)
+FCS32 = FCS('fcs32', 4, FCS32_POLYNOMIAL, compute=_compute_fcs32,
+            native=_hdlc is not None)
+CRC32C = FCS('crc32c', 4, CRC32C_POLYNOMIAL,
+             compute=(_hdlc.crc32c if _hdlc is not None else
+                      compute_crc32c_slicing8),
+             native=_hdlc is not None)
+
+# The FCS types a Codec can be given by name.
+fcs_types = dict((fcs.name, fcs) for fcs in (FCS_NONE, FCS16, FCS32, CRC32C))
+
+
+STATISTICS_COUNTERS = (
+    'bytes',
+    'frames',
+    'unframed',
+    'empty',
+    'escaped_flag',
+    'double_escape',
+    'timeout',
+    'invalid',
+    'fcs',
+    'oversize',
+    'resync',
+    'discarded',
+)
+
+
+class Histogram(object):
+    '''
+    A histogram with power-of-two buckets: bucket n counts the values v with
+    2**(n-1) <= v < 2**n, and bucket 0 counts zeros.
+    '''
+    __slots__ = ('counts',)
+
+    def __init__(self, buckets=64):
+        self.counts = [0] * buckets
+
+    def record(self, value):
+        counts = self.counts
+        bucket = int(value).bit_length()
+        if bucket >= len(counts):
+            bucket = len(counts) - 1
+        counts[bucket] += 1
+
+    def merge(self, other):
+        '''
+        Add the counts of another histogram to this one.
+        '''
+        counts = self.counts
+        for bucket, count in enumerate(other.counts):
+            counts[bucket] += count
+
+    def snapshot(self):
+        return list(self.counts)
+
+
+class Statistics(object):
+    '''
+    HDLC receiver statistics.
+
+    The counters in STATISTICS_COUNTERS are plain attributes (also readable
+    as statistics['name'] for compatibility). oversize counts frames dropped
+    for outgrowing the MRU, resync the times the receiver then (or after a
+    double escape) went hunting for the next flag, and discarded the bytes
+    skipped while it did. Good frames are also counted
+    per channel (channel_frames and channel_bytes, indexed by channel
+    number) and by size (frame_sizes). queue_high_water is the most frames
+    ever waiting in the receiver's completed_frames.
+
+    With (timing) enabled, the time each chunk of data takes to decode and
+    the time frames wait to be retrieved are recorded (in microseconds) in
+    the decode_time and queue_wait histograms.
+
+    A (profiler) callback, if set with set_profiler(), is called with the
+    statistics once every (interval) chunks.
+    '''
+    __slots__ = STATISTICS_COUNTERS + (
+        'channel_frames',
+        'channel_bytes',
+        'frame_sizes',
+        'queue_high_water',
+        'decode_time',
+        'queue_wait',
+        'timing',
+        'profiler',
+        'profile_interval',
+        'profile_countdown',
+    )
+
+    def __init__(self, timing=False):
+        for name in STATISTICS_COUNTERS:
+            setattr(self, name, 0)
+        self.channel_frames = [0] * 256
+        self.channel_bytes = [0] * 256
+        self.frame_sizes = Histogram()
+        self.queue_high_water = 0
+        self.decode_time = Histogram()
+        self.queue_wait = Histogram()
+        self.timing = timing
+        self.profiler = None
+        self.profile_interval = 0
+        self.profile_countdown = 0
+
+    def __getitem__(self, name):
+        if name not in STATISTICS_COUNTERS:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def __setitem__(self, name, value):
+        if name not in STATISTICS_COUNTERS:
+            raise KeyError(name)
+        setattr(self, name, value)
+
+    def __iter__(self):
+        return iter(STATISTICS_COUNTERS)
+
+    def keys(self):
+        return list(STATISTICS_COUNTERS)
+
+    def items(self):
+        return [(name, getattr(self, name)) for name in STATISTICS_COUNTERS]
+
+    def __eq__(self, other):
+        if isinstance(other, (Statistics, dict)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<Statistics {0}>'.format(dict(self.items()))
+
+    def set_profiler(self, profiler, interval=1):
+        '''
+        Call profiler(statistics) once every (interval) chunks of received
+        data; a profiler of None turns this off.
+        '''
+        self.profiler = profiler
+        self.profile_interval = interval
+        self.profile_countdown = interval
+
+    def sample(self):
+        '''
+        Count a processed chunk and call the profiler when one is due.
+        '''
+        self.profile_countdown -= 1
+        if self.profile_countdown <= 0:
+            self.profile_countdown = self.profile_interval
+            self.profiler(self)
+
+    def merge(self, other):
+        '''
+        Add the statistics of another receiver (e.g. one that decoded a
+        different part of the same stream) to these.
+        '''
+        for name in STATISTICS_COUNTERS:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        for channel in range(256):
+            self.channel_frames[channel] += other.channel_frames[channel]
+            self.channel_bytes[channel] += other.channel_bytes[channel]
+        self.frame_sizes.merge(other.frame_sizes)
+        self.decode_time.merge(other.decode_time)
+        self.queue_wait.merge(other.queue_wait)
+        self.queue_high_water = max(self.queue_high_water,
+                                    other.queue_high_water)
+
+    def snapshot(self):
+        '''
+        Return a copy of the statistics as plain data (dicts and lists).
+        '''
+        return {
+            'time': time.time(),
+            'counters': dict(self.items()),
+            'channels': dict(
+                (channel, {'frames': frames,
+                           'bytes': self.channel_bytes[channel]})
+                for channel, frames in enumerate(self.channel_frames)
+                if frames),
+            'frame_sizes': self.frame_sizes.snapshot(),
+            'queue_high_water': self.queue_high_water,
+            'decode_time_us': self.decode_time.snapshot(),
+            'queue_wait_us': self.queue_wait.snapshot(),
+        }
+
+    def delta(self, previous):
+        '''
+        Return what changed since an earlier snapshot(): the differences in
+        counters, channel counts and histograms, the interval in seconds, and
+        per second rates for the counters.
+        '''
+        return snapshot_delta(self.snapshot(), previous)
+
+
+def snapshot_delta(current, previous):
+    '''
+    Return the difference between two Statistics snapshots.
+    '''
+    interval = current['time'] - previous['time']
+    counters = dict((name, value - previous['counters'].get(name, 0))
+                    for name, value in current['counters'].items())
+
+    channels = {}
+    for channel, counts in current['channels'].items():
+        before = previous['channels'].get(channel, {'frames': 0, 'bytes': 0})
+        changed = dict((name, value - before[name])
+                       for name, value in counts.items())
+        if changed['frames']:
+            channels[channel] = changed
+
+    def histogram_delta(name):
+        return [a - b for a, b in zip(current[name], previous[name])]
 
-def create_statistics():
     return {
-        'bytes': 0,
-        'unframed': 0,
-        'empty': 0,
-        'escaped_flag': 0,
-        'double_escape': 0,
-        'timeout': 0,
-        'invalid': 0,
-        'fcs': 0,
+        'interval': interval,
+        'counters': counters,
+        'rates': dict((name, value / interval if interval > 0 else 0.0)
+                      for name, value in counters.items()),
+        'channels': channels,
+        'frame_sizes': histogram_delta('frame_sizes'),
+        'queue_high_water': current['queue_high_water'],
+        'decode_time_us': histogram_delta('decode_time_us'),
+        'queue_wait_us': histogram_delta('queue_wait_us'),
     }
 
 
-class Receiver(object):
+def create_statistics(timing=False):
+    return Statistics(timing=timing)
+
+
+class Codec(object):
     '''
-    HDLC Receiver
+    HDLC framing without any I/O.
+
+    feed() runs received bytes through the deframing state machine and
+    returns the frames they complete; encode() and encode_many() build frames
+    to send. Receiver adds device reads and writes on top, and any other
+    front end (threads, asyncio, a selector loop, offline decoding) can drive
+    a Codec with bytes it got however it likes.
+
+    (fcs) is the frame check sequence, an FCS or the name of one in
+    fcs_types. With (verify_fcs) False, the FCS is stripped off received
+    frames without being checked (for hardware that has already checked it).
 
     States
     ------
@@ -153,139 +733,439 @@ class Receiver(object):
       0x7D -> GET_ESC
       * -> save, GET_FRAME
     GET_ESC:
-      0x7E -> error, OUT_OF_SYNC
+      0x7E -> error, drop frame, GET_FRAME
       0x7D -> error, OUT_OF_SYNC
       * -> save XOR 0x20, GET_FRAME
     '''
+    __slots__ = (
+        'accm',
+        'mru',
+        'state',
+        'statistics',
+        'frame',
+        'completed_frames',
+        'completed_times',
+        'timestamps',
+        'fcs',
+        'verify_fcs',
+    )
 
-    def __init__(self, device):
-        self.device = device
+    def __init__(self, accm=ACCM_NONE, mru=None, timing=False,
+                 timestamps=False, fcs='fcs32', verify_fcs=True):
+        self.accm = accm
+        self.mru = mru
+        self.fcs = fcs if isinstance(fcs, FCS) else fcs_types[fcs]
+        self.verify_fcs = verify_fcs
         self.state = IDLE
-        self.statistics = create_statistics()
-        self.frame = []
+        self.statistics = create_statistics(timing=timing)
+        # The frame being received (FCS included).  The same buffer is
+        # emptied and refilled for every frame.
+        self.frame = bytearray()
         self.completed_frames = deque()
-        self.esc_chars = [HDLC_FLAG, HDLC_ESC]
-        self.state_handler = {
-            OUT_OF_SYNC : self.process_out_of_sync,
-            IDLE: self.process_idle,
-            GET_FRAME: self.process_get,
-            GET_ESC: self.process_esc,
-        }
+        # With timestamps (or timing), the time each completed frame was
+        # queued.
+        self.timestamps = timestamps or timing
+        self.completed_times = deque()
 
-    def _read(self):
-        '''
-        Read incoming bytes from the HDLC device.
+    def process_state(self, c):
         '''
-        return self.device.read(1)
+        Run one received byte (c, an int) through the state machine.
 
-    def set_state(self, next_state):
-        '''
-        Set the HDLC state flag to the given state to be processed.
+        Save plain bytes to the frame, decode escapes, and verify and queue
+        the frame on a closing flag. Bad frames are queued as None objects.
         '''
-        current_state = self.state
+        state = self.state
+        if state == GET_FRAME:
+            if c == HDLC_FLAG_CHAR:
+                self.end_frame()
+                del self.frame[:]
+            elif c == HDLC_ESC_CHAR:
+                self.state = GET_ESC
+            else:
+                self.frame.append(c)
+                if (self.mru is not None and
+                        len(self.frame) > self.mru + self.fcs.size):
+                    self.abort_frame()
+                    self.state = OUT_OF_SYNC
 
-        if next_state == GET_FRAME:
-            if current_state != GET_ESC:
+        elif state == GET_ESC:
+            if c == HDLC_FLAG_CHAR:
+                # An escaped flag aborts the frame in progress.
+                self.statistics.escaped_flag += 1
+                self.statistics.invalid += 1
                 del self.frame[:]
+                self.state = GET_FRAME
+            elif c == HDLC_ESC_CHAR:
+                self.statistics.double_escape += 1
+                self.statistics.invalid += 1
+                self.statistics.resync += 1
+                self.state = OUT_OF_SYNC
+            else:
+                self.frame.append(c ^ HDLC_ESC_MOD)
+                self.state = GET_FRAME
+                if (self.mru is not None and
+                        len(self.frame) > self.mru + self.fcs.size):
+                    self.abort_frame()
+                    self.state = OUT_OF_SYNC
+
+        elif state == IDLE:
+            if c == HDLC_FLAG_CHAR:
+                self.state = GET_FRAME
+            elif c != HDLC_IDLE_CHAR:
+                self.statistics.unframed += 1
 
-        self.state = next_state
+        elif c == HDLC_FLAG_CHAR:
+            # OUT_OF_SYNC: wait for a flag to start a fresh frame.
+            del self.frame[:]
+            self.state = GET_FRAME
+        else:
+            self.statistics.discarded += 1
 
-    def process_out_of_sync(self, c):
+    def end_frame(self):
         '''
-        Handle an out of sync HDLC state.
+        Handle a closing flag: verify the collected frame and queue it (or a
+        None object for a bad frame).
+
+        Drop the FCS off of the end of good frames before queueing them.
+        Frames longer than the MRU never get this far (see abort_frame()).
         '''
-        if c == HDLC_FLAG:
-            self.state = GET_FRAME
+        frame = self.frame
+        if not frame:
+            self.statistics.empty += 1
+            return
 
-    def _write(self, data):
+        if self.verify_frame(frame):
+            # Drop the FCS off of the queued frame.  This is the only copy
+            # made of the received data.
+            self.queue_frame(
+                memoryview(frame)[:len(frame) - self.fcs.size].tobytes())
+        else:
+            # Bad frame.  Tack in a None object to indicate this.
+            self.queue_frame(None)
+
+    def abort_frame(self):
         '''
-        Write data to the HDLC connected device.
+        Drop the frame in progress as soon as it outgrows the MRU, queueing a
+        None object for it. The caller then skips to the next flag
+        (OUT_OF_SYNC), so the receiver neither buffers nor checks the FCS of
+        any more of it.
         '''
-        self.device.write(data)
+        stats = self.statistics
+        stats.oversize += 1
+        stats.resync += 1
+        del self.frame[:]
+        self.queue_frame(None)
 
-    def process_idle(self, c):
+    def queue_frame(self, frame):
         '''
-        Handle an HDLC_IDLE state.
+        Add a frame (or None for a bad frame) to completed_frames, counting
+        good frames in the statistics.
         '''
-        if c == HDLC_IDLE:
-            self.state = IDLE
-        elif c == HDLC_FLAG:
-            self.state = GET_FRAME
-        else:
-            self.statistics['unframed'] += 1
+        stats = self.statistics
+        completed = self.completed_frames
+        completed.append(frame)
+        if frame is not None:
+            length = len(frame)
+            stats.frames += 1
+            stats.frame_sizes.record(length)
+            if length:
+                stats.channel_frames[frame[0]] += 1
+                stats.channel_bytes[frame[0]] += length
 
-    def process_get(self, c):
+        if self.timestamps:
+            self.completed_times.append(time.time())
+        if len(completed) > stats.queue_high_water:
+            stats.queue_high_water = len(completed)
+
+    def process_data_python(self, data):
         '''
-        Compile incoming bytes into usable data.
+        Run a chunk of received data through the state machine.
 
-        Through this process, drop the HDLC flags off of the beginning and end
-        of the data, as well as the FCS value (after verifying it). If a bad
-        frame is received, replace it with a None object.
+        This gives the same frames, None objects and statistics as calling
+        process_state() for every byte, but locates flags and escapes with
+        find() and saves the plain runs between them as slices. Only escape
+        sequences are handled a byte at a time.
         '''
-        if c == HDLC_FLAG:
-            if len(self.frame) == 0:
-                self.statistics['empty'] = 1
-            else:
-                frame = '' .join(self.frame)
-                if self.verify_frame(frame):
-                    # Drop the FCS off of the queued frame.
-                    self.completed_frames.append(frame[:-4])
+        stats = self.statistics
+        if stats.timing:
+            started = time.time()
+        frame = self.frame
+        state = self.state
+        find = data.find
+        end = len(data)
+        pos = 0
+        # The most a frame may hold (FCS included), or -1 for no limit.
+        limit = -1 if self.mru is None else self.mru + self.fcs.size
+        # Position of the next flag at or after pos (end if there is none).
+        flag = -1
+
+        while pos < end:
+            if state == GET_FRAME:
+                if flag < pos:
+                    flag = find(HDLC_FLAG, pos)
+                    if flag < 0:
+                        flag = end
+
+                esc = find(HDLC_ESC, pos, flag)
+                if limit >= 0 and (len(frame) + (flag if esc < 0 else esc) -
+                                   pos) > limit:
+                    # The frame outgrows the MRU in this run: drop it and
+                    # skip to the next flag from the byte past the limit.
+                    pos += max(limit - len(frame), 0) + 1
+                    self.abort_frame()
+                    state = OUT_OF_SYNC
+                    continue
+
+                if esc >= 0:
+                    if esc > pos:
+                        frame += data[pos:esc]
+                    pos = esc + 1
+                    state = GET_ESC
+                    continue
+
+                if flag > pos:
+                    frame += data[pos:flag]
+                if flag == end:
+                    break
+
+                self.end_frame()
+                del frame[:]
+                pos = flag + 1
+
+            elif state == GET_ESC:
+                c = data[pos]
+                pos += 1
+                if c == HDLC_FLAG_CHAR:
+                    stats.escaped_flag += 1
+                    stats.invalid += 1
+                    del frame[:]
+                    state = GET_FRAME
+                elif c == HDLC_ESC_CHAR:
+                    stats.double_escape += 1
+                    stats.invalid += 1
+                    stats.resync += 1
+                    state = OUT_OF_SYNC
                 else:
-                    # Bad frame.  Tack in a None object to indicate this.
-                    self.completed_frames.append(None)
+                    frame.append(c ^ HDLC_ESC_MOD)
+                    state = GET_FRAME
+                    if 0 <= limit < len(frame):
+                        self.abort_frame()
+                        state = OUT_OF_SYNC
+
+            elif state == OUT_OF_SYNC:
+                flag = find(HDLC_FLAG, pos)
+                if flag < 0:
+                    stats.discarded += end - pos
+                    break
+                stats.discarded += flag - pos
+                del frame[:]
+                pos = flag + 1
+                state = GET_FRAME
 
-            self.set_state(GET_FRAME)
+            else:
+                # IDLE: everything up to the first flag is line idle (0xFF) or
+                # unframed garbage.
+                flag = find(HDLC_FLAG, pos)
+                stop = end if flag < 0 else flag
+                stats.unframed += (stop - pos) - data.count(HDLC_IDLE, pos,
+                                                             stop)
+                if flag < 0:
+                    break
+                pos = flag + 1
+                state = GET_FRAME
 
-        elif c == HDLC_ESC:
-            self.set_state(GET_ESC)
+        self.state = state
 
-        else:
-            self.frame.append(c)
+        if stats.timing:
+            stats.decode_time.record((time.time() - started) * 1e6)
+        if stats.profiler is not None:
+            stats.sample()
 
-    def process_esc(self, c):
+    def process_data_native(self, data):
         '''
-        When an escape character is received, decode or handle it accordingly
-        and reset the state (OUT_OF_SYNC for a double escape, GET_FRAME
-        otherwise).
+        process_data() using the C deframer from the _hdlc extension, for
+        the FCS types it knows (see FCS).
         '''
-        if c == HDLC_FLAG:
-            self.statistics['escaped_flag'] += 1
-            self.statistics['invalid'] += 1
-            self.set_state(GET_FRAME)
+        fcs = self.fcs
+        if not fcs.native:
+            return self.process_data_python(data)
 
-        elif c == HDLC_ESC:
-            self.statistics['double_escape'] += 1
-            self.statistics['invalid'] += 1
-            self.set_state(OUT_OF_SYNC)
+        stats = self.statistics
+        if stats.timing:
+            started = time.time()
+        mru = -1 if self.mru is None else self.mru
+        state, results, unframed, escaped_flag, double_escape, discarded = \
+            _hdlc.deframe(data, self.state, self.frame, mru, fcs.name,
+                          self.verify_fcs)
+        self.state = STATES[state]
 
-        else:
-            value = ord(c)
-            decoded = value ^ HDLC_ESC_MOD
-            self.frame.append(chr(decoded))
-            self.set_state(GET_FRAME)
+        stats.unframed += unframed
+        stats.escaped_flag += escaped_flag
+        stats.double_escape += double_escape
+        stats.invalid += escaped_flag + double_escape
+        stats.resync += double_escape
+        stats.discarded += discarded
+        for result in results:
+            if result.__class__ is bytes:
+                self.queue_frame(result)
+            elif result == FRAME_EMPTY:
+                stats.empty += 1
+            else:
+                if result == FRAME_SHORT:
+                    stats.invalid += 1
+                elif result == FRAME_FCS:
+                    stats.fcs += 1
+                else:
+                    stats.oversize += 1
+                    stats.resync += 1
+                self.queue_frame(None)
 
-    def process_state(self, c):
-        '''
-        Call the appropriate function based on received data.
-        '''
-        self.state_handler[self.state](c)
+        if stats.timing:
+            stats.decode_time.record((time.time() - started) * 1e6)
+        if stats.profiler is not None:
+            stats.sample()
+
+    # Selected by set_framing_core().
+    process_data = process_data_python
 
     def verify_frame(self, frame):
         '''
         Verify appropriate frame length and FCS value.
         '''
-        if len(frame) < 4:
-            self.statistics['invalid'] += 1
+        fcs = self.fcs
+        if len(frame) < fcs.size:
+            self.statistics.invalid += 1
             return False
 
-        fcs = compute_fcs32(frame)
-        if fcs != FCS32_GOOD_FINAL:
-            self.statistics['fcs'] += 1
+        if (self.verify_fcs and fcs.size and
+                fcs.compute(frame) != fcs.good_final):
+            self.statistics.fcs += 1
             return False
 
         return True
 
-    def get(self):
+    def feed(self, data, timestamps=False):
+        '''
+        Run received (data) through the deframer and return the frames it
+        completes (None for bad ones), counting the bytes in the statistics.
+
+        Frames completed earlier and not yet taken are returned first. With
+        (timestamps), return (time received, frame) pairs; see take_frames().
+        '''
+        self.statistics.bytes += len(data)
+        self.process_data(data)
+        return self.take_frames(timestamps=timestamps)
+
+    def take_frames(self, max_frames=None, timestamps=False):
+        '''
+        Remove and return the completed frames (up to (max_frames)).
+
+        With (timestamps), return (time received, frame) pairs instead. The
+        time is when the frame was decoded, as given by time.time(); the
+        codec must have been created with timestamps (or timing) enabled.
+        '''
+        if timestamps and not self.timestamps:
+            raise ValueError('The codec does not record timestamps.')
+
+        frames = self.completed_frames
+        if max_frames is None or max_frames >= len(frames):
+            max_frames = len(frames)
+
+        times = None
+        if self.timestamps:
+            times = self._take_times(max_frames)
+
+        if max_frames == len(frames):
+            batch = list(frames)
+            frames.clear()
+        else:
+            batch = [frames.popleft() for i in range(max_frames)]
+
+        if timestamps:
+            return list(zip(times, batch))
+        return batch
+
+    def _take_times(self, count):
+        '''
+        Remove and return the times of the next (count) completed frames,
+        recording how long they have waited when timing.
+        '''
+        times = self.completed_times
+        if count == len(times):
+            taken = list(times)
+            times.clear()
+        else:
+            taken = [times.popleft() for i in range(count)]
+
+        if self.statistics.timing:
+            now = time.time()
+            record = self.statistics.queue_wait.record
+            for queued in taken:
+                record((now - queued) * 1e6)
+        return taken
+
+    def encode(self, channel, control, data):
+        '''
+        Build a data frame (see encode_frame()) with the codec's FCS,
+        escaping the characters in its ACCM as well.
+        '''
+        if self.fcs is FCS32:
+            return encode_frame(channel, control, data, self.accm)
+        return self.fcs.encode_frame(channel, control, data, self.accm)
+
+    def encode_many(self, frames):
+        '''
+        Build a batch of (channel, control, data) frames sharing their flags
+        (see encode_frames()).
+        '''
+        if self.fcs is FCS32:
+            return encode_frames(frames, self.accm)
+        return self.fcs.encode_frames(frames, self.accm)
+
+
+class Receiver(Codec):
+    '''
+    HDLC Receiver
+
+    A Codec reading from and writing to (device), which needs pyserial's
+    read() and write() (and optionally in_waiting).
+    '''
+    __slots__ = (
+        'device',
+        'read_size',
+    )
+
+    def __init__(self, device, read_size=1, accm=ACCM_NONE, mru=None,
+                 timing=False, timestamps=False, fcs='fcs32', verify_fcs=True):
+        super(Receiver, self).__init__(accm=accm, mru=mru, timing=timing,
+                                       timestamps=timestamps, fcs=fcs,
+                                       verify_fcs=verify_fcs)
+        self.device = device
+        self.read_size = read_size
+
+    def _read(self):
+        '''
+        Read incoming bytes from the HDLC device.
+
+        With a read_size above 1, read whatever the device has buffered (up to
+        read_size bytes) in one call. Devices exposing pyserial's in_waiting
+        are only asked for what they hold, so we block (up to the device
+        timeout) only while nothing has arrived.
+        '''
+        size = self.read_size
+        if size > 1:
+            waiting = getattr(self.device, 'in_waiting', None)
+            if waiting is not None:
+                size = max(1, min(size, waiting))
+        return self.device.read(size)
+
+    def _write(self, data):
+        '''
+        Write data to the HDLC connected device.
+        '''
+        self.device.write(data)
+
+    def get(self, timeout=None, timestamps=False):
         '''
         Retrieve data and return a frame from the HDLC.
 
@@ -293,20 +1173,80 @@ class Receiver(object):
         state of the HDLC and build data accordingly. If we do not detect any
         incoming data and timeout, return None. If completed frames are
         detected, return them (FIFO).
+
+        A single read may complete several frames; the extras stay queued in
+        completed_frames and are returned by later calls without touching the
+        device.
+
+        If (timeout) is given, stop reading once that many seconds have
+        passed, in all, without a complete frame. With (timestamps), return
+        a (time received, frame) pair; see take_frames().
+        '''
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        if not self._receive(deadline):
+            return None
+
+        return self.take_frames(1, timestamps)[0]
+
+    def get_many(self, max_frames=None, timeout=None, timestamps=False):
+        '''
+        Retrieve data and return a list of frames from the HDLC.
+
+        Like get(), but return every frame completed by the read (up to
+        max_frames, the rest stay queued) at once. Bad frames are None objects.
+        If timeout is given, stop reading once timeout seconds have passed
+        without a complete frame. Return an empty list on a timeout.
+        '''
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        if not self._receive(deadline):
+            return []
+
+        return self.take_frames(max_frames, timestamps)
+
+    def iter_frames(self):
+        '''
+        Generate frames from the HDLC as they are received until the device
+        times out.
+
+        Frames are pulled a read at a time with get_many().
         '''
         while True:
-            c = self._read()
+            frames = self.get_many()
+            if not frames:
+                return
+
+            for frame in frames:
+                yield frame
+
+    def _receive(self, deadline=None):
+        '''
+        Read and process data until a frame is complete.
+
+        Return False if the device times out (or the deadline passes) first.
+        '''
+        while not self.completed_frames:
+            data = self._read()
 
-            if not c:
-                self.statistics['timeout'] += 1
-                return None
+            if not data:
+                self.statistics.timeout += 1
+                return False
 
             # Add to byte count for every valid byte
-            self.statistics['bytes'] += 1
-            self.process_state(c)
+            self.statistics.bytes += len(data)
+            self.process_data(data)
 
-            if self.completed_frames:
-                return self.completed_frames.popleft()
+            if (deadline is not None and not self.completed_frames and
+                    time.time() >= deadline):
+                self.statistics.timeout += 1
+                return False
+
+        return True
 
     def send(self, channel, control, data):
         '''
@@ -314,19 +1254,51 @@ class Receiver(object):
 
         Data frames consist of an HDLC_FLAG followed by the channel, the
         control, the data, the FCS (all escaped), and ending with an HDLC_FLAG.
+        Characters in the ACCM are escaped as well.
         '''
-        data = append_fcs32(chr(channel) + chr(control) + data)
+        self._write(self.encode(channel, control, data))
 
-        coded = []
-        for character in data:
-            # XOR any esc pieces of the data with HDLC_ESC_MOD
-            if character in self.esc_chars:
-                character = HDLC_ESC + (character ^ HDLC_ESC_MOD)
-            coded.append(character) 
+    def send_many(self, frames):
+        '''
+        Build and send a batch of (channel, control, data) frames through the
+        HDLC in a single write, with the frames sharing their flags.
+        '''
+        self._write(self.encode_many(frames))
 
-        coded = ''.join(coded)
 
-        frame = HDLC_FLAG + coded + HDLC_FLAG
+# The framing core: the pure Python code above, or the same functions in C
+# from the optional _hdlc extension (see _hdlc.c).  Both give identical
+# output; the extension releases the GIL while it works.
+framing_cores = {
+    'python': {
+        'escape': escape,
+        'encode_frame': encode_frame,
+        'encode_frames': encode_frames,
+        'process_data': Codec.process_data_python,
+    },
+}
+if _hdlc is not None:
+    framing_cores['native'] = {
+        'escape': _hdlc.escape,
+        'encode_frame': _hdlc.encode_frame,
+        'encode_frames': _hdlc.encode_frames,
+        'process_data': Codec.process_data_native,
+    }
+
+
+def set_framing_core(name):
+    '''
+    Select the framing core (a key of framing_cores) used by escape(),
+    encode_frame(), encode_frames() and Codec.process_data().
+    '''
+    global escape, encode_frame, encode_frames, framing_core
+    core = framing_cores[name]
+    framing_core = name
+    escape = core['escape']
+    encode_frame = core['encode_frame']
+    encode_frames = core['encode_frames']
+    Codec.process_data = core['process_data']
 
-        self._write(frame)
 
+# Use the extension when it has been built.
+set_framing_core('native' if _hdlc is not None else 'python')
@@ -0,0 +1,233 @@
+'''
+Many HDLC links served by one selector loop.
+
+A VirtualSerial runs a reader thread per device. A LinkManager instead
+registers every device with a single selectors (epoll/kqueue/poll) loop and
+deframes whatever is readable, so one process can serve hundreds of links
+with a handful of threads:
+
+    manager = LinkManager(workers=4)
+    link = manager.add_link(serial.Serial('/dev/ttyS0', timeout=0))
+    channel = link.open(0)
+    data = channel.read(3, timeout=1)
+    manager.close()
+
+Devices must have a fileno(). Links are VirtualSerial objects, so channels
+are opened and used as usual.
+'''
+import os
+import selectors
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import virtualserial
+
+
+class Link(virtualserial.VirtualSerial):
+    '''
+    A VirtualSerial whose device is read by a LinkManager rather than by a
+    thread of its own.
+
+    Received frames are delivered to the channels from the manager's
+    threads. A full channel with the OVERFLOW_BLOCK policy stalls the thread
+    delivering to it, so prefer the other policies (or use workers) when one
+    slow reader must not hold up other links.
+    '''
+    def __init__(self, manager, device, read_size=4096, coalesce=False,
+                 flush_latency=0.002, flush_size=4096, timing=False,
+                 timestamps=False, max_payload=None, fcs='fcs32',
+                 verify_fcs=True, start=True):
+        self.manager = manager
+        self.device = device
+        self.read_size = read_size
+        self.closed = False
+        # The exception that made the manager drop the link, if any.
+        self.error = None
+        super(Link, self).__init__(device, read_size=read_size,
+                                   coalesce=coalesce,
+                                   flush_latency=flush_latency,
+                                   flush_size=flush_size, timing=timing,
+                                   timestamps=timestamps,
+                                   max_payload=max_payload, fcs=fcs,
+                                   verify_fcs=verify_fcs, start=start)
+
+    def fileno(self):
+        return self.device.fileno()
+
+    def close(self, timeout=None):
+        '''
+        Stop the manager reading the device, then close as VirtualSerial
+        does.
+        '''
+        if not self.manager.closed:
+            self.manager.remove_link(self)
+        super(Link, self).close(timeout)
+
+    def _start_thread(self):
+        # The manager reads the device; there is no reader thread.
+        self.manager._register(self)
+
+    def _read_ready(self):
+        '''
+        Read what the device has available (it is readable, so this does not
+        block). Devices exposing pyserial's in_waiting are read through the
+        receiver; others straight from the file descriptor.
+        '''
+        if getattr(self.device, 'in_waiting', None) is not None:
+            return self.hdlc._read()
+        return os.read(self.fileno(), self.read_size)
+
+    def _service(self):
+        '''
+        Deframe what is readable and deliver the frames to the channels.
+        Return False once the device has been closed at the other end, or
+        if reading or delivering failed (the exception is kept in error).
+        '''
+        try:
+            data = self._read_ready()
+            if not data:
+                return False
+
+            frames = self.hdlc.feed(data, timestamps=self.timestamps)
+            if frames:
+                if self.timestamps:
+                    self.deliver([frame for received, frame in frames],
+                                  [received for received, frame in frames])
+                else:
+                    self.deliver(frames)
+        except (BlockingIOError, InterruptedError):
+            # A spurious wakeup: there was nothing to read after all.
+            pass
+        except Exception as exc:
+            self.error = exc
+            return False
+        return True
+
+
+class LinkManager(object):
+    '''
+    Serve the links of many devices from a single selector loop.
+
+    With (workers) of 0 the loop thread deframes every readable device
+    itself. Otherwise readable devices are handed to a pool of that many
+    threads; the C framing core (see hdlc.set_framing_core) releases the GIL,
+    so they deframe in parallel. A link is only ever serviced by one thread
+    at a time, so its frames stay in order.
+
+    A link is dropped when its device reaches EOF, or when reading it or
+    delivering its frames fails (see Link.error); the other links carry on.
+    '''
+    def __init__(self, workers=0):
+        self.selector = selectors.DefaultSelector()
+        self.links = []
+        self.pool = ThreadPoolExecutor(workers) if workers > 0 else None
+        self.closed = False
+        self._lock = threading.Lock()
+        self._pending = []
+        self._wake_read, self._wake_write = os.pipe()
+        self.selector.register(self._wake_read, selectors.EVENT_READ)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add_link(self, device, read_size=4096, coalesce=False,
+                 flush_latency=0.002, flush_size=4096, timing=False,
+                 timestamps=False, max_payload=None, fcs='fcs32',
+                 verify_fcs=True, start=True):
+        '''
+        Register (device) and return its Link (see VirtualSerial for the
+        other arguments). Without (start), the device is registered by
+        Link.start().
+        '''
+        return Link(self, device, read_size=read_size, coalesce=coalesce,
+                    flush_latency=flush_latency, flush_size=flush_size,
+                    timing=timing, timestamps=timestamps,
+                    max_payload=max_payload, fcs=fcs, verify_fcs=verify_fcs,
+                    start=start)
+
+    def remove_link(self, link):
+        '''
+        Stop reading (link)'s device. The device is left open.
+        '''
+        self._request('remove', link)
+
+    def close(self):
+        '''
+        Stop the loop and the workers and unregister every link.
+        '''
+        if self.closed:
+            return
+        self._request('close', None)
+        self._thread.join()
+        if self.pool is not None:
+            self.pool.shutdown()
+        os.close(self._wake_read)
+        os.close(self._wake_write)
+        self.selector.close()
+
+    def _register(self, link):
+        self._request('add', link)
+
+    def _request(self, action, link):
+        '''
+        Queue a change for the loop thread (the selector is only touched
+        from there) and wake it up.
+        '''
+        with self._lock:
+            self._pending.append((action, link))
+        os.write(self._wake_write, b'\0')
+
+    def _apply_pending(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+
+        for action, link in pending:
+            if action == 'add':
+                if link in self.links:
+                    continue
+                self.links.append(link)
+                self.selector.register(link, selectors.EVENT_READ, link)
+            elif action == 'rearm':
+                if not link.closed:
+                    self.selector.register(link, selectors.EVENT_READ, link)
+            elif action == 'remove':
+                self._unregister(link)
+            else:
+                self.closed = True
+                for link in list(self.links):
+                    self._unregister(link)
+
+    def _unregister(self, link):
+        if link in self.links:
+            self.links.remove(link)
+        link.closed = True
+        try:
+            self.selector.unregister(link)
+        except (KeyError, ValueError):
+            # Not registered (being serviced), or its device is closed.
+            pass
+
+    def _run(self):
+        while not self.closed:
+            for key, events in self.selector.select():
+                link = key.data
+                if link is None:
+                    os.read(self._wake_read, 4096)
+                    self._apply_pending()
+                elif link.closed:
+                    # Removed while handling this batch of events.
+                    continue
+                elif self.pool is None:
+                    if not link._service():
+                        self._unregister(link)
+                else:
+                    # Stop watching the link until its worker is done with it.
+                    self.selector.unregister(link)
+                    self.pool.submit(self._service, link)
+
+    def _service(self, link):
+        if link._service():
+            self._request('rearm', link)
+        else:
+            self._request('remove', link)
@@ -0,0 +1,10 @@
+from setuptools import Extension, setup
+
+setup(
+    name='hdlc',
+    py_modules=['hdlc', 'virtualserial', 'aiovirtualserial', 'linkmanager',
+                'capture'],
+    # The C framing core is optional: hdlc.py falls back to pure Python
+    # when it is missing, so a failed build is not an error.
+    ext_modules=[Extension('_hdlc', ['_hdlc.c'], optional=True)],
+)
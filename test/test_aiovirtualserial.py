@@ -0,0 +1,171 @@
+import socket
+import unittest
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+if asyncio is not None:
+    from aiovirtualserial import *
+
+
+class LoopbackTransport(object):
+    '''
+    A fake transport for testing purposes. Delivers everything written to it
+    back to its protocol on the next loop iteration.
+    '''
+    def __init__(self, loop, protocol):
+        self.loop = loop
+        self.protocol = protocol
+        self.reading = True
+        self.held = []
+        protocol.connection_made(self)
+
+    def write(self, data):
+        self.held.append(data)
+        self.loop.call_soon(self._deliver)
+
+    def pause_reading(self):
+        self.reading = False
+
+    def resume_reading(self):
+        self.reading = True
+        self.loop.call_soon(self._deliver)
+
+    def _deliver(self):
+        if self.reading and self.held:
+            self.protocol.data_received(self.held.pop(0))
+
+
+@unittest.skipIf(asyncio is None, 'asyncio requires Python 3')
+class TestAsyncVirtualSerial(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def _run(self, future, timeout=5):
+        return self.loop.run_until_complete(
+            asyncio.wait_for(future, timeout))
+
+    def _loopback(self):
+        vs = AsyncVirtualSerial(loop=self.loop)
+        LoopbackTransport(self.loop, vs)
+        return vs
+
+    def test_channelWriteRead(self):
+        '''
+        Verify that writing to a channel and reading from a channel yield an
+        expected result.
+        '''
+        vs = self._loopback()
+        ch = vs.open(0)
+        ch.write(b'foo')
+        ch.write(b'bar')
+        self.assertEqual(self._run(ch.read(6)), b'foobar')
+
+    def test_multiChannelRead(self):
+        '''
+        Verify entries on multiple channels are read correctly.
+        '''
+        vs = self._loopback()
+        ch0 = vs.open(0)
+        ch1 = vs.open(1)
+        ch0.write(b'foo')
+        ch1.write(b'b\x7ear')
+        self.assertEqual(self._run(ch1.read(4)), b'b\x7ear')
+        self.assertEqual(self._run(ch0.read(3)), b'foo')
+
+    def test_cancelledRead(self):
+        '''
+        Verify that a timed out read leaves the data for the next read.
+        '''
+        vs = self._loopback()
+        ch = vs.open(0)
+        ch.write(b'foo')
+        with self.assertRaises(asyncio.TimeoutError):
+            self._run(ch.read(4), timeout=0.1)
+        self.assertEqual(self._run(ch.read(3)), b'foo')
+
+    def test_readBackpressure(self):
+        '''
+        Verify that a full channel pauses reading until it is read from.
+        '''
+        vs = self._loopback()
+        ch = vs.open(0, maxsize=3)
+        ch.write(b'foo')
+        ch.write(b'bar')
+        self._run(asyncio.sleep(0.01))
+        self.assertTrue(ch.isFull())
+        self.assertFalse(vs.transport.reading)
+        self.assertEqual(ch.buffer, b'foo')
+        self.assertEqual(self._run(ch.read(6)), b'foobar')
+        self.assertTrue(vs.transport.reading)
+
+    def test_cancelledReadBackpressure(self):
+        '''
+        Verify that cancelling the read keeping a full channel's reading
+        going pauses reading.
+        '''
+        vs = self._loopback()
+        ch = vs.open(0, maxsize=3)
+        reader = ch.read(10)
+        ch.write(b'foo')
+        ch.write(b'bar')
+        self._run(asyncio.sleep(0.01))
+        self.assertTrue(vs.transport.reading)
+        reader.cancel()
+        self._run(asyncio.sleep(0.01))
+        self.assertFalse(vs.transport.reading)
+        self.assertEqual(self._run(ch.read(6)), b'foobar')
+
+    def test_runningLoop(self):
+        '''
+        Verify that a protocol created without a loop uses the running one.
+        '''
+        async def run():
+            vs = AsyncVirtualSerial()
+            self.assertEqual(vs.loop, None)
+            LoopbackTransport(asyncio.get_running_loop(), vs)
+            self.assertTrue(vs.loop is asyncio.get_running_loop())
+            ch = vs.open(0)
+            ch.write(b'foo')
+            return await ch.read(3)
+
+        self.assertEqual(self._run(run()), b'foo')
+
+    def test_drain(self):
+        '''
+        Verify that drain() waits for the transport to resume writing.
+        '''
+        vs = self._loopback()
+        ch = vs.open(0)
+        vs.pause_writing()
+        waiter = ch.drain()
+        self.assertFalse(waiter.done())
+        vs.resume_writing()
+        self._run(waiter)
+
+    def test_socketpair(self):
+        '''
+        Verify channels between two connections over a socket pair.
+        '''
+        a, b = socket.socketpair()
+        _, vs_a = self._run(self.loop.create_connection(
+            lambda: AsyncVirtualSerial(loop=self.loop), sock=a))
+        transport_b, vs_b = self._run(self.loop.create_connection(
+            lambda: AsyncVirtualSerial(loop=self.loop), sock=b))
+        ch_a = vs_a.open(5)
+        ch_b = vs_b.open(5)
+        data = bytes(bytearray(range(256))) * 4
+        ch_a.write(data)
+        self._run(ch_a.drain())
+        self.assertEqual(self._run(ch_b.read(len(data))), data)
+        self.assertEqual(vs_b.statistics['fcs'], 0)
+
+        vs_a.transport.close()
+        self.assertEqual(self._run(ch_b.read(1)), b'')
+        transport_b.close()
+        self._run(asyncio.sleep(0))
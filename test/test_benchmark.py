@@ -0,0 +1,28 @@
+import unittest
+
+import benchmark
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_loopbackDevice(self):
+        '''
+        Verify that the loopback device reads back what was written and times
+        out when empty.
+        '''
+        device = benchmark.LoopbackDevice(timeout=0.01)
+        device.write(b'foobar')
+        self.assertEqual(device.in_waiting, 6)
+        self.assertEqual(device.read(4), b'foob')
+        self.assertEqual(device.read(4), b'ar')
+        self.assertEqual(device.read(4), b'')
+
+    def test_run(self):
+        '''
+        Verify that every benchmark runs and reports results.
+        '''
+        report = benchmark.run(quick=True)
+        names = set(result['benchmark'] for result in report['results'])
+        self.assertEqual(names, set(benchmark.BENCHMARKS))
+        for result in report['results']:
+            if 'mb_per_s' in result:
+                self.assertTrue(result['mb_per_s'] > 0)
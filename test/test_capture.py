@@ -0,0 +1,193 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import hdlc
+import virtualserial
+from capture import *
+
+
+def _capture(rand, frames):
+    '''
+    Build a raw capture: good frames with idle bytes, garbage and damaged
+    frames in between.
+    '''
+    pieces = []
+    for i in range(frames):
+        data = bytes(rand.choice(b'\x7e\x7d\xffab') for i in range(
+            rand.randint(0, 40)))
+        frame = hdlc.encode_frame(rand.randrange(4), 0, data)
+        choice = rand.random()
+        if choice < 0.1:
+            frame = frame[:-3] + b'\x00' + frame[-2:]
+        elif choice < 0.2:
+            frame = b'\xff\xff' + frame
+        elif choice < 0.25:
+            frame = b'\x7d\x7d' + frame
+        pieces.append(frame)
+    return b''.join(pieces)
+
+
+class TestCaptureDecoder(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'link.raw')
+        self.data = _capture(random.Random(17), 500)
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+
+        self.expected = hdlc.Receiver(None)
+        self.expected.statistics.bytes += len(self.data)
+        self.expected.process_data(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _check(self, decoder):
+        self.assertEqual(list(decoder.frames()),
+                         list(self.expected.completed_frames))
+        self.assertEqual(decoder.statistics, self.expected.statistics)
+        self.assertEqual(decoder.statistics.channel_frames,
+                         self.expected.statistics.channel_frames)
+        self.assertEqual(decoder.state, self.expected.state)
+        self.assertEqual(decoder.frame, bytes(self.expected.frame))
+
+    def test_find_chunks(self):
+        chunks = find_chunks(self.path, chunk_size=100)
+        self.assertTrue(len(chunks) > 10)
+        self.assertEqual(chunks[0][0], 0)
+        self.assertEqual(sum(length for offset, length in chunks),
+                         len(self.data))
+        for offset, length in chunks[:-1]:
+            self.assertEqual(self.data[offset + length - 1:offset + length],
+                             hdlc.HDLC_FLAG)
+
+    def test_in_process(self):
+        for chunk_size in (1, 7, 100, 1 << 20):
+            self._check(CaptureDecoder(self.path, workers=0,
+                                       chunk_size=chunk_size))
+
+    def test_process_pool(self):
+        self._check(CaptureDecoder(self.path, workers=2, chunk_size=1000))
+
+    def test_write(self):
+        out = os.path.join(self.dir, 'link.frames')
+        decoder = CaptureDecoder(self.path, workers=0, chunk_size=1000)
+        count = decoder.write(out)
+        frames = [frame for frame in self.expected.completed_frames
+                  if frame is not None]
+        self.assertEqual(count, len(frames))
+        with open(out, 'rb') as f:
+            self.assertEqual(f.read(), b''.join(frames))
+        with open(out + '.idx', 'rb') as f:
+            index = f.read()
+        self.assertEqual(len(index), count * INDEX_RECORD.size)
+        offset = 0
+        for i, frame in enumerate(frames):
+            record = INDEX_RECORD.unpack_from(index, i * INDEX_RECORD.size)
+            self.assertEqual(record, (offset, len(frame), frame[0], 0.0))
+            offset += len(frame)
+
+
+class TestFrameFile(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'link.frames')
+        rand = random.Random(18)
+        self.frames = [bytes([rand.randrange(4), 0]) + bytes(
+            rand.randrange(256) for i in range(rand.randint(0, 20)))
+            for i in range(300)]
+        with FrameWriter(self.path) as writer:
+            for i, frame in enumerate(self.frames):
+                writer.write(frame, timestamp=1000.0 + i)
+        self.file = FrameFile(self.path)
+
+    def tearDown(self):
+        self.file.close()
+        shutil.rmtree(self.dir)
+
+    def test_index(self):
+        self.assertEqual(len(self.file), len(self.frames))
+        self.assertEqual(list(self.file), self.frames)
+        self.assertEqual(self.file[123], self.frames[123])
+        self.assertEqual(self.file[-1], self.frames[-1])
+        self.assertEqual(self.file.channel(7), self.frames[7][0])
+        self.assertEqual(self.file.timestamp(7), 1007.0)
+        self.assertRaises(IndexError, lambda: self.file[len(self.frames)])
+
+    def test_channels(self):
+        for channel in range(5):
+            numbers = [i for i, frame in enumerate(self.frames)
+                       if frame[0] == channel]
+            self.assertEqual(self.file.channel_frames(channel), numbers)
+            self.assertEqual(list(self.file.frames(channel=channel,
+                                                   start=100)),
+                             [self.frames[i] for i in numbers if i >= 100])
+
+    def test_find_time(self):
+        self.assertEqual(self.file.find_time(0), 0)
+        self.assertEqual(self.file.find_time(1050), 50)
+        self.assertEqual(self.file.find_time(1050.5), 51)
+        self.assertEqual(self.file.find_time(5000), len(self.frames))
+
+    def test_empty(self):
+        path = os.path.join(self.dir, 'empty.frames')
+        FrameWriter(path).close()
+        with FrameFile(path) as frames:
+            self.assertEqual(len(frames), 0)
+            self.assertEqual(list(frames.frames(channel=1)), [])
+
+    def test_replay(self):
+        vs = virtualserial.VirtualSerial(CaptureDevice(b''))
+        channel = vs.open(2)
+        self.file.replay(vs, batch=16)
+        expected = b''.join(frame[2:] for frame in self.frames
+                            if frame[0] == 2)
+        self.assertEqual(channel.read(len(expected), timeout=1), expected)
+
+
+class TestCaptureFile(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'link.raw')
+        self.data = _capture(random.Random(19), 200)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_record(self):
+        device = RecordingDevice(CaptureDevice(self.data, timeout=0),
+                                 CaptureWriter(self.path))
+        receiver = hdlc.Receiver(device, read_size=100)
+        while device.in_waiting:
+            receiver.process_data(receiver._read())
+        device.writer.close()
+
+        with CaptureFile(self.path) as capture:
+            self.assertEqual(capture.data[:], self.data)
+            self.assertEqual(len(capture), (len(self.data) + 99) // 100)
+            self.assertEqual(capture[1], self.data[100:200])
+
+            replayed = hdlc.Receiver(capture.device(timeout=0),
+                                     read_size=100)
+            while replayed.device.in_waiting:
+                replayed.process_data(replayed._read())
+            self.assertEqual(list(replayed.completed_frames),
+                             list(receiver.completed_frames))
+
+    def test_virtualserial(self):
+        frames = [hdlc.encode_frame(1, 0, b'frame %d' % i) for i in range(50)]
+        with CaptureWriter(self.path) as writer:
+            for i, frame in enumerate(frames):
+                writer.write(frame, timestamp=float(i))
+
+        with CaptureFile(self.path) as capture:
+            vs = virtualserial.VirtualSerial(capture.device(
+                start=capture.find_time(40)), read_size=64, start=False)
+            channel = vs.open(1)
+            with vs:
+                expected = b''.join(b'frame %d' % i for i in range(40, 50))
+                self.assertEqual(channel.read(len(expected), timeout=1),
+                                 expected)
@@ -1,3 +1,6 @@
+import random
+import struct
+import time
 import unittest
 
 import hdlc
@@ -5,13 +8,39 @@ import hdlc
 
 class FakeDevice(object):
     def __init__(self, data):
-        self.data = list(data)
+        self.data = data
 
     def read(self, count):
         assert count == 1
         if len(self.data) == 0:
             return None
-        return self.data.pop(0)
+        result, self.data = self.data[:1], self.data[1:]
+        return result
+
+
+class FakeBulkDevice(object):
+    def __init__(self, data):
+        self.data = data
+        self.reads = 0
+
+    @property
+    def in_waiting(self):
+        return len(self.data)
+
+    def read(self, count):
+        self.reads += 1
+        if len(self.data) == 0:
+            return None
+        result, self.data = self.data[:count], self.data[count:]
+        return result
+
+
+class FakeWriteDevice(object):
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(data)
 
 
 def _make_receiver(data):
@@ -20,44 +49,660 @@ def _make_receiver(data):
 
 class TestHdlc(unittest.TestCase):
     def test_unframed(self):
-        r = _make_receiver('bad')
+        r = _make_receiver(b'bad')
         self.assertEqual(r.get(), None)
         self.assertEqual(r.statistics['bytes'], 3)
         self.assertEqual(r.statistics['unframed'], 3)
 
     def test_empty(self):
-        r = _make_receiver('\x7e\x7e')
+        r = _make_receiver(b'\x7e\x7e')
         self.assertEqual(r.get(), None)
         self.assertEqual(r.statistics['bytes'], 2)
         self.assertEqual(r.statistics['empty'], 1)
 
     def test_short(self):
-        r = _make_receiver('\x7ebad\x7e')
+        r = _make_receiver(b'\x7ebad\x7e')
         self.assertEqual(r.get(), None)
         self.assertEqual(r.statistics['bytes'], 5)
         self.assertEqual(r.statistics['invalid'], 1)
 
     def test_escaped(self):
-        r = _make_receiver('\x7eabc\x7d\x5edef\x3f\xd4\x66\x53\x7e')
-        self.assertEqual(r.get(), 'abc\x7edef')
+        r = _make_receiver(b'\x7eabc\x7d\x5edef\x3f\xd4\x66\x53\x7e')
+        self.assertEqual(r.get(), b'abc\x7edef')
         self.assertEqual(r.statistics['bytes'], 14)
         self.assertEqual(r.statistics['fcs'], 0)
 
     def test_invalid_crc(self):
-        r = _make_receiver('\x7eabc\x7d\x5edef\x3f\xd4\x66\x55\x7e')
+        r = _make_receiver(b'\x7eabc\x7d\x5edef\x3f\xd4\x66\x55\x7e')
         self.assertEqual(r.get(), None)
         self.assertEqual(r.statistics['bytes'], 14)
         self.assertEqual(r.statistics['fcs'], 1)
 
 
+class TestBulkRead(unittest.TestCase):
+    frame = b'\x7eabc\x7d\x5edef\x3f\xd4\x66\x53\x7e'
+
+    def test_single_read(self):
+        device = FakeBulkDevice(self.frame)
+        r = hdlc.Receiver(device, read_size=4096)
+        self.assertEqual(r.get(), b'abc\x7edef')
+        self.assertEqual(device.reads, 1)
+        self.assertEqual(r.statistics['bytes'], 14)
+
+    def test_read_size_limit(self):
+        device = FakeBulkDevice(self.frame)
+        r = hdlc.Receiver(device, read_size=4)
+        self.assertEqual(r.get(), b'abc\x7edef')
+        self.assertEqual(device.reads, 4)
+
+    def test_queued_frames(self):
+        device = FakeBulkDevice(self.frame * 2)
+        r = hdlc.Receiver(device, read_size=4096)
+        self.assertEqual(r.get(), b'abc\x7edef')
+        self.assertEqual(r.get(), b'abc\x7edef')
+        self.assertEqual(device.reads, 1)
+        self.assertEqual(r.statistics['empty'], 1)
+
+    def test_timeout(self):
+        device = FakeBulkDevice(self.frame[:-1])
+        r = hdlc.Receiver(device, read_size=4096)
+        self.assertEqual(r.get(), None)
+        self.assertEqual(r.statistics['bytes'], 13)
+        self.assertEqual(r.statistics['timeout'], 1)
+
+
+def _encode(data):
+    return b'\x7e' + hdlc.escape(hdlc.append_fcs32(data)) + b'\x7e'
+
+
+def _random_stream(rand, length):
+    '''
+    Build a stream of good frames mixed with idle bytes, garbage and damaged
+    escape sequences.
+    '''
+    alphabet = b'\x7e\x7d\xffab\x5e\x5d'
+    pieces = []
+    while sum(len(p) for p in pieces) < length:
+        choice = rand.random()
+        if choice < 0.5:
+            size = rand.randint(0, 20)
+            pieces.append(_encode(bytes(rand.choice(alphabet)
+                                        for i in range(size))))
+        else:
+            size = rand.randint(1, 10)
+            pieces.append(bytes(rand.choice(alphabet) for i in range(size)))
+    return b''.join(pieces)
+
+
+class TestProcessData(unittest.TestCase):
+    def _per_byte(self, data, mru=None):
+        r = _make_receiver(b'')
+        r.mru = mru
+        for c in data:
+            r.process_state(c)
+        return r
+
+    def _chunked(self, data, rand, mru=None):
+        r = _make_receiver(b'')
+        r.mru = mru
+        pos = 0
+        while pos < len(data):
+            size = rand.randint(1, 16)
+            r.process_data(data[pos:pos + size])
+            pos += size
+        return r
+
+    def test_matches_state_machine(self):
+        rand = random.Random(1662)
+        for i in range(200):
+            data = _random_stream(rand, 200)
+            expected = self._per_byte(data)
+            whole = _make_receiver(b'')
+            whole.process_data(data)
+            for r in (whole, self._chunked(data, rand)):
+                self.assertEqual(list(r.completed_frames),
+                                 list(expected.completed_frames))
+                self.assertEqual(r.statistics, expected.statistics)
+                self.assertEqual(r.state, expected.state)
+
+    def test_mru(self):
+        r = hdlc.Receiver(None, mru=4)
+        r.process_data(_encode(b'abcd') + _encode(b'abcde')[1:])
+        self.assertEqual(list(r.completed_frames), [b'abcd', None])
+        self.assertEqual(r.statistics['oversize'], 1)
+        self.assertEqual(r.statistics['fcs'], 0)
+
+    def test_mru_matches_state_machine(self):
+        rand = random.Random(1663)
+        for i in range(200):
+            data = _random_stream(rand, 200)
+            mru = rand.choice([0, 1, 4, 16])
+            expected = self._per_byte(data, mru)
+            r = self._chunked(data, rand, mru)
+            self.assertEqual(list(r.completed_frames),
+                             list(expected.completed_frames))
+            self.assertEqual(r.statistics, expected.statistics)
+            self.assertEqual(r.state, expected.state)
+            self.assertEqual(r.frame, expected.frame)
+
+    def test_mru_abort(self):
+        # A lost closing flag: the noise after it is dropped, not buffered.
+        noise = bytes(random.Random(5).choice(b'ab\x5d\xff')
+                      for i in range(1 << 16))
+        for core in sorted(hdlc.framing_cores):
+            hdlc.set_framing_core(core)
+            r = hdlc.Receiver(None, mru=16)
+            r.process_data(b'\x7e' + noise[:100])
+            self.assertTrue(len(r.frame) <= 20)
+            r.process_data(noise[100:])
+            self.assertEqual(len(r.frame), 0)
+            r.process_data(_encode(b'abcd'))
+            self.assertEqual(list(r.completed_frames), [None, b'abcd'])
+            stats = r.statistics
+            self.assertEqual(stats.oversize, 1)
+            self.assertEqual(stats.fcs, 0)
+            self.assertEqual(stats.resync, 1)
+            self.assertEqual(stats.discarded, len(noise) - 21)
+        hdlc.set_framing_core('native' if hdlc._hdlc else 'python')
+
+    def test_frame_buffer_reused(self):
+        r = _make_receiver(b'')
+        frame = r.frame
+        r.process_data(_encode(b'abc') + _encode(b'defgh')[1:])
+        self.assertTrue(r.frame is frame)
+        self.assertEqual(list(r.completed_frames), [b'abc', b'defgh'])
+        self.assertEqual(type(r.completed_frames[0]), type(b''))
+
+    def test_escaped_flag_aborts_frame(self):
+        r = _make_receiver(b'')
+        r.process_data(b'\x7exyz\x7d\x7e' + _encode(b'abc')[1:])
+        self.assertEqual(list(r.completed_frames), [b'abc'])
+        self.assertEqual(r.statistics['escaped_flag'], 1)
+
+    def test_resync_after_double_escape(self):
+        r = _make_receiver(b'')
+        r.process_data(b'\x7exyz\x7d\x7dgarbage' + _encode(b'abc'))
+        self.assertEqual(list(r.completed_frames), [b'abc'])
+        self.assertEqual(r.statistics['double_escape'], 1)
+
+
+class TestSend(unittest.TestCase):
+    def test_escape(self):
+        self.assertEqual(hdlc.escape(b'a\x7eb\x7dc'), b'a\x7d\x5eb\x7d\x5dc')
+        self.assertEqual(hdlc.escape(b'\x7d\x5e'), b'\x7d\x5d\x5e')
+        self.assertEqual(hdlc.escape(b'abc\x11'), b'abc\x11')
+
+    def test_escape_accm(self):
+        self.assertEqual(hdlc.escape(b'\x00\x11\x13\x7e', 1 << 0x11),
+                         b'\x00\x7d\x31\x13\x7d\x5e')
+        self.assertEqual(hdlc.escape(b'\x00\x1f\x20', hdlc.ACCM_ALL),
+                         b'\x7d\x20\x7d\x3f\x20')
+
+    def test_send(self):
+        device = FakeWriteDevice()
+        r = hdlc.Receiver(device)
+        r.send(1, 0, b'ab\x7e')
+        frame = device.writes[0]
+        self.assertEqual(frame, _encode(b'\x01\x00ab\x7e'))
+        self.assertEqual(frame[:6], b'\x7e\x01\x00ab\x7d')
+
+    def test_send_round_trip(self):
+        rand = random.Random(4)
+        device = FakeWriteDevice()
+        sender = hdlc.Receiver(device, accm=hdlc.ACCM_ALL)
+        for i in range(50):
+            data = bytes(rand.randrange(256) for i in range(30))
+            sender.send(i, 3, data)
+            frame = device.writes[-1]
+            self.assertFalse(any(c < 0x20 for c in frame))
+            r = _make_receiver(frame)
+            self.assertEqual(r.get(), bytes((i, 3)) + data)
+
+
+class TestGetMany(unittest.TestCase):
+    def test_get_many(self):
+        data = _encode(b'abc') + _encode(b'de')[1:] + b'\x7ebad\x7e'
+        r = hdlc.Receiver(FakeBulkDevice(data), read_size=4096)
+        self.assertEqual(r.get_many(), [b'abc', b'de', None])
+        self.assertEqual(r.device.reads, 1)
+        self.assertEqual(r.get_many(), [])
+        self.assertEqual(r.statistics['timeout'], 1)
+
+    def test_max_frames(self):
+        data = _encode(b'abc') * 3
+        r = hdlc.Receiver(FakeBulkDevice(data), read_size=4096)
+        self.assertEqual(r.get_many(max_frames=2), [b'abc', b'abc'])
+        self.assertEqual(r.get_many(max_frames=2), [b'abc'])
+        self.assertEqual(r.device.reads, 1)
+
+    def test_timeout(self):
+        r = hdlc.Receiver(FakeBulkDevice(b'\x7eabc' * 10), read_size=3)
+        self.assertEqual(r.get_many(timeout=0), [])
+        self.assertEqual(r.device.reads, 1)
+        self.assertEqual(r.statistics['timeout'], 1)
+
+    def test_get_timeout(self):
+        r = hdlc.Receiver(FakeBulkDevice(b'\x7eabc' * 10), read_size=3)
+        self.assertEqual(r.get(timeout=0), None)
+        self.assertEqual(r.statistics['timeout'], 1)
+
+    def test_timestamps(self):
+        data = _encode(b'abc') + _encode(b'de')[1:]
+        r = hdlc.Receiver(FakeBulkDevice(data), read_size=4096,
+                          timestamps=True)
+        before = time.time()
+        batch = r.get_many(timestamps=True)
+        self.assertEqual([frame for received, frame in batch],
+                         [b'abc', b'de'])
+        for received, frame in batch:
+            self.assertTrue(before <= received <= time.time())
+        self.assertEqual(len(r.completed_times), 0)
+        self.assertEqual(sum(r.statistics.queue_wait.counts), 0)
+
+    def test_no_timestamps(self):
+        r = hdlc.Receiver(None)
+        r.process_data(_encode(b'abc'))
+        self.assertRaises(ValueError, r.take_frames, timestamps=True)
+        self.assertEqual(r.take_frames(), [b'abc'])
+
+    def test_iter_frames(self):
+        data = _encode(b'abc') + _encode(b'de')[1:]
+        r = hdlc.Receiver(FakeBulkDevice(data), read_size=8)
+        self.assertEqual(list(r.iter_frames()), [b'abc', b'de'])
+
+
+class TestCodec(unittest.TestCase):
+    def test_feed(self):
+        data = hdlc.encode_frames([(1, 0, b'abc'), (2, 0, b'd\x7de')])
+        codec = hdlc.Codec()
+        self.assertEqual(codec.feed(data[:6]), [])
+        self.assertEqual(codec.feed(data[6:]), [b'\x01\x00abc',
+                                                b'\x02\x00d\x7de'])
+        self.assertEqual(codec.feed(b'\x7e\x7e'), [])
+        self.assertEqual(codec.statistics['bytes'], len(data) + 2)
+        self.assertEqual(codec.statistics['empty'], 2)
+
+    def test_feed_timestamps(self):
+        codec = hdlc.Codec(timestamps=True)
+        before = time.time()
+        [(received, frame)] = codec.feed(_encode(b'abc'), timestamps=True)
+        self.assertEqual(frame, b'abc')
+        self.assertTrue(before <= received <= time.time())
+
+    def test_encode(self):
+        codec = hdlc.Codec(accm=hdlc.ACCM_ALL)
+        self.assertEqual(codec.encode(1, 0, b'a\x11'),
+                         hdlc.encode_frame(1, 0, b'a\x11', hdlc.ACCM_ALL))
+        frames = [(1, 0, b'abc'), (2, 5, b'\x00')]
+        data = codec.encode_many(frames)
+        self.assertEqual(data, hdlc.encode_frames(frames, hdlc.ACCM_ALL))
+        self.assertEqual(hdlc.Codec().feed(data),
+                         [b'\x01\x00abc', b'\x02\x05\x00'])
+
+
+class TestSendMany(unittest.TestCase):
+    def test_shared_flags(self):
+        frames = [(1, 0, b'abc'), (2, 0, b'd\x7ee'), (1, 0, b'')]
+        data = hdlc.encode_frames(frames)
+        self.assertEqual(data.count(b'\x7e'), 4)
+        self.assertEqual(data, hdlc.encode_frame(1, 0, b'abc') +
+                         hdlc.encode_frame(2, 0, b'd\x7ee')[1:] +
+                         hdlc.encode_frame(1, 0, b'')[1:])
+
+    def test_send_many(self):
+        device = FakeWriteDevice()
+        hdlc.Receiver(device).send_many([(1, 0, b'abc'), (2, 5, b'de')])
+        self.assertEqual(len(device.writes), 1)
+        r = hdlc.Receiver(FakeBulkDevice(device.writes[0]), read_size=4096)
+        self.assertEqual(r.get_many(), [b'\x01\x00abc', b'\x02\x05de'])
+        self.assertEqual(r.statistics['empty'], 0)
+
+
 class TestFcs32(unittest.TestCase):
     def test_crc_data(self):
-        data = "Hello World"
+        data = b"Hello World"
         fcs = hdlc.compute_fcs32(data)
         self.assertEqual(0xB5E84EA9, fcs)
 
         # Note: the complement of the FCS is appended to the data, LSB first.
         # ~0xB5E84EA9 = 0x4A17B156
-        data = "Hello World\x56\xB1\x17\x4A"
+        data = b"Hello World\x56\xB1\x17\x4A"
         fcs = hdlc.compute_fcs32(data)
         self.assertEqual(hdlc.FCS32_GOOD_FINAL, fcs)
+
+    def test_backends_match_table(self):
+        rand = random.Random(32)
+        for name, compute in hdlc.fcs32_backends.items():
+            for length in range(40):
+                data = bytes(rand.randrange(256) for i in range(length))
+                seed = rand.choice([None, 0, 0xFFFFFFFF,
+                                    rand.randrange(1 << 32)])
+                self.assertEqual(compute(data, seed),
+                                 hdlc.compute_fcs32_table(data, seed), name)
+
+    def test_backends_incremental(self):
+        data = b"Hello World\x56\xB1\x17\x4A"
+        for name, compute in hdlc.fcs32_backends.items():
+            fcs = compute(data[:5])
+            fcs = compute(data[5:], fcs)
+            self.assertEqual(hdlc.FCS32_GOOD_FINAL, fcs, name)
+
+    def test_set_backend(self):
+        default = hdlc.compute_fcs32
+        try:
+            hdlc.set_fcs32_backend('table')
+            self.assertTrue(hdlc.compute_fcs32 is hdlc.compute_fcs32_table)
+            r = _make_receiver(b'\x7eabc\x7d\x5edef\x3f\xd4\x66\x53\x7e')
+            self.assertEqual(r.get(), b'abc\x7edef')
+        finally:
+            hdlc.compute_fcs32 = default
+
+
+class TestFcs(unittest.TestCase):
+    def test_check_values(self):
+        # The standard check values, over b'123456789'.
+        data = b'123456789'
+        for fcs, check in ((hdlc.FCS16, 0x906E), (hdlc.FCS32, 0xCBF43926),
+                           (hdlc.CRC32C, 0xE3069283)):
+            self.assertEqual(fcs.compute(data) ^ fcs.mask, check, fcs)
+            self.assertEqual(fcs.compute(fcs.append(data)), fcs.good_final,
+                             fcs)
+        self.assertEqual(hdlc.FCS16.good_final, 0xF0B8)
+        self.assertEqual(hdlc.FCS32.good_final, hdlc.FCS32_GOOD_FINAL)
+
+    def test_implementations_match(self):
+        rand = random.Random(33)
+        generic16 = hdlc.FCS('fcs16', 2, hdlc.FCS16_POLYNOMIAL)
+        generic32c = hdlc.FCS('crc32c', 4, hdlc.CRC32C_POLYNOMIAL)
+        for length in range(40):
+            data = bytes(rand.randrange(256) for i in range(length))
+            seed = rand.choice([None, 0, rand.randrange(1 << 16)])
+            expected = generic16.compute(data, seed)
+            self.assertEqual(hdlc.compute_fcs16_table(data, seed), expected)
+            self.assertEqual(hdlc.compute_fcs16_hqx(data, seed), expected)
+            self.assertEqual(hdlc.FCS16.compute(data, seed), expected)
+            expected = generic32c.compute(data, seed)
+            self.assertEqual(hdlc.compute_crc32c_slicing8(data, seed),
+                             expected)
+            self.assertEqual(hdlc.CRC32C.compute(data, seed), expected)
+
+    def test_crc_table(self):
+        self.assertTrue(hdlc.crc_table(0xA001) is hdlc.crc_table(0xA001))
+        table = hdlc._crc_tables.pop(hdlc.FCS32_POLYNOMIAL)
+        try:
+            self.assertEqual(hdlc.crc_table(hdlc.FCS32_POLYNOMIAL), table)
+        finally:
+            hdlc._crc_tables[hdlc.FCS32_POLYNOMIAL] = table
+
+    def _round_trip(self, fcs, verify_fcs=True):
+        frames = [(1, 0, b'abc'), (2, 5, b'd\x7ee'), (3, 0, b'')]
+        codec = hdlc.Codec(fcs=fcs, verify_fcs=verify_fcs)
+        data = codec.encode_many(frames)
+        self.assertEqual(data, b''.join(codec.encode(*frame)[:-1]
+                                        for frame in frames) + b'\x7e')
+        self.assertEqual(codec.feed(data),
+                         [bytes((channel, control)) + payload
+                          for channel, control, payload in frames])
+        return codec
+
+    def test_codecs(self):
+        custom = hdlc.FCS('crc16', 2, 0xA001)
+        for core in sorted(hdlc.framing_cores):
+            hdlc.set_framing_core(core)
+            try:
+                for fcs in sorted(hdlc.fcs_types) + [custom]:
+                    codec = self._round_trip(fcs)
+                    frame = codec.encode(1, 0, b'abcd').replace(b'abcd',
+                                                                b'abce')
+                    self.assertEqual(codec.feed(frame),
+                                     [b'\x01\x00abce' if fcs == 'none'
+                                      else None])
+                    self.assertEqual(codec.statistics['fcs'],
+                                     0 if fcs == 'none' else 1)
+            finally:
+                hdlc.set_framing_core('native' if hdlc._hdlc else 'python')
+
+    def test_fcs16_frame(self):
+        # RFC 1662 FCS-16 on the wire: the complement, LSB first.
+        frame = hdlc.Codec(fcs='fcs16').encode(1, 2, b'')
+        fcs = hdlc.compute_fcs16_table(b'\x01\x02') ^ 0xFFFF
+        self.assertEqual(frame, b'\x7e\x01\x02' +
+                         struct.pack('<H', fcs) + b'\x7e')
+
+    def test_no_verify(self):
+        for core in sorted(hdlc.framing_cores):
+            hdlc.set_framing_core(core)
+            try:
+                codec = hdlc.Codec(fcs='fcs16', verify_fcs=False)
+                self.assertEqual(codec.feed(b'\x7eabcXY\x7ea\x7e'),
+                                 [b'abc', None])
+                self.assertEqual(codec.statistics['fcs'], 0)
+                self.assertEqual(codec.statistics['invalid'], 1)
+            finally:
+                hdlc.set_framing_core('native' if hdlc._hdlc else 'python')
+
+    def test_mru(self):
+        codec = hdlc.Codec(fcs='fcs16', mru=4)
+        self.assertEqual(codec.feed(codec.encode(1, 0, b'ab') +
+                                    codec.encode(1, 0, b'abc')),
+                         [b'\x01\x00ab', None])
+        self.assertEqual(codec.statistics['oversize'], 1)
+
+
+class TestStatistics(unittest.TestCase):
+    def test_repeated_empty(self):
+        r = _make_receiver(b'\x7e\x7e\x7e\x7e')
+        self.assertEqual(r.get(), None)
+        self.assertEqual(r.statistics['empty'], 3)
+
+    def test_channel_counts(self):
+        r = hdlc.Receiver(None)
+        r.process_data(hdlc.encode_frames([(1, 0, b'abc'), (1, 0, b'de'),
+                                           (7, 0, b'fghijk')]))
+        stats = r.statistics
+        self.assertEqual(stats.frames, 3)
+        self.assertEqual(stats.channel_frames[1], 2)
+        self.assertEqual(stats.channel_bytes[1], 9)
+        self.assertEqual(stats.channel_frames[7], 1)
+        self.assertEqual(stats.channel_bytes[7], 8)
+        self.assertEqual(stats.queue_high_water, 3)
+        # 4 and 5 byte frames share a bucket, 8 bytes is in the next.
+        self.assertEqual(stats.frame_sizes.counts[3], 2)
+        self.assertEqual(stats.frame_sizes.counts[4], 1)
+
+    def test_frame_size_clamp(self):
+        r = hdlc.Receiver(None)
+        r.statistics.frame_sizes = hdlc.Histogram(buckets=4)
+        r.process_data(hdlc.encode_frames([(1, 0, b'a'), (1, 0, b'x' * 100)]))
+        self.assertEqual(r.statistics.frames, 2)
+        self.assertEqual(r.statistics.frame_sizes.counts, [0, 0, 1, 1])
+
+    def test_timing(self):
+        r = hdlc.Receiver(FakeBulkDevice(hdlc.encode_frames(
+            [(1, 0, b'abc'), (2, 0, b'de')])), read_size=64, timing=True)
+        self.assertEqual(len(r.get_many()), 2)
+        stats = r.statistics
+        self.assertEqual(sum(stats.decode_time.counts), 1)
+        self.assertEqual(sum(stats.queue_wait.counts), 2)
+        self.assertEqual(len(r.completed_times), 0)
+
+    def test_no_timing(self):
+        r = hdlc.Receiver(None)
+        r.process_data(hdlc.encode_frame(1, 0, b'abc'))
+        self.assertEqual(sum(r.statistics.decode_time.counts), 0)
+        self.assertEqual(len(r.completed_times), 0)
+
+    def test_profiler(self):
+        samples = []
+        r = hdlc.Receiver(None)
+        r.statistics.set_profiler(lambda stats: samples.append(stats.frames),
+                                  interval=2)
+        for i in range(5):
+            r.process_data(hdlc.encode_frame(1, 0, b'abc'))
+        self.assertEqual(samples, [2, 4])
+
+    def test_snapshot_delta(self):
+        r = hdlc.Receiver(None)
+        r.process_data(hdlc.encode_frame(1, 0, b'abc'))
+        before = r.statistics.snapshot()
+        r.process_data(b'x' + hdlc.encode_frame(2, 0, b'de'))
+        delta = r.statistics.delta(before)
+        self.assertEqual(delta['counters']['frames'], 1)
+        self.assertEqual(delta['counters']['invalid'], 1)
+        self.assertEqual(delta['channels'], {2: {'frames': 1, 'bytes': 4}})
+        self.assertEqual(sum(delta['frame_sizes']), 1)
+        self.assertTrue(delta['interval'] >= 0)
+
+    def test_merge(self):
+        data = hdlc.encode_frames([(1, 0, b'abc'), (2, 0, b'de')]) + b'x\x7e'
+        whole = hdlc.Receiver(None)
+        whole.process_data(data)
+        first, second = hdlc.Receiver(None), hdlc.Receiver(None)
+        split = data.index(b'\x7e', 1) + 1
+        first.process_data(data[:split])
+        second.state = hdlc.GET_FRAME
+        second.process_data(data[split:])
+        first.statistics.merge(second.statistics)
+        self.assertEqual(first.statistics, whole.statistics)
+        self.assertEqual(first.statistics.channel_bytes,
+                         whole.statistics.channel_bytes)
+        self.assertEqual(first.statistics.frame_sizes.counts,
+                         whole.statistics.frame_sizes.counts)
+
+
+def _vector_payloads(rand):
+    '''
+    Payloads for comparing the framing cores: edge cases, then random data
+    heavy in characters that get escaped.
+    '''
+    payloads = [b'', b'\x7e', b'\x7d', b'\x7d\x5e', b'\x7e\x7e\x7d\x7d',
+                b'\x00\x1f\x20\xff', bytes(range(256)), b'x' * 1000]
+    alphabet = b'\x7e\x7d\xff\x00\x11\x13\x1fab'
+    for i in range(100):
+        size = rand.randint(0, 64)
+        payloads.append(bytes(rand.choice(alphabet) for i in range(size)))
+    return payloads
+
+
+@unittest.skipIf(hdlc._hdlc is None, 'the _hdlc extension is not built')
+class TestFramingCores(unittest.TestCase):
+    '''
+    The C extension and the pure Python code must give identical output.
+    '''
+    accms = [hdlc.ACCM_NONE, hdlc.ACCM_ALL, 1 << 0x11 | 1 << 0x13]
+
+    def setUp(self):
+        self.python = hdlc.framing_cores['python']
+        self.native = hdlc.framing_cores['native']
+
+    def tearDown(self):
+        hdlc.set_framing_core('native')
+
+    def test_fcs32(self):
+        rand = random.Random(15)
+        for data in _vector_payloads(rand):
+            seed = rand.choice([None, 0, rand.randrange(1 << 32)])
+            self.assertEqual(hdlc.fcs32_backends['native'](data, seed),
+                             hdlc.compute_fcs32_table(data, seed))
+
+    def test_escape(self):
+        for data in _vector_payloads(random.Random(16)):
+            for accm in self.accms:
+                self.assertEqual(self.native['escape'](data, accm),
+                                 self.python['escape'](data, accm))
+
+    def test_encode_frame(self):
+        rand = random.Random(17)
+        for data in _vector_payloads(rand):
+            channel, control = rand.randrange(256), rand.randrange(256)
+            for accm in self.accms:
+                self.assertEqual(
+                    self.native['encode_frame'](channel, control, data, accm),
+                    self.python['encode_frame'](channel, control, data, accm))
+
+    def test_encode_frames(self):
+        rand = random.Random(18)
+        payloads = _vector_payloads(rand)
+        for accm in self.accms:
+            frames = [(rand.randrange(256), 0, data) for data in payloads]
+            self.assertEqual(self.native['encode_frames'](frames, accm),
+                             self.python['encode_frames'](frames, accm))
+        self.assertEqual(self.native['encode_frames']([]),
+                         self.python['encode_frames']([]))
+
+    def test_bad_arguments(self):
+        with self.assertRaises(ValueError):
+            self.native['encode_frame'](256, 0, b'')
+        with self.assertRaises(TypeError):
+            self.native['encode_frames']([(1, 0)])
+        with self.assertRaises(ValueError):
+            hdlc._hdlc.deframe(b'', 4, bytearray(), -1)
+        with self.assertRaises(ValueError):
+            hdlc._hdlc.deframe(b'', 1, bytearray(), -1, 'crc8')
+
+    def _deframe(self, core, data, rand, mru, fcs='fcs32', verify_fcs=True):
+        hdlc.set_framing_core(core)
+        r = hdlc.Receiver(None, mru=mru, fcs=fcs, verify_fcs=verify_fcs)
+        pos = 0
+        while pos < len(data):
+            size = rand.randint(1, 32)
+            r.process_data(data[pos:pos + size])
+            pos += size
+        return r
+
+    def test_deframe(self):
+        rand = random.Random(19)
+        for i in range(200):
+            data = _random_stream(rand, 300)
+            mru = rand.choice([None, 4, 16])
+            seed = rand.random()
+            python = self._deframe('python', data, random.Random(seed), mru)
+            native = self._deframe('native', data, random.Random(seed), mru)
+            self.assertEqual(list(native.completed_frames),
+                             list(python.completed_frames))
+            self.assertEqual(native.statistics, python.statistics)
+            self.assertEqual(native.statistics.channel_frames,
+                             python.statistics.channel_frames)
+            self.assertEqual(native.state, python.state)
+            self.assertEqual(repr(native.state), repr(python.state))
+            self.assertEqual(native.frame, python.frame)
+
+    def test_deframe_long_frame(self):
+        # A frame much longer than the reads is decoded in place, leaving
+        # the partial frame in Codec.frame between calls.
+        payload = bytes(range(256)) * 1024
+        data = hdlc.encode_frame(1, 0, payload) + hdlc.encode_frame(2, 0, b'x')
+        hdlc.set_framing_core('native')
+        codec = hdlc.Codec()
+        for pos in range(0, len(data), 61):
+            codec.process_data(data[pos:pos + 61])
+            if not codec.completed_frames:
+                self.assertTrue(payload.startswith(codec.frame[2:8]))
+        self.assertEqual(len(codec.completed_frames), 2)
+        self.assertTrue(codec.completed_frames[0] == b'\x01\x00' + payload)
+        self.assertEqual(codec.completed_frames[1], b'\x02\x00x')
+        self.assertEqual(codec.frame, bytearray())
+
+        frame = bytearray(b'\x01\x00abc')
+        state, results = hdlc._hdlc.deframe(b'def', 2, frame, -1)[:2]
+        self.assertEqual((state, results, frame), (2, [], b'\x01\x00abcdef'))
+
+    def test_deframe_fcs(self):
+        rand = random.Random(20)
+        for i in range(100):
+            fcs = rand.choice(sorted(hdlc.fcs_types))
+            verify_fcs = rand.random() < 0.8
+            codec = hdlc.Codec(fcs=fcs)
+            data = _random_stream(rand, 200) + codec.encode_many(
+                (1, 0, payload) for payload in _vector_payloads(rand)[:8])
+            mru = rand.choice([None, 4, 16])
+            seed = rand.random()
+            python = self._deframe('python', data, random.Random(seed), mru,
+                                   fcs, verify_fcs)
+            native = self._deframe('native', data, random.Random(seed), mru,
+                                   fcs, verify_fcs)
+            self.assertEqual(list(native.completed_frames),
+                             list(python.completed_frames))
+            self.assertEqual(native.statistics, python.statistics)
+            self.assertEqual(native.state, python.state)
+            self.assertEqual(native.frame, python.frame)
@@ -0,0 +1,219 @@
+import socket
+import time
+import unittest
+
+import hdlc
+from linkmanager import *
+
+
+class SocketDevice(object):
+    '''
+    A device for testing purposes: one end of a socket pair.
+    '''
+    def __init__(self, sock):
+        self.sock = sock
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read(self, count):
+        return self.sock.recv(count)
+
+    def write(self, data):
+        self.sock.sendall(data)
+
+
+class TestLinkManager(unittest.TestCase):
+    def setUp(self):
+        self.sockets = []
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+
+    def _pair(self):
+        a, b = socket.socketpair()
+        self.sockets.extend((a, b))
+        return SocketDevice(a), b
+
+    def _check_links(self, workers, count):
+        manager = LinkManager(workers=workers)
+        try:
+            links = []
+            for i in range(count):
+                device, peer = self._pair()
+                link = manager.add_link(device)
+                links.append((link, link.open(i % 3), peer))
+
+            for i, (link, channel, peer) in enumerate(links):
+                payload = ('link %d' % i).encode()
+                peer.sendall(hdlc.encode_frame(i % 3, 0, payload[:3]) +
+                             hdlc.encode_frame(i % 3, 0, payload[3:]))
+            for i, (link, channel, peer) in enumerate(links):
+                payload = ('link %d' % i).encode()
+                self.assertEqual(channel.read(len(payload), timeout=5),
+                                 payload)
+        finally:
+            manager.close()
+
+    def test_links(self):
+        '''
+        Verify that frames on many links reach the right channels.
+        '''
+        self._check_links(workers=0, count=20)
+
+    def test_workers(self):
+        '''
+        Verify that links served by a pool of workers keep their frames in
+        order.
+        '''
+        self._check_links(workers=4, count=20)
+
+    def test_write(self):
+        '''
+        Verify that channel writes go out on the link's device.
+        '''
+        manager = LinkManager()
+        try:
+            device, peer = self._pair()
+            channel = manager.add_link(device).open(5)
+            channel.write(b'foo')
+            frame = hdlc.encode_frame(5, 0, b'foo')
+            self.assertEqual(peer.recv(len(frame)), frame)
+        finally:
+            manager.close()
+
+    def test_closedDevice(self):
+        '''
+        Verify that a link is dropped once its device is closed at the other
+        end.
+        '''
+        manager = LinkManager()
+        try:
+            device, peer = self._pair()
+            link = manager.add_link(device)
+            peer.close()
+            deadline = time.time() + 5
+            while not link.closed and time.time() < deadline:
+                time.sleep(0.001)
+            self.assertTrue(link.closed)
+            self.assertEqual(manager.links, [])
+        finally:
+            manager.close()
+
+    def _check_errors(self, workers):
+        manager = LinkManager(workers=workers)
+        try:
+            links = []
+            for i in range(3):
+                device, peer = self._pair()
+                link = manager.add_link(device)
+                links.append((link, link.open(0), peer))
+            spurious, failing, bad = [link for link, channel, peer in links]
+
+            read_ready = spurious._read_ready
+            wakeups = []
+            def spurious_read():
+                if not wakeups:
+                    wakeups.append(True)
+                    raise BlockingIOError()
+                return read_ready()
+            def failing_read():
+                raise OSError('device gone')
+            def bad_deliver(frames, times=None):
+                raise ValueError('bad data')
+            spurious._read_ready = spurious_read
+            failing._read_ready = failing_read
+            bad.deliver = bad_deliver
+
+            for link, channel, peer in links:
+                peer.sendall(hdlc.encode_frame(0, 0, b'data'))
+            deadline = time.time() + 5
+            while (not (failing.closed and bad.closed) and
+                   time.time() < deadline):
+                time.sleep(0.001)
+            self.assertTrue(failing.closed)
+            self.assertIsInstance(failing.error, OSError)
+            self.assertTrue(bad.closed)
+            self.assertIsInstance(bad.error, ValueError)
+
+            link, channel, peer = links[0]
+            self.assertEqual(channel.read(4, timeout=5), b'data')
+            peer.sendall(hdlc.encode_frame(0, 0, b'more'))
+            self.assertEqual(channel.read(4, timeout=5), b'more')
+            self.assertEqual(wakeups, [True])
+            self.assertIsNone(spurious.error)
+            self.assertEqual(manager.links, [spurious])
+            self.assertTrue(manager._thread.is_alive())
+        finally:
+            manager.close()
+
+    def test_linkErrors(self):
+        '''
+        Verify that a spurious wakeup is not taken for EOF, and that a link
+        whose read or delivery fails is dropped on its own.
+        '''
+        self._check_errors(0)
+
+    def test_workerLinkErrors(self):
+        '''
+        Verify that link errors in a worker drop only that link.
+        '''
+        self._check_errors(2)
+
+    def test_closeLink(self):
+        '''
+        Verify that closing a link stops the manager reading its device.
+        '''
+        manager = LinkManager()
+        try:
+            device, peer = self._pair()
+            link = manager.add_link(device)
+            link.close()
+            deadline = time.time() + 5
+            while not link.closed and time.time() < deadline:
+                time.sleep(0.001)
+            self.assertTrue(link.closed)
+            self.assertEqual(manager.links, [])
+        finally:
+            manager.close()
+
+    def test_startLink(self):
+        '''
+        Verify that starting a link again, or using it in a with block,
+        registers its device only once.
+        '''
+        manager = LinkManager()
+        try:
+            device, peer = self._pair()
+            with manager.add_link(device, start=False) as link:
+                channel = link.open(1)
+                link.start()
+                link.start()
+                manager._register(link)
+                peer.sendall(hdlc.encode_frame(1, 0, b'data'))
+                self.assertEqual(channel.read(4, timeout=5), b'data')
+            self.assertTrue(manager._thread.is_alive())
+
+            device, peer = self._pair()
+            with manager.add_link(device) as link:
+                channel = link.open(2)
+                peer.sendall(hdlc.encode_frame(2, 0, b'more'))
+                self.assertEqual(channel.read(4, timeout=5), b'more')
+            self.assertTrue(manager._thread.is_alive())
+        finally:
+            manager.close()
+        self.assertFalse(manager._thread.is_alive())
+
+    def test_close(self):
+        '''
+        Verify that closing the manager stops its thread and unregisters
+        every link.
+        '''
+        manager = LinkManager(workers=2)
+        device, peer = self._pair()
+        link = manager.add_link(device)
+        manager.close()
+        self.assertFalse(manager._thread.is_alive())
+        self.assertTrue(link.closed)
+        self.assertEqual(manager.links, [])
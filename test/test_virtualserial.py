@@ -1,4 +1,8 @@
+import os
+import subprocess
+import sys
 import unittest
+import threading
 import time
 
 from virtualserial import *
@@ -6,21 +10,40 @@ from virtualserial import *
 class FakeDevice(object):
     '''
     A fake device for testing purposes. Reroutes all input from the write
-    function to output from the read function.
+    function to output from the read function.  Like a serial port with a
+    short timeout, a read with nothing to return waits a little first.
     '''
     def __init__(self):
-        self.data = []
+        self.data = bytearray()
+        self.lock = threading.Lock()
 
     def read(self, count):
         assert count == 1
-        if len(self.data) == 0:
+        with self.lock:
+            character = bytes(self.data[:1])
+            del self.data[:1]
+
+        if not character:
+            time.sleep(0.001)
             return None
+        return character
+
+    def write(self, data):
+        with self.lock:
+            self.data += data
 
-        return self.data.pop(0)
+
+class CountingDevice(FakeDevice):
+    '''
+    A fake device that also counts its writes.
+    '''
+    def __init__(self):
+        FakeDevice.__init__(self)
+        self.writes = 0
 
     def write(self, data):
-        for character in data:
-            self.data.append(character)
+        self.writes += 1
+        FakeDevice.write(self, data)
 
 
 class TestVirtualSerial(unittest.TestCase):
@@ -30,7 +53,7 @@ class TestVirtualSerial(unittest.TestCase):
         '''
         vs = VirtualSerial(FakeDevice())
         vs.add_channel(num=0)
-        self.assertEqual(vs.channel_read(0, 1, timeout=1), '')
+        self.assertEqual(vs.channel_read(0, 1, timeout=1), b'')
 
     def test_singleEntryQueueRead(self):
         '''
@@ -38,8 +61,8 @@ class TestVirtualSerial(unittest.TestCase):
         '''
         vs = VirtualSerial(FakeDevice())
         vs.add_channel(num=0)
-        vs.channel_write(0, 'foo')
-        self.assertEqual(vs.channel_read(0, 3), 'foo')
+        vs.channel_write(0, b'foo')
+        self.assertEqual(vs.channel_read(0, 3), b'foo')
 
     def test_multiEntryQueueRead(self):
         '''
@@ -47,9 +70,9 @@ class TestVirtualSerial(unittest.TestCase):
         '''
         vs = VirtualSerial(FakeDevice())
         vs.add_channel(num=0)
-        vs.channel_write(0, 'foo')
-        vs.channel_write(0, 'bar')
-        self.assertEqual(vs.channel_read(0, 6), 'foobar')
+        vs.channel_write(0, b'foo')
+        vs.channel_write(0, b'bar')
+        self.assertEqual(vs.channel_read(0, 6), b'foobar')
 
     def test_multiChannelQueueRead(self):
         '''
@@ -58,10 +81,10 @@ class TestVirtualSerial(unittest.TestCase):
         vs = VirtualSerial(FakeDevice())
         vs.add_channel(num=0)
         vs.add_channel(num=1)
-        vs.channel_write(0, 'foo')
-        vs.channel_write(1, 'bar')
-        self.assertEqual(vs.channel_read(0, 3), 'foo')
-        self.assertEqual(vs.channel_read(1, 3), 'bar')
+        vs.channel_write(0, b'foo')
+        vs.channel_write(1, b'bar')
+        self.assertEqual(vs.channel_read(0, 3), b'foo')
+        self.assertEqual(vs.channel_read(1, 3), b'bar')
 
     def test_addChannel(self):
         '''
@@ -80,22 +103,295 @@ class TestVirtualSerial(unittest.TestCase):
         '''
         vs = VirtualSerial(FakeDevice())
         ch = vs.open(num=0, maxsize=5)
-        ch.write('foo')
-        ch.write('bar')
+        ch.write(b'foo')
+        ch.write(b'bar')
         while not ch.isFull():
             pass
         assert ch.isFull()
         # Verify that reading the full length of the queue included parts of the
         # second write
-        self.assertEqual(ch.read(5), 'fooba')
+        self.assertEqual(ch.read(5), b'fooba')
         # Verify that emptying out the queue allowed the last item to be placed
-        self.assertEqual(ch.read(1), 'r')
+        self.assertEqual(ch.read(1), b'r')
         # Verify that the queue is now empty
         while not ch.isEmpty():
             pass
         assert ch.isEmpty()
 
 
+class TestTransmitter(unittest.TestCase):
+    def test_coalescedWrites(self):
+        '''
+        Verify that writes to several channels go out in one device write and
+        are read back correctly.
+        '''
+        device = CountingDevice()
+        vs = VirtualSerial(device, coalesce=True, flush_latency=10)
+        ch0 = vs.open(num=0)
+        ch1 = vs.open(num=1)
+        ch0.write(b'foo')
+        ch1.write(b'bar')
+        ch0.write(b'baz')
+        vs.flush()
+        self.assertEqual(device.writes, 1)
+        self.assertEqual(ch0.read(6), b'foobaz')
+        self.assertEqual(ch1.read(3), b'bar')
+
+    def test_flushLatency(self):
+        '''
+        Verify that queued writes are sent once the flush latency passes.
+        '''
+        device = CountingDevice()
+        vs = VirtualSerial(device, coalesce=True, flush_latency=0.01)
+        ch = vs.open(num=0)
+        ch.write(b'foo')
+        self.assertEqual(ch.read(3, timeout=1), b'foo')
+
+    def test_flushSize(self):
+        '''
+        Verify that queued writes are sent once the flush size is reached.
+        '''
+        device = CountingDevice()
+        vs = VirtualSerial(device, coalesce=True, flush_latency=10,
+                           flush_size=6)
+        ch = vs.open(num=0)
+        ch.write(b'foo')
+        ch.write(b'bar')
+        self.assertEqual(ch.read(6, timeout=1), b'foobar')
+        self.assertEqual(device.writes, 1)
+
+    def test_writeError(self):
+        '''
+        Verify that a failed device write is raised by flush() and by later
+        writes instead of stopping the writer thread silently.
+        '''
+        class BrokenDevice(FakeDevice):
+            def write(self, data):
+                raise OSError('device gone')
+
+        vs = VirtualSerial(BrokenDevice(), coalesce=True, flush_latency=10)
+        ch = vs.open(num=0)
+        ch.write(b'foo')
+        self.assertRaises(OSError, vs.flush)
+        self.assertRaises(OSError, ch.write, b'bar')
+        self.assertRaises(OSError, vs.flush)
+        vs.close()
+
+    def test_flushNotStarted(self):
+        '''
+        Verify that flush() does not wait for a writer thread that has not
+        been started.
+        '''
+        vs = VirtualSerial(FakeDevice(), coalesce=True, start=False)
+        ch = vs.open(num=0)
+        vs.flush()
+        ch.write(b'foo')
+        self.assertRaises(RuntimeError, vs.flush)
+        with vs:
+            vs.flush()
+            self.assertEqual(ch.read(3, timeout=1), b'foo')
+
+
+class TestScheduling(unittest.TestCase):
+    def _transmitter(self, flush_size=1 << 20):
+        # No writer thread: batches are taken with _next_batch().
+        return Transmitter(None, flush_latency=0, flush_size=flush_size)
+
+    def test_priority(self):
+        '''
+        Verify that higher priority channels are sent first.
+        '''
+        tx = self._transmitter()
+        tx.set_channel(2, priority=5)
+        for i in range(3):
+            tx.send(1, 0, b'bulk')
+        tx.send(2, 0, b'ctl')
+        tx.send(3, 0, b'low')
+        tx.set_channel(3, priority=-1)
+        self.assertEqual([frame[0] for frame in tx._next_batch()],
+                         [2, 1, 1, 1, 3])
+
+    def test_weights(self):
+        '''
+        Verify that channels of the same priority share the link by weight.
+        '''
+        tx = self._transmitter()
+        tx.set_channel(1, weight=1)
+        tx.set_channel(2, weight=3)
+        for i in range(8):
+            tx.send(1, 0, b'x' * 10)
+            tx.send(2, 0, b'y' * 10)
+        order = [frame[0] for frame in tx._next_batch()]
+        self.assertEqual(order[:8].count(2), 6)
+        self.assertEqual(len(order), 16)
+        self.assertRaises(ValueError, tx.set_channel, 3, weight=0)
+
+    def test_batchSize(self):
+        '''
+        Verify that a batch stops at flush_size bytes and that frames queued
+        meanwhile at a higher priority go ahead of the rest.
+        '''
+        tx = self._transmitter(flush_size=25)
+        tx.set_channel(2, priority=1)
+        for i in range(6):
+            tx.send(1, 0, b'x' * 10)
+        self.assertEqual(len(tx._next_batch()), 3)
+        tx.send(2, 0, b'ctl')
+        self.assertEqual([frame[0] for frame in tx._next_batch()],
+                         [2, 1, 1, 1])
+        self.assertEqual(tx.statistics[1],
+                         {'frames': 6, 'bytes': 60, 'high_water': 6})
+        self.assertEqual(tx.first_queued, None)
+
+    def test_fragments(self):
+        '''
+        Verify that long writes are fragmented and put back together.
+        '''
+        vs = VirtualSerial(FakeDevice(), coalesce=True, max_payload=4)
+        datagram = vs.open(1, datagram=True)
+        stream = vs.open(2)
+        datagram.send_frame(b'0123456789', control=3)
+        datagram.send_frame(b'abcd')
+        stream.write(b'0123456789')
+        self.assertEqual(datagram.recv_frame(timeout=5), (3, b'0123456789'))
+        self.assertEqual(datagram.recv_frame(timeout=5), (0, b'abcd'))
+        self.assertEqual(stream.read(10, timeout=5), b'0123456789')
+        self.assertEqual(vs.snapshot()['transmit'][1]['frames'], 4)
+        self.assertRaises(ValueError, datagram.send_frame, b'x',
+                          control=CONTROL_MORE)
+        self.assertRaises(ValueError, datagram.send_frame, b'x',
+                          control=CONTROL_START)
+
+    def test_fragmentsDropped(self):
+        '''
+        Verify that a write interrupted by a bad frame, or too long, is
+        dropped rather than joined onto the next one, and that the next write
+        is received whole.
+        '''
+        vs = VirtualSerial(FakeDevice(), max_payload=4, start=False)
+        datagram = vs.open(1, datagram=True)
+        vs.deliver([b'\x01\xc0abc', None, b'\x01\x80def', b'\x01\x00gh',
+                     b'\x01\x45ok'])
+        self.assertEqual(datagram.recv_frame(timeout=1), (5, b'ok'))
+        vs.max_message = 5
+        vs.deliver([b'\x01\xc0abc', b'\x01\x80def', b'\x01\x80ghi',
+                     b'\x01\x00j', b'\x01\xc0kl', b'\x01\x00mn'])
+        self.assertEqual(datagram.recv_frame(timeout=1), (0, b'klmn'))
+        self.assertEqual(datagram.recv_frame(timeout=0.01), None)
+        self.assertEqual(
+            vs.snapshot()['channel_buffers'][1]['partial_dropped'], 2)
+        self.assertEqual(vs.fragments, {})
+
+        # The bad frame was the last fragment: the next writes start afresh.
+        vs.deliver([b'\x01\xc0aa', b'\x01\x80bb', None, b'\x01\xc0dd',
+                     b'\x01\x00ee', b'\x01\x40x'])
+        vs.deliver([b'\x01\xc0aa', None, b'\x01\x40y'])
+        # A new write cuts short the one in progress; fragments without a
+        # start are dropped.
+        vs.deliver([b'\x01\xc0ab', b'\x01\xc0cd', b'\x01\x00ef',
+                     b'\x01\x80gh', b'\x01\x00ij', b'\x01\x40z'])
+        self.assertEqual([datagram.recv_frame(timeout=1) for i in range(5)],
+                         [(0, b'ddee'), (0, b'x'), (0, b'y'), (0, b'cdef'),
+                          (0, b'z')])
+        self.assertEqual(datagram.recv_frame(timeout=0.01), None)
+        self.assertEqual(
+            vs.snapshot()['channel_buffers'][1]['partial_dropped'], 6)
+        self.assertEqual(vs.fragments, {})
+
+    def test_receivePriority(self):
+        '''
+        Verify that received data reaches higher priority channels before a
+        full blocking channel stalls delivery.
+        '''
+        vs = VirtualSerial(FakeDevice())
+        bulk = vs.open(1, maxsize=1)
+        control = vs.open(2, priority=1)
+        t = threading.Thread(target=vs.deliver,
+                             args=([b'\x01\x00ab', b'\x02\x00ctl'],))
+        t.daemon = True
+        t.start()
+        self.assertEqual(control.read(3, timeout=5), b'ctl')
+        self.assertEqual(bulk.read(2, timeout=5), b'ab')
+        t.join()
+        self.assertEqual(vs.snapshot()['channel_buffers'][2]['priority'], 1)
+
+
+class TestLifecycle(unittest.TestCase):
+    def test_startClose(self):
+        '''
+        Verify that the threads only run between start() and close(), and
+        that close() sends what is queued and joins them.
+        '''
+        vs = VirtualSerial(FakeDevice(), coalesce=True, flush_latency=10,
+                           start=False)
+        self.assertEqual(vs._threads, [])
+        ch = vs.open(1)
+        vs.start()
+        vs.start()
+        self.assertEqual(len(vs._threads), 2)
+        ch.write(b'foo')
+        vs.close(timeout=5)
+        for thread in vs._threads:
+            self.assertFalse(thread.is_alive())
+        self.assertEqual(vs.transmitter.unsent, 0)
+        self.assertEqual(vs.snapshot()['transmit'][1]['frames'], 1)
+
+    def test_contextManager(self):
+        '''
+        Verify that a VirtualSerial used as a context manager is started and
+        closed.
+        '''
+        with VirtualSerial(FakeDevice(), start=False) as vs:
+            ch = vs.open(1)
+            ch.write(b'foo')
+            self.assertEqual(ch.read(3, timeout=5), b'foo')
+        self.assertFalse(vs._threads[0].is_alive())
+
+    def test_closeFullChannel(self):
+        '''
+        Verify that close() does not wait for room in a full blocking
+        channel.
+        '''
+        for datagram in (False, True):
+            vs = VirtualSerial(FakeDevice())
+            ch = vs.open(0, maxsize=2, datagram=datagram)
+            for data in (b'ab', b'cd', b'ef'):
+                ch.send_frame(data)
+            deadline = time.time() + 5
+            while not ch.isFull():
+                self.assertLess(time.time(), deadline)
+                time.sleep(0.001)
+            vs.close(timeout=5)
+            self.assertFalse(vs._threads[0].is_alive())
+            if datagram:
+                self.assertEqual(ch.recv_frame(timeout=1), (0, b'ab'))
+            else:
+                self.assertEqual(ch.read(2, timeout=1), b'ab')
+
+    def test_fromPort(self):
+        '''
+        Verify that a port opened by URL works and is closed with the
+        VirtualSerial.
+        '''
+        vs = VirtualSerial.from_port('loop://', read_size=4096, start=False)
+        ch = vs.open(1)
+        with vs:
+            ch.write(b'foo')
+            self.assertEqual(ch.read(3, timeout=5), b'foo')
+        self.assertFalse(vs.hdlc.device.is_open)
+
+    def test_lazyImport(self):
+        '''
+        Verify that importing the module does not import pyserial.
+        '''
+        code = 'import sys, virtualserial; print("serial" in sys.modules)'
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         cwd=os.path.dirname(
+                                             os.path.dirname(
+                                                 os.path.abspath(__file__))))
+        self.assertEqual(output.strip(), b'False')
+
+
 class testChannel(unittest.TestCase):
     def test_initializeChannel(self):
         '''
@@ -114,8 +410,23 @@ class testChannel(unittest.TestCase):
         '''
         vs = VirtualSerial(FakeDevice())
         ch = Channel(vs, num=0)
-        ch.write('foo')
-        self.assertEqual(ch.read(3), 'foo')
+        ch.write(b'foo')
+        self.assertEqual(ch.read(3), b'foo')
+
+    def test_fcs16(self):
+        '''
+        Verify that channels work over a link with the FCS-16, and that the
+        frames carry it.
+        '''
+        device = FakeDevice()
+        vs = VirtualSerial(device, fcs='fcs16', start=False)
+        ch = vs.open(1)
+        ch.write(b'foo')
+        self.assertEqual(bytes(device.data),
+                         hdlc.Codec(fcs='fcs16').encode(1, 0, b'foo'))
+        vs.start()
+        self.assertEqual(ch.read(3, timeout=5), b'foo')
+        vs.close()
 
     def test_open(self):
         '''
@@ -124,10 +435,10 @@ class testChannel(unittest.TestCase):
         '''
         vs = VirtualSerial(FakeDevice())
         ch = vs.open(num=0, name='test')
-        ch.write('foo')
+        ch.write(b'foo')
         self.assertEqual(ch.num, 0)
         self.assertEqual(ch.name, 'test')
-        self.assertEqual(ch.read(3), 'foo')
+        self.assertEqual(ch.read(3), b'foo')
 
     def test_channelReadError(self):
         '''
@@ -139,3 +450,342 @@ class testChannel(unittest.TestCase):
             vs.channel_read(0, 1)
 
 
+
+
+class TestChannelBuffer(unittest.TestCase):
+    def test_putGet(self):
+        '''
+        Verify that data put into a buffer is read back in order, in pieces
+        of the requested size.
+        '''
+        buf = ChannelBuffer()
+        self.assertEqual(buf.put(b'foo'), 3)
+        self.assertEqual(buf.put(b'bar'), 3)
+        self.assertEqual(buf.qsize(), 6)
+        self.assertEqual(buf.get(4), b'foob')
+        self.assertEqual(buf.get(2), b'ar')
+        assert buf.empty()
+
+    def test_maxsize(self):
+        '''
+        Verify that a bounded buffer only takes as much data as fits.
+        '''
+        buf = ChannelBuffer(maxsize=5)
+        self.assertEqual(buf.put(b'foo'), 3)
+        self.assertEqual(buf.put(b'bar'), 2)
+        assert buf.full()
+        self.assertEqual(buf.put(b'r', block=False), 0)
+        self.assertEqual(buf.put(b'r', timeout=0.01), 0)
+        self.assertEqual(buf.get(1), b'f')
+        self.assertEqual(buf.put(b'r'), 1)
+        self.assertEqual(buf.get(5), b'oobar')
+
+    def test_getTimeout(self):
+        '''
+        Verify that a read that times out returns the data available.
+        '''
+        buf = ChannelBuffer()
+        buf.put(b'foo')
+        self.assertEqual(buf.get(5, timeout=0.01), b'foo')
+        self.assertEqual(buf.get(5, block=False), b'')
+
+    def test_getDeadline(self):
+        '''
+        Verify that a read gives up after the timeout in all, even while data
+        keeps trickling in.
+        '''
+        buf = ChannelBuffer()
+        stop = threading.Event()
+
+        def trickle():
+            while not stop.wait(0.005):
+                buf.put(b'x')
+
+        t = threading.Thread(target=trickle)
+        t.start()
+        try:
+            start = time.time()
+            data = buf.get(1000, timeout=0.05)
+            elapsed = time.time() - start
+        finally:
+            stop.set()
+            t.join()
+        self.assertTrue(0 < len(data) < 1000)
+        self.assertTrue(elapsed < 0.5)
+
+    def test_getMinimum(self):
+        '''
+        Verify that a read returns once the minimum is in, with whatever else
+        is buffered.
+        '''
+        buf = ChannelBuffer()
+        buf.put(b'foo')
+        self.assertEqual(buf.get(10, minimum=2), b'foo')
+        t = threading.Thread(target=lambda: (time.sleep(0.01),
+                                             buf.put(b'barbaz')))
+        t.start()
+        self.assertEqual(buf.get(10, minimum=1, timeout=5), b'barbaz')
+        t.join()
+        self.assertEqual(buf.get(10, minimum=0), b'')
+
+    def test_timestamps(self):
+        '''
+        Verify that reads return the timestamp of their first byte.
+        '''
+        buf = ChannelBuffer()
+        buf.push(b'foo', 1.0)
+        buf.push(b'bar', 2.0)
+        self.assertEqual(buf.get_timestamped(2), (b'fo', 1.0))
+        self.assertEqual(buf.get_timestamped(2), (b'ob', 1.0))
+        self.assertEqual(buf.get_timestamped(2), (b'ar', 2.0))
+        buf.push(b'baz')
+        self.assertEqual(buf.get_timestamped(3), (b'baz', 2.0))
+        self.assertEqual(buf.get_timestamped(3, block=False), (b'', None))
+
+    def test_timestampsDropped(self):
+        '''
+        Verify that timestamps follow the data through the overflow policies.
+        '''
+        buf = ChannelBuffer(maxsize=4, overflow=OVERFLOW_DROP_OLDEST)
+        buf.push(b'foo', 1.0)
+        buf.push(b'bar', 2.0)
+        buf.push(b'b', 3.0)
+        self.assertEqual(buf.get_timestamped(2), (b'ba', 2.0))
+        self.assertEqual(buf.get_timestamped(2), (b'rb', 2.0))
+        self.assertEqual(len(buf.marks), 1)
+
+        buf = ChannelBuffer(maxsize=3, overflow=OVERFLOW_DROP_NEWEST)
+        buf.push(b'foo', 1.0)
+        buf.push(b'bar', 2.0)
+        buf.get(3)
+        buf.push(b'baz', 3.0)
+        self.assertEqual(buf.get_timestamped(3), (b'baz', 3.0))
+
+        buf = ChannelBuffer(maxsize=3, overflow=OVERFLOW_SPILL, spill_size=3)
+        buf.push(b'foo', 1.0)
+        buf.push(b'bar', 2.0)
+        self.assertEqual(buf.get_timestamped(2), (b'fo', 1.0))
+        self.assertEqual(buf.get_timestamped(4), (b'obar', 1.0))
+        buf.push(b'baz', 3.0)
+        self.assertEqual(buf.get_timestamped(3), (b'baz', 3.0))
+
+    def test_compaction(self):
+        '''
+        Verify that data survives reclaiming the space in front of it.
+        '''
+        buf = ChannelBuffer()
+        data = bytes(i % 256 for i in range(3 * buf.compact_size))
+        buf.put(data)
+        pos = 0
+        while pos < len(data):
+            self.assertEqual(buf.get(1024), data[pos:pos + 1024])
+            pos += 1024
+        assert buf.empty()
+
+    def test_blockPolicy(self):
+        '''
+        Verify that pushing to a full blocking buffer waits for the reader.
+        '''
+        buf = ChannelBuffer(maxsize=3)
+        buf.push(b'foo')
+        t = threading.Thread(target=buf.push, args=(b'bar',))
+        t.start()
+        while not buf.statistics['blocked']:
+            time.sleep(0.001)
+        self.assertEqual(buf.get(6), b'foobar')
+        t.join()
+
+    def test_dropOldestPolicy(self):
+        '''
+        Verify that the oldest data is dropped to make room for new data.
+        '''
+        buf = ChannelBuffer(maxsize=5, overflow=OVERFLOW_DROP_OLDEST)
+        buf.push(b'foo')
+        buf.push(b'bar')
+        self.assertEqual(buf.get(5), b'oobar')
+        buf.push(b'abcdefg')
+        self.assertEqual(buf.get(5), b'cdefg')
+        self.assertEqual(buf.statistics['dropped_oldest'], 3)
+
+    def test_dropNewestPolicy(self):
+        '''
+        Verify that data that does not fit is dropped.
+        '''
+        buf = ChannelBuffer(maxsize=5, overflow=OVERFLOW_DROP_NEWEST)
+        buf.push(b'foo')
+        buf.push(b'bar')
+        self.assertEqual(buf.get(5), b'fooba')
+        self.assertEqual(buf.statistics['dropped_newest'], 1)
+
+    def test_spillPolicy(self):
+        '''
+        Verify that data that does not fit is kept in the spill buffer, up to
+        its size, and delivered in order.
+        '''
+        buf = ChannelBuffer(maxsize=3, overflow=OVERFLOW_SPILL, spill_size=4)
+        buf.push(b'foo')
+        buf.push(b'bar')
+        buf.push(b'bazqux')
+        self.assertEqual(buf.statistics['spilled'], 4)
+        self.assertEqual(buf.statistics['spill_dropped'], 5)
+        self.assertEqual(buf.get(3), b'foo')
+        self.assertEqual(buf.get(4, timeout=0.01), b'barb')
+        assert buf.empty()
+
+    def test_highWater(self):
+        '''
+        Verify that the most bytes ever buffered is recorded.
+        '''
+        buf = ChannelBuffer()
+        buf.put(b'foo')
+        buf.push(b'bar')
+        buf.get(5)
+        buf.put(b'a')
+        self.assertEqual(buf.statistics['high_water'], 6)
+
+
+class TestFrameQueue(unittest.TestCase):
+    def test_putGet(self):
+        '''
+        Verify that frames are read back whole and in order.
+        '''
+        queue = FrameQueue()
+        queue.deliver([b'\x01\x00foo', b'\x01\x05', b'\x01'],
+                      [1.0, 2.0, 3.0])
+        self.assertEqual(queue.qsize(), 3)
+        self.assertEqual(queue.get(), (0, b'foo', 1.0))
+        self.assertEqual(queue.get(), (5, b'', 2.0))
+        self.assertEqual(queue.get(), (0, b'', 3.0))
+        self.assertEqual(queue.get(timeout=0.01), None)
+        self.assertEqual(queue.get(block=False), None)
+
+    def test_dropOldestPolicy(self):
+        '''
+        Verify that the oldest frames are dropped to make room.
+        '''
+        queue = FrameQueue(maxsize=2, overflow=OVERFLOW_DROP_OLDEST)
+        queue.deliver([b'\x01\x00a', b'\x01\x00b', b'\x01\x00c'])
+        queue.deliver([b'\x01\x00d'])
+        self.assertEqual([queue.get()[1] for i in range(2)], [b'c', b'd'])
+        self.assertEqual(queue.statistics['dropped_oldest'], 2)
+        self.assertEqual(queue.statistics['high_water'], 2)
+
+    def test_dropNewestPolicy(self):
+        '''
+        Verify that frames that do not fit are dropped.
+        '''
+        queue = FrameQueue(maxsize=2, overflow=OVERFLOW_DROP_NEWEST)
+        queue.deliver([b'\x01\x00a', b'\x01\x00b', b'\x01\x00c'])
+        assert queue.full()
+        self.assertEqual([queue.get()[1] for i in range(2)], [b'a', b'b'])
+        self.assertEqual(queue.statistics['dropped_newest'], 1)
+
+    def test_blockPolicy(self):
+        '''
+        Verify that delivering to a full blocking queue waits for the reader.
+        '''
+        queue = FrameQueue(maxsize=1)
+        t = threading.Thread(target=queue.deliver,
+                             args=([b'\x01\x00a', b'\x01\x00b'],))
+        t.start()
+        while not queue.statistics['blocked']:
+            time.sleep(0.001)
+        self.assertEqual([queue.get()[1] for i in range(2)], [b'a', b'b'])
+        t.join()
+        self.assertEqual(queue.put((0, b'c', None), timeout=0), True)
+        self.assertEqual(queue.put((0, b'd', None), timeout=0.01), False)
+
+    def test_spill(self):
+        '''
+        Verify that the spill policy is refused.
+        '''
+        self.assertRaises(ValueError, FrameQueue, maxsize=2,
+                          overflow=OVERFLOW_SPILL)
+
+
+class TestDatagram(unittest.TestCase):
+    def test_sendRecvFrame(self):
+        '''
+        Verify that frames keep their boundaries and control bytes.
+        '''
+        vs = VirtualSerial(FakeDevice())
+        ch = vs.open(2, datagram=True)
+        ch.send_frame(b'foo')
+        ch.send_frame(b'', control=7)
+        ch.send_frame(b'barbaz', control=1)
+        self.assertEqual(ch.recv_frame(timeout=5), (0, b'foo'))
+        self.assertEqual(ch.recv_frame(timeout=5), (7, b''))
+        self.assertEqual(ch.recv_frame(timeout=5), (1, b'barbaz'))
+        self.assertEqual(ch.recv_frame(timeout=0.01), None)
+
+    def test_mixedChannels(self):
+        '''
+        Verify that stream and datagram channels work side by side, and that
+        each refuses the other's calls.
+        '''
+        vs = VirtualSerial(FakeDevice(), timestamps=True)
+        stream = vs.open(1)
+        datagram = vs.open(2, datagram=True)
+        stream.write(b'foo')
+        datagram.send_frame(b'bar')
+        stream.write(b'baz')
+        self.assertEqual(stream.read(6, timeout=5), b'foobaz')
+        control, data, received = datagram.recv_frame_timestamped(timeout=5)
+        self.assertEqual((control, data), (0, b'bar'))
+        self.assertTrue(received <= time.time())
+        self.assertRaises(ChannelError, stream.recv_frame)
+        self.assertRaises(ChannelError, datagram.read, 1)
+
+
+class TestTimestamps(unittest.TestCase):
+    def test_readTimestamped(self):
+        '''
+        Verify that channel data carries the time its frame was received.
+        '''
+        vs = VirtualSerial(FakeDevice(), timestamps=True)
+        ch = vs.open(1)
+        before = time.time()
+        ch.write(b'foo')
+        data, received = ch.read_timestamped(3, timeout=5)
+        self.assertEqual(data, b'foo')
+        self.assertTrue(before <= received <= time.time())
+
+    def test_noTimestamps(self):
+        '''
+        Verify that reads without timestamps enabled give None.
+        '''
+        vs = VirtualSerial(FakeDevice())
+        ch = vs.open(1)
+        ch.write(b'foo')
+        self.assertEqual(ch.read_timestamped(3, timeout=5), (b'foo', None))
+
+
+class TestOverflow(unittest.TestCase):
+    def test_slowChannel(self):
+        '''
+        Verify that a full channel that drops data does not hold up delivery
+        to the other channels.
+        '''
+        vs = VirtualSerial(FakeDevice())
+        slow = vs.open(num=0, maxsize=2, overflow=OVERFLOW_DROP_NEWEST)
+        fast = vs.open(num=1)
+        slow.write(b'foo')
+        slow.write(b'bar')
+        fast.write(b'baz')
+        self.assertEqual(fast.read(3), b'baz')
+        self.assertEqual(slow.read(2), b'fo')
+        self.assertEqual(vs.channel_queues[0].statistics['dropped_newest'], 4)
+
+
+class TestSnapshot(unittest.TestCase):
+    def test_snapshot(self):
+        '''
+        Verify that a snapshot has the receiver and channel statistics.
+        '''
+        vs = VirtualSerial(FakeDevice())
+        ch = vs.open(num=3)
+        ch.write(b'foo')
+        self.assertEqual(ch.read(3), b'foo')
+        snapshot = vs.snapshot()
+        self.assertEqual(snapshot['channels'][3], {'frames': 1, 'bytes': 5})
+        self.assertEqual(snapshot['channel_buffers'][3]['high_water'], 3)
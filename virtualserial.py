@@ -1,71 +1,756 @@
-import serial
-import Queue
 import hdlc
+import heapq
 import threading
+import time
 
 from collections import deque
 
 
-class VSQueue(Queue.Queue):
-    def extend(self, item, block=True, timeout=None):
+# Overflow policies: what a bounded channel does with received data that
+# does not fit.
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_DROP_OLDEST = 'drop-oldest'
+OVERFLOW_DROP_NEWEST = 'drop-newest'
+OVERFLOW_SPILL = 'spill'
+
+# Control bits reserved when writes are split into frames of at most
+# max_payload bytes (see VirtualSerial): MORE is set on every fragment of a
+# write but the last, START on the first frame of every write, so the
+# receiver can pick up again at the next write after losing a fragment.
+CONTROL_MORE = 0x80
+CONTROL_START = 0x40
+
+
+def create_overflow_statistics():
+    return {
+        'blocked': 0,
+        'dropped_oldest': 0,
+        'dropped_newest': 0,
+        'spilled': 0,
+        'spill_dropped': 0,
+        'high_water': 0,
+    }
+
+
+def create_transmit_statistics():
+    return {
+        'frames': 0,
+        'bytes': 0,
+        'high_water': 0,
+    }
+
+
+class ChannelBuffer(object):
+    '''
+    A thread safe byte buffer for a channel.
+
+    Data is kept contiguously in a bytearray with a read offset, so whole
+    runs of bytes are added and removed under a single lock acquisition.
+    (maxsize) is the capacity in bytes; 0 means unlimited.
+
+    (overflow) selects what push() does with data that does not fit:
+
+    OVERFLOW_BLOCK:
+      wait for the reader to make room (stalls the pushing thread)
+    OVERFLOW_DROP_OLDEST:
+      discard the oldest buffered bytes to make room
+    OVERFLOW_DROP_NEWEST:
+      discard the bytes that do not fit
+    OVERFLOW_SPILL:
+      keep the bytes that do not fit in a side buffer of (spill_size) bytes,
+      moved into the buffer as the reader makes room; discard what does not
+      fit there either
+
+    Each policy counts its events (in bytes, or waits for OVERFLOW_BLOCK) in
+    the statistics dict, along with the most bytes ever buffered
+    (high_water).
+
+    Data pushed with a timestamp keeps it: get_timestamped() returns the
+    timestamp of the push that the first byte read came from.
+
+    Once the buffer is closed, puts no longer wait for room.
+    '''
+    __slots__ = (
+        'maxsize',
+        'overflow',
+        'spill_size',
+        'buffer',
+        'start',
+        'spill',
+        'statistics',
+        'received',
+        'consumed',
+        'marks',
+        'closed',
+        'mutex',
+        'not_empty',
+        'not_full',
+    )
+
+    # Reclaim the space in front of the read offset once it is this large and
+    # more than half of the buffer.
+    compact_size = 4096
+
+    def __init__(self, maxsize=0, overflow=OVERFLOW_BLOCK, spill_size=0):
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.spill_size = spill_size
+        self.buffer = bytearray()
+        self.start = 0
+        self.spill = bytearray()
+        self.statistics = create_overflow_statistics()
+        # Bytes ever added (buffered or spilled) and removed from the front,
+        # and (position, timestamp) marks: the timestamp of the data from
+        # each position in that stream onwards.
+        self.received = 0
+        self.consumed = 0
+        self.marks = deque()
+        self.closed = False
+        self.mutex = threading.Lock()
+        self.not_empty = threading.Condition(self.mutex)
+        self.not_full = threading.Condition(self.mutex)
+
+    def close(self):
         '''
-        Put an item into the queue using extend to break the item up. Please
-        note, this implementation does not account for checking the maxsize (if
-        applicable) of a Queue if an item will extend beyond capacity. Perform
-        this check elsewhere. This will, however, protect against the case where
-        a Queue is at its exact capacity.
+        Stop puts from waiting for room, and wake up those waiting now.
+        '''
+        with self.not_full:
+            self.closed = True
+            self.not_full.notify_all()
 
-        If optional args 'block' is true and 'timeout' is None (the default),
-        block if necessary until a free slot is available. If 'timeout' is
-        a non-negative number, it blocks at most 'timeout' seconds and raises
-        the Full exception if no free slot was available within that time.
-        Otherwise ('block' is false), put an item on the queue if a free slot
-        is immediately available, else raise the Full exception ('timeout'
-        is ignored in that case).
+    def qsize(self):
         '''
-        self.not_full.acquire()
-        try:
+        Return the number of bytes in the buffer.
+        '''
+        with self.mutex:
+            return self._qsize()
+
+    def empty(self):
+        '''
+        Return True if the buffer is empty, False if it is not.
+        '''
+        with self.mutex:
+            return self._qsize() == 0
+
+    def full(self):
+        '''
+        Return True if the buffer is at capacity, False if it is not.
+        '''
+        with self.mutex:
+            return 0 < self.maxsize <= self._qsize()
+
+    def put(self, data, block=True, timeout=None):
+        '''
+        Add as much of (data) as fits and return the number of bytes added.
+
+        If the buffer is full and (block) is true, wait (at most (timeout)
+        seconds in all, if given) for room. Return 0 if no room was made, or
+        the buffer has been closed.
+        '''
+        with self.not_full:
+            count = len(data)
             if self.maxsize > 0:
-                if not block:
-                    if self._qsize() == self.maxsize:
-                        raise Full
-                elif timeout is None:
-                    while self._qsize() == self.maxsize:
+                deadline = None
+                if timeout is not None:
+                    deadline = time.time() + timeout
+                while self._qsize() >= self.maxsize:
+                    if not block or self.closed:
+                        return 0
+                    self.statistics['blocked'] += 1
+                    if deadline is None:
                         self.not_full.wait()
-                elif timeout < 0:
-                    raise ValueError("'timeout' must be a non-negative number")
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            return 0
+                        self.not_full.wait(remaining)
+                count = min(count, self.maxsize - self._qsize())
+
+            if count:
+                if count < len(data):
+                    data = data[:count]
+                self._append(data)
+            return count
+
+    def push(self, data, timestamp=None):
+        '''
+        Add all of (data), applying the overflow policy to whatever does not
+        fit. Only OVERFLOW_BLOCK ever waits.
+
+        (timestamp) (such as the time the data was received) is returned by
+        get_timestamped() with reads starting in (data).
+        '''
+        if self.overflow == OVERFLOW_BLOCK or self.maxsize <= 0:
+            if timestamp is not None:
+                with self.mutex:
+                    self._mark(timestamp)
+            while data:
+                count = self.put(data)
+                if not count:
+                    # Closed while full: the rest is dropped.
+                    return
+                data = data[count:]
+            return
+
+        with self.mutex:
+            if timestamp is not None:
+                self._mark(timestamp)
+            stats = self.statistics
+            if self.spill:
+                # Keep the data in order behind what has already spilled.
+                free = 0
+            else:
+                free = self.maxsize - self._qsize()
+
+            if len(data) > free:
+                if self.overflow == OVERFLOW_DROP_OLDEST:
+                    if len(data) > self.maxsize:
+                        stats['dropped_oldest'] += len(data) - self.maxsize
+                        data = data[-self.maxsize:]
+                    drop = len(data) - free
+                    stats['dropped_oldest'] += drop
+                    self._discard(drop)
+                else:
+                    rest = data[free:]
+                    data = data[:free]
+                    if self.overflow == OVERFLOW_SPILL:
+                        room = max(0, self.spill_size - len(self.spill))
+                        self.spill += rest[:room]
+                        self.received += min(room, len(rest))
+                        stats['spilled'] += min(room, len(rest))
+                        stats['spill_dropped'] += max(0, len(rest) - room)
+                    else:
+                        stats['dropped_newest'] += len(rest)
+
+            if data:
+                self._append(data)
+
+    def deliver(self, frames, times=None):
+        '''
+        Push the payloads of received (frames) (channel, control and payload)
+        as one run of data, stamped with the first frame's receive time from
+        (times), if given.
+        '''
+        self.push(b''.join([frame[2:] for frame in frames]),
+                  None if times is None else times[0])
+
+    def get(self, size, block=True, timeout=None, minimum=None):
+        '''
+        Remove and return up to (size) bytes.
+
+        If (block) is true, wait until (minimum) bytes ((size) by default)
+        have been read, then take whatever else is buffered up to (size);
+        reads larger than a bounded buffer are taken in pieces as room is
+        made. With a (timeout), give up and return what has been read once
+        (timeout) seconds have passed in all.
+        '''
+        return self.get_timestamped(size, block=block, timeout=timeout,
+                                    minimum=minimum)[0]
+
+    def get_timestamped(self, size, block=True, timeout=None, minimum=None):
+        '''
+        Like get(), but return (data, timestamp), where timestamp is the one
+        pushed with the first byte of data (None if there is none).
+        '''
+        if minimum is None or minimum > size:
+            minimum = size
+        deadline = None
+        if block and timeout is not None:
+            deadline = time.time() + timeout
+
+        chunks = []
+        read = 0
+        timestamp = None
+        with self.not_empty:
+            while True:
+                count = min(size - read, self._qsize())
+                if count:
+                    if not chunks and self.marks:
+                        timestamp = self._timestamp()
+                    start = self.start
+                    chunks.append(
+                        memoryview(self.buffer)[start:start + count].tobytes())
+                    self._discard(count)
+                    read += count
+
+                    if self.spill:
+                        room = self.maxsize - self._qsize()
+                        self.buffer += self.spill[:room]
+                        del self.spill[:room]
+
+                    self.not_full.notify()
+
+                    if read < size and self._qsize():
+                        # More was moved in from the spill buffer.
+                        continue
+
+                if read >= minimum or not block:
+                    break
+
+                if deadline is None:
+                    self.not_empty.wait()
                 else:
-                    endtime = _time() + timeout
-                    while self._qsize() == self.maxsize:
-                        remaining = endtime - _time()
-                        if remaining <= 0.0:
-                            raise Full
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.not_empty.wait(remaining)
+
+        return b''.join(chunks), timestamp
+
+    def _mark(self, timestamp):
+        '''
+        Stamp the data pushed from now on with (timestamp).
+        '''
+        marks = self.marks
+        if marks and marks[-1][0] == self.received:
+            # Nothing was kept since the last mark.
+            marks[-1] = (self.received, timestamp)
+        else:
+            marks.append((self.received, timestamp))
+
+    def _timestamp(self):
+        '''
+        Return the timestamp of the next byte to be read (None if it has
+        none), dropping the marks behind it.
+        '''
+        marks = self.marks
+        while len(marks) > 1 and marks[1][0] <= self.consumed:
+            marks.popleft()
+        if marks[0][0] <= self.consumed:
+            return marks[0][1]
+        return None
+
+    def _append(self, data):
+        self.buffer += data
+        self.received += len(data)
+        size = self._qsize()
+        if size > self.statistics['high_water']:
+            self.statistics['high_water'] = size
+        self.not_empty.notify()
+
+    def _qsize(self):
+        return len(self.buffer) - self.start
+
+    def _discard(self, count):
+        '''
+        Drop (count) bytes from the front of the buffer.
+        '''
+        self.consumed += count
+        if self.marks:
+            self._timestamp()
+
+        buf = self.buffer
+        end = self.start + count
+        if end >= len(buf):
+            del buf[:]
+            end = 0
+        elif end >= self.compact_size and end > len(buf) // 2:
+            del buf[:end]
+            end = 0
+        self.start = end
+
+
+class FrameQueue(object):
+    '''
+    A thread safe queue of whole frames for a datagram channel.
+
+    Each item is a (control, data, timestamp) tuple, so message boundaries
+    are kept and a frame costs the same however long it is. (maxsize) is
+    the capacity in frames; 0 means unlimited. (overflow) is one of the
+    ChannelBuffer policies except OVERFLOW_SPILL, applied to whole frames,
+    and the statistics count frames rather than bytes. partial_dropped
+    counts the fragmented writes dropped before they were complete (see
+    VirtualSerial.max_message). As with ChannelBuffer, once the queue is
+    closed, puts no longer wait for room.
+    '''
+    __slots__ = (
+        'maxsize',
+        'overflow',
+        'frames',
+        'statistics',
+        'closed',
+        'mutex',
+        'not_empty',
+        'not_full',
+    )
+
+    def __init__(self, maxsize=0, overflow=OVERFLOW_BLOCK):
+        if overflow == OVERFLOW_SPILL:
+            raise ValueError('Datagram channels cannot spill.')
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.frames = deque()
+        self.statistics = create_overflow_statistics()
+        self.statistics['partial_dropped'] = 0
+        self.closed = False
+        self.mutex = threading.Lock()
+        self.not_empty = threading.Condition(self.mutex)
+        self.not_full = threading.Condition(self.mutex)
+
+    def close(self):
+        '''
+        Stop puts from waiting for room, and wake up those waiting now.
+        '''
+        with self.not_full:
+            self.closed = True
+            self.not_full.notify_all()
+
+    def qsize(self):
+        '''
+        Return the number of frames in the queue.
+        '''
+        with self.mutex:
+            return len(self.frames)
+
+    def empty(self):
+        '''
+        Return True if the queue is empty, False if it is not.
+        '''
+        with self.mutex:
+            return not self.frames
+
+    def full(self):
+        '''
+        Return True if the queue is at capacity, False if it is not.
+        '''
+        with self.mutex:
+            return 0 < self.maxsize <= len(self.frames)
+
+    def put(self, item, block=True, timeout=None):
+        '''
+        Add a (control, data, timestamp) (item).
+
+        If the queue is full and (block) is true, wait (at most (timeout)
+        seconds in all, if given) for room. Return False if no room was made,
+        or the queue has been closed.
+        '''
+        with self.not_full:
+            if self.maxsize > 0:
+                deadline = None
+                if timeout is not None:
+                    deadline = time.time() + timeout
+                while len(self.frames) >= self.maxsize:
+                    if not block or self.closed:
+                        return False
+                    self.statistics['blocked'] += 1
+                    if deadline is None:
+                        self.not_full.wait()
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            return False
                         self.not_full.wait(remaining)
-            self._extend(item)
-            self.unfinished_tasks += len(item)
-            self.not_empty.notify()
+            self._extend((item,))
+            return True
+
+    def deliver(self, frames, times=None):
+        '''
+        Queue received (frames) (channel, control and payload), with their
+        receive (times), if given, applying the overflow policy to those that
+        do not fit. Only OVERFLOW_BLOCK ever waits.
+        '''
+        if times is None:
+            times = [None] * len(frames)
+        items = [(frame[1] if len(frame) > 1 else 0, frame[2:], received)
+                 for frame, received in zip(frames, times)]
+
+        if self.overflow == OVERFLOW_BLOCK and self.maxsize > 0:
+            for item in items:
+                if not self.put(item):
+                    # Closed while full: the rest is dropped.
+                    return
+            return
+
+        with self.mutex:
+            free = len(items)
+            if self.maxsize > 0:
+                free = self.maxsize - len(self.frames)
+            if len(items) > free:
+                stats = self.statistics
+                if self.overflow == OVERFLOW_DROP_OLDEST:
+                    if len(items) > self.maxsize:
+                        stats['dropped_oldest'] += len(items) - self.maxsize
+                        items = items[-self.maxsize:]
+                    for i in range(len(items) - free):
+                        self.frames.popleft()
+                    stats['dropped_oldest'] += len(items) - free
+                else:
+                    stats['dropped_newest'] += len(items) - free
+                    items = items[:free]
+            if items:
+                self._extend(items)
+
+    def get(self, block=True, timeout=None):
+        '''
+        Remove and return the next (control, data, timestamp) item.
+
+        If (block) is true, wait (at most (timeout) seconds, if given) for a
+        frame. Return None if there is none.
+        '''
+        deadline = None
+        if block and timeout is not None:
+            deadline = time.time() + timeout
+
+        with self.not_empty:
+            while not self.frames:
+                if not block:
+                    return None
+                if deadline is None:
+                    self.not_empty.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    self.not_empty.wait(remaining)
+
+            item = self.frames.popleft()
+            self.not_full.notify()
+            return item
+
+    def _extend(self, items):
+        self.frames.extend(items)
+        if len(self.frames) > self.statistics['high_water']:
+            self.statistics['high_water'] = len(self.frames)
+        self.not_empty.notify()
+
+
+class Transmitter(object):
+    '''
+    Coalesces channel writes into batched HDLC writes on a writer thread.
+
+    Frames are queued per channel. The writer thread sends what is queued
+    once (flush_size) bytes of data are waiting or (flush_latency) seconds
+    after the oldest queued frame, whichever comes first. A batch holds up
+    to (flush_size) bytes and goes out in a single device write, with
+    back-to-back frames sharing their flags.
+
+    Batches are filled by channel priority, then by weighted fair queueing
+    (self-clocked): of the channels at the highest priority with frames
+    queued, each gets a share of the link in proportion to its weight (see
+    set_channel). What does not fit waits for the next batch, where frames
+    queued since at a higher priority go ahead of it.
+
+    The statistics dict holds the frames and bytes sent and the most frames
+    ever queued (high_water) for each channel.
+
+    If a device write fails, the writer thread stops. The frames still
+    queued are dropped, and the exception is kept in (error) and raised
+    again by send() and flush().
+    '''
+    def __init__(self, receiver, flush_latency=0.002, flush_size=4096):
+        self.hdlc = receiver
+        self.flush_latency = flush_latency
+        self.flush_size = flush_size
+        self.queues = {}
+        # (priority, weight) of each channel, the virtual time each channel's
+        # last queued frame finishes at, and the virtual time of the last
+        # frame sent at each priority.
+        self.classes = {}
+        self.finish = {}
+        self.vtimes = {}
+        self.statistics = {}
+        self.queued_bytes = 0
+        self.unsent = 0
+        self.first_queued = None
+        self.flushing = False
+        self.closed = False
+        self.running = False
+        self.error = None
+        self.condition = threading.Condition()
+
+    def set_channel(self, chanNo, priority=0, weight=1):
+        '''
+        Set the (priority) of a channel (higher goes first) and its (weight)
+        among the channels of the same priority.
+        '''
+        if weight <= 0:
+            raise ValueError('Channel weights must be positive.')
+        with self.condition:
+            self.classes[chanNo] = (priority, weight)
+
+    def send(self, chanNo, control, data):
+        '''
+        Queue a frame for the writer thread.
+        '''
+        with self.condition:
+            if self.error is not None:
+                raise self.error
+            queue = self.queues.get(chanNo)
+            if queue is None:
+                queue = self.queues[chanNo] = deque()
+                self.statistics[chanNo] = create_transmit_statistics()
+            priority, weight = self.classes.get(chanNo, (0, 1))
+            start = max(self.finish.get(chanNo, 0.0),
+                        self.vtimes.get(priority, 0.0))
+            # Count a byte for the frame itself, so empty frames get a turn.
+            tag = self.finish[chanNo] = start + (len(data) + 1.0) / weight
+            queue.append((tag, (chanNo, control, data)))
+            stats = self.statistics[chanNo]
+            if len(queue) > stats['high_water']:
+                stats['high_water'] = len(queue)
+            self.queued_bytes += len(data)
+            self.unsent += 1
+            if self.first_queued is None:
+                self.first_queued = time.time()
+                self.condition.notify_all()
+            elif self.queued_bytes >= self.flush_size:
+                self.condition.notify_all()
+
+    def flush(self):
+        '''
+        Send all queued frames now and wait until they have been written.
+
+        Raise the writer thread's error if a write failed, and RuntimeError
+        if frames are queued with no writer thread to send them.
+        '''
+        with self.condition:
+            self.flushing = True
+            self.condition.notify_all()
+            try:
+                while self.unsent:
+                    if self.error is not None:
+                        raise self.error
+                    if not self.running:
+                        raise RuntimeError('The transmitter is not running.')
+                    self.condition.wait()
+            finally:
+                self.flushing = False
+            if self.error is not None:
+                raise self.error
+
+    def close(self):
+        '''
+        Send what is queued and stop the writer thread.
+        '''
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def _next_batch(self):
+        '''
+        Wait for a batch to be due and take it off the queues. Return None
+        once closed with nothing left to send.
+        '''
+        with self.condition:
+            while True:
+                if self.first_queued is None:
+                    if self.closed:
+                        return None
+                    self.condition.wait()
+                    continue
+                if (self.flushing or self.closed or
+                        self.queued_bytes >= self.flush_size):
+                    break
+                remaining = self.first_queued + self.flush_latency - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            # The channel queues in sending order: highest priority, then
+            # earliest virtual finish time.
+            heads = [(-self.classes.get(chanNo, (0, 1))[0], queue[0][0],
+                      chanNo)
+                     for chanNo, queue in self.queues.items() if queue]
+            heapq.heapify(heads)
+
+            batch = []
+            size = 0
+            while heads and size < self.flush_size:
+                priority, tag, chanNo = heads[0]
+                queue = self.queues[chanNo]
+                frame = queue.popleft()[1]
+                self.vtimes[-priority] = tag
+                batch.append(frame)
+                size += len(frame[2])
+                stats = self.statistics[chanNo]
+                stats['frames'] += 1
+                stats['bytes'] += len(frame[2])
+                if queue:
+                    heapq.heapreplace(heads, (priority, queue[0][0], chanNo))
+                else:
+                    heapq.heappop(heads)
+
+            self.queued_bytes -= size
+            if not heads:
+                self.first_queued = None
+            # Otherwise the rest is already due.
+            return batch
+
+    def _run(self):
+        try:
+            while True:
+                batch = self._next_batch()
+                if batch is None:
+                    return
+                try:
+                    self.hdlc.send_many(batch)
+                finally:
+                    with self.condition:
+                        self.unsent -= len(batch)
+                        self.condition.notify_all()
+        except Exception as exc:
+            with self.condition:
+                self.error = exc
+                self._drop_queued()
         finally:
-            self.not_full.release()
+            with self.condition:
+                self.running = False
+                self.condition.notify_all()
+
+    def _drop_queued(self):
+        # Called with the condition held, once nothing can be sent.
+        for queue in self.queues.values():
+            queue.clear()
+        self.queued_bytes = 0
+        self.unsent = 0
+        self.first_queued = None
 
-    def _extend(self, item):
-        self.queue.extend(item)
+    def _start_thread(self):
+        with self.condition:
+            self.running = True
+        t = threading.Thread(target = self._run)
+        t.daemon = True
+        t.start()
+        return t
 
 
 class Channel(object):
     '''
     An object representing a virtual serial channel.
+
+    A channel is a byte stream, read with read() and written with write(),
+    or, if opened with (datagram), a sequence of whole frames, received with
+    recv_frame() and sent with send_frame().
     '''
-    def __init__(self, vsObj, num, name=None, maxsize=0):
+    def __init__(self, vsObj, num, name=None, maxsize=0,
+                 overflow=OVERFLOW_BLOCK, spill_size=0, datagram=False,
+                 priority=0, weight=1):
         self.vs = vsObj
         self.num = num
         self.name = name
-        self.vs.add_channel(num, maxsize=maxsize)
+        self.datagram = datagram
+        self.vs.add_channel(num, maxsize=maxsize, overflow=overflow,
+                            spill_size=spill_size, datagram=datagram,
+                            priority=priority, weight=weight)
 
-    def read(self, length, timeout=None):
+    def read(self, length, timeout=None, minimum=None):
         '''
         Read from the channel for (length) bytes.
+
+        Return once (minimum) bytes ((length) by default) have been read, or
+        with what has been read once (timeout) seconds have passed.
         '''
-        return self.vs.channel_read(self.num, length, timeout=timeout)
+        return self.vs.channel_read(self.num, length, timeout=timeout,
+                                    minimum=minimum)
+
+    def read_timestamped(self, length, timeout=None, minimum=None):
+        '''
+        Like read(), but return (data, timestamp): the time the frame holding
+        the first byte of data was received, or None if that is not known
+        (see VirtualSerial's timestamps).
+        '''
+        return self.vs.channel_read(self.num, length, timeout=timeout,
+                                    minimum=minimum, timestamped=True)
 
     def write(self, data):
         '''
@@ -73,6 +758,29 @@ class Channel(object):
         '''
         self.vs.channel_write(self.num, data)
 
+    def recv_frame(self, timeout=None):
+        '''
+        Return the next frame received on a datagram channel as a (control,
+        data) pair, or None if none arrives within (timeout) seconds.
+        '''
+        item = self.vs.channel_recv_frame(self.num, timeout=timeout)
+        if item is None:
+            return None
+        return item[:2]
+
+    def recv_frame_timestamped(self, timeout=None):
+        '''
+        Like recv_frame(), but return (control, data, timestamp) (see
+        read_timestamped()).
+        '''
+        return self.vs.channel_recv_frame(self.num, timeout=timeout)
+
+    def send_frame(self, data, control=0):
+        '''
+        Send (data) as a single frame with (control).
+        '''
+        self.vs.channel_write(self.num, data, control=control)
+
     def isFull(self):
         '''
         Return True if the channel is full, False if it is not.
@@ -100,85 +808,396 @@ class ChannelError(Exception):
 class VirtualSerial(object):
     '''
     A virtual serial connection handler for communication with the HDLC.
+
+    The reader thread (and the Transmitter's, with coalesce) run from
+    start() until close(); use it as a context manager to close it on exit:
+
+        with VirtualSerial.from_port('/dev/ttyUSB0') as vs:
+            channel = vs.open(0)
+            ...
     '''
-    def __init__(self, device):
+    # How often, at most, the reader thread checks whether it has been
+    # closed while data keeps arriving without a complete frame.
+    poll_interval = 0.1
+    # The most bytes of a fragmented write a datagram channel collects
+    # before dropping it.
+    max_message = 1 << 20
+
+    def __init__(self, device, read_size=1, coalesce=False,
+                 flush_latency=0.002, flush_size=4096, timing=False,
+                 timestamps=False, max_payload=None, start=True,
+                 fcs='fcs32', verify_fcs=True):
         '''
         Start a virtual serial connection with (numChannels) channels
         to an HDLC receiver connected to (device).
+
+        (read_size) is passed on to the HDLC receiver; raise it to read the
+        device in bulk.
+
+        With (coalesce), channel writes are batched by a Transmitter (see
+        there for (flush_latency) and (flush_size)) instead of each being
+        written to the device directly.
+
+        (timing) turns on the HDLC receiver's decode and queue wait timing
+        (see hdlc.Statistics).
+
+        With (timestamps), received data keeps the time its frame was
+        decoded, returned by Channel.read_timestamped().
+
+        With (max_payload), writes longer than that many bytes are split into
+        frames of at most max_payload bytes, all but the last with the
+        CONTROL_MORE control bit set, and datagram channels put received
+        fragments back together. The first frame of every write has the
+        CONTROL_START bit set. Both ends must agree; the bits are then not
+        available in send_frame() controls. A write whose fragments are
+        interrupted by a bad frame, or that outgrows max_message, is dropped
+        up to the start of the next write.
+
+        The threads are started right away unless (start) is false; then
+        open the channels and call start(), so that no frame arrives before
+        its channel exists.
+
+        (fcs) and (verify_fcs) select the frame check sequence, as for
+        hdlc.Codec.
         '''
-        self.hdlc = hdlc.Receiver(device)
+        self.timestamps = timestamps
+        self.max_payload = max_payload
+        self.hdlc = hdlc.Receiver(device, read_size=read_size, timing=timing,
+                                  timestamps=timestamps, fcs=fcs,
+                                  verify_fcs=verify_fcs)
         self.channel_queues = {}
-        self._start_thread()
+        self.channel_priorities = {}
+        # The size and fragments received so far of the write in progress on
+        # each datagram channel, or None while dropping the rest of a write.
+        self.fragments = {}
+        self.transmitter = None
+        if coalesce:
+            self.transmitter = Transmitter(self.hdlc,
+                                           flush_latency=flush_latency,
+                                           flush_size=flush_size)
+        # Whether close() closes the device too (see from_port).
+        self.owns_device = False
+        self._started = False
+        self._threads = []
+        self._stopping = threading.Event()
+        if start:
+            self.start()
 
-    def open(self, num, name=None, maxsize=0):
+    @classmethod
+    def from_port(cls, port, baudrate=115200, timeout=0.1, **kwargs):
+        '''
+        Open (port), a device name or any pyserial URL, and return a
+        VirtualSerial on it. Other arguments are passed on to the
+        constructor; the port is closed by close().
+
+        pyserial is imported here, so the module can be used without it
+        with any device object.
+        '''
+        import serial
+
+        start = kwargs.pop('start', True)
+        device = serial.serial_for_url(port, baudrate=baudrate,
+                                       timeout=timeout)
+        vs = cls(device, start=False, **kwargs)
+        vs.owns_device = True
+        if start:
+            vs.start()
+        return vs
+
+    def start(self):
+        '''
+        Start the reader thread (and the Transmitter's). Does nothing if they
+        are running.
+        '''
+        if self._started or self._stopping.is_set():
+            return
+        self._started = True
+        if self.transmitter is not None:
+            self._threads.append(self.transmitter._start_thread())
+        reader = self._start_thread()
+        if reader is not None:
+            self._threads.append(reader)
+
+    def close(self, timeout=None):
+        '''
+        Send what the Transmitter has queued, stop the threads and wait (up to
+        (timeout) seconds for each) for them to finish.
+
+        The reader thread stops after the device read in progress returns, so
+        the device needs a read timeout. The channels are closed, so it does
+        not wait for room in a full OVERFLOW_BLOCK channel; data it was
+        delivering to one is dropped. The device is closed if it was opened
+        by from_port().
+        '''
+        self._stopping.set()
+        for queue in list(self.channel_queues.values()):
+            queue.close()
+        if self.transmitter is not None:
+            self.transmitter.close()
+        for thread in self._threads:
+            thread.join(timeout)
+        if self.owns_device:
+            self.hdlc.device.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def open(self, num, name=None, maxsize=0, overflow=OVERFLOW_BLOCK,
+             spill_size=0, datagram=False, priority=0, weight=1):
         '''
         Open and return a Channel object.
         '''
-        return Channel(self, num, name=name, maxsize=maxsize)
+        return Channel(self, num, name=name, maxsize=maxsize,
+                       overflow=overflow, spill_size=spill_size,
+                       datagram=datagram, priority=priority, weight=weight)
 
-    def add_channel(self, num, maxsize=0):
+    def add_channel(self, num, maxsize=0, overflow=OVERFLOW_BLOCK,
+                    spill_size=0, datagram=False, priority=0, weight=1):
         '''
         Add a channel to the channel queues dict (num is the reference key).
+
+        See ChannelBuffer for the (overflow) policies. With OVERFLOW_BLOCK a
+        full channel stalls delivery to every channel until it is read from;
+        the other policies never wait.
+
+        A (datagram) channel queues whole frames in a FrameQueue, and
+        (maxsize) counts frames.
+
+        Received data is handed to the channels in order of (priority),
+        highest first. With coalesce, the Transmitter also sends by
+        (priority) and shares the link by (weight) (see
+        Transmitter.set_channel); otherwise writes go out in caller order.
         '''
-        self.channel_queues[num] = VSQueue(maxsize=maxsize)
+        if self.transmitter is not None:
+            self.transmitter.set_channel(num, priority=priority,
+                                         weight=weight)
+        elif weight <= 0:
+            raise ValueError('Channel weights must be positive.')
+        self.channel_priorities[num] = priority
+        if datagram:
+            queue = FrameQueue(maxsize=maxsize, overflow=overflow)
+        else:
+            queue = ChannelBuffer(maxsize=maxsize, overflow=overflow,
+                                  spill_size=spill_size)
+        self.channel_queues[num] = queue
 
-    def channel_read(self, chanNo, bytes, timeout=None):
+    def channel_read(self, chanNo, bytes, timeout=None, minimum=None,
+                     timestamped=False):
         '''
-        Read from channel_queues for (bytes) bytes. The bytes read are joined
-        and returned as a single piece of data.
+        Read from channel_queues for (bytes) bytes. The bytes read are
+        returned as a single piece of data once (minimum) bytes ((bytes) by
+        default) are in; once (timeout) seconds have passed, return what has
+        been read so far. With (timestamped), return (data, timestamp) (see
+        ChannelBuffer.get_timestamped).
         '''
-        buffdata = []
-        try:
-            for i in range(bytes):
-                buffdata.append(self.channel_queues[chanNo].get(block=True,
-                    timeout=timeout))
-        except Queue.Empty:
-            buffdata.append('')
-        except KeyError:
-            raise ChannelError('Could not find channel %s.' % chanNo)
+        queue = self._channel_queue(chanNo)
+        if queue.__class__ is FrameQueue:
+            raise ChannelError('Channel %s is a datagram channel.' % chanNo)
 
-        data = ''.join(buffdata)
+        if timestamped:
+            return queue.get_timestamped(bytes, timeout=timeout,
+                                         minimum=minimum)
+        return queue.get(bytes, timeout=timeout, minimum=minimum)
 
-        return data
+    def channel_recv_frame(self, chanNo, timeout=None):
+        '''
+        Return the next (control, data, timestamp) frame from a datagram
+        channel, or None if none arrives within (timeout) seconds.
+        '''
+        queue = self._channel_queue(chanNo)
+        if queue.__class__ is not FrameQueue:
+            raise ChannelError('Channel %s is not a datagram channel.' %
+                               chanNo)
+        return queue.get(timeout=timeout)
+
+    def channel_write(self, chanNo, data, control=0):
+        '''
+        Write to a channel on the HDLC, in fragments of max_payload bytes if
+        it is set.
+        '''
+        #channel num, control, data
+        if self.transmitter is not None:
+            send = self.transmitter.send
+        else:
+            send = self.hdlc.send
+
+        size = self.max_payload
+        if size is None:
+            send(chanNo, control, data)
+            return
+        if control & (CONTROL_MORE | CONTROL_START):
+            raise ValueError('The CONTROL_MORE and CONTROL_START bits are '
+                             'reserved for fragments.')
+        flags = CONTROL_START
+        while len(data) > size:
+            send(chanNo, control | flags | CONTROL_MORE, data[:size])
+            data = data[size:]
+            flags = 0
+        send(chanNo, control | flags, data)
+
+    def flush(self):
+        '''
+        Wait until all channel writes have been written to the device.
+        '''
+        if self.transmitter is not None:
+            self.transmitter.flush()
 
-    def channel_write(self, chanNo, data):
+    def snapshot(self):
         '''
-        Write to a channel on the HDLC.
+        Return the HDLC receiver statistics (see hdlc.Statistics.snapshot)
+        with the overflow statistics and priority of every channel added
+        under 'channel_buffers', and with coalesce, the Transmitter
+        statistics under 'transmit'.
         '''
-        self.hdlc.send(chanNo, 0, data)
-        #channel num, control (0 for now), data
+        snapshot = self.hdlc.statistics.snapshot()
+        buffers = snapshot['channel_buffers'] = {}
+        for num, queue in self.channel_queues.items():
+            buffers[num] = dict(queue.statistics)
+            buffers[num]['priority'] = self.channel_priorities[num]
+        if self.transmitter is not None:
+            with self.transmitter.condition:
+                snapshot['transmit'] = dict(
+                    (num, dict(stats))
+                    for num, stats in self.transmitter.statistics.items())
+        return snapshot
+
+    def _channel_queue(self, chanNo):
+        try:
+            return self.channel_queues[chanNo]
+        except KeyError:
+            raise ChannelError('Could not find channel %s.' % chanNo)
 
     def _check_for_data(self):
         '''
         Continuously check for incoming data - break it up and add it to the
         queue.
 
+        All frames decoded from a read are handled as a batch: the payloads
+        for each channel are joined and added to its queue in one go.
+
         If the queues have a size limit and either the queue is full or
         the incoming data will surpass the size limit, add enough data to the
-        queue to fill it, then hang on to the rest of the data until it can be
-        added.
-        '''
-        while True:
-            msg = self.hdlc.get()
-            if msg:
-                # (channel num)(cmd num)(data)
-                chanNo = ord(msg[0])
-                data = msg[2:]
-                targetQueue = self.channel_queues[chanNo]
-                if targetQueue.maxsize > 0:
-                    while data:
-                        # We only expect a single writer per queue, so 
-                        # qsize() should be accurate.
-                        free = targetQueue.maxsize - targetQueue.qsize()
-                        if free:
-                            targetQueue.extend(data[:free], False)
-                        data = data[free:]
+        queue to fill it, then handle the rest according to the queue's
+        overflow policy.
+        '''
+        receiver = self.hdlc
+        stopping = self._stopping
+        timeout = self.poll_interval
+        while not stopping.is_set():
+            if self.timestamps:
+                batch = receiver.get_many(timeout=timeout, timestamps=True)
+                self.deliver([frame for received, frame in batch],
+                              [received for received, frame in batch])
+            else:
+                self.deliver(receiver.get_many(timeout=timeout))
+
+    def deliver(self, frames, times=None):
+        '''
+        Add the payloads of a batch of frames to their channel queues, joined
+        per channel. Frames for channels that have not been opened are
+        dropped.
+
+        The reader thread (or a LinkManager) calls this with every batch it
+        decodes; call it to hand in frames from elsewhere, such as a replay
+        (see capture.FrameFile.replay). Each frame is one as returned by
+        hdlc.Receiver.get(): channel, control and payload.
+
+        (times) are the receive times of the frames (see ChannelBuffer and
+        FrameQueue deliver()). Channels get their frames in order of
+        priority, so a full OVERFLOW_BLOCK channel only holds up those after
+        it.
+        '''
+        if self.max_payload is not None:
+            frames, times = self._reassemble(frames, times)
+
+        pending = {}
+        if times is None:
+            for msg in frames:
+                if msg:
+                    # (channel num)(cmd num)(data)
+                    pending.setdefault(msg[0], []).append(msg)
+        else:
+            stamps = {}
+            for msg, received in zip(frames, times):
+                if msg:
+                    pending.setdefault(msg[0], []).append(msg)
+                    stamps.setdefault(msg[0], []).append(received)
+
+        order = pending
+        if len(pending) > 1:
+            priorities = self.channel_priorities
+            order = sorted(pending, key=lambda num: -priorities.get(num, 0))
+        for chanNo in order:
+            queue = self.channel_queues.get(chanNo)
+            if queue is not None:
+                if times is None:
+                    queue.deliver(pending[chanNo])
+                else:
+                    queue.deliver(pending[chanNo], stamps[chanNo])
+
+    def _reassemble(self, frames, times):
+        '''
+        Join the fragments of writes to datagram channels (see max_payload)
+        and return the frames and times to deliver, without the reserved
+        control bits. A write is stamped with the time of its last fragment.
+        '''
+        fragments = self.fragments
+        whole = []
+        whole_times = None if times is None else []
+        for i, msg in enumerate(frames):
+            if msg is None:
+                # The bad frame may have been a fragment of any write in
+                # progress.
+                for chanNo, partial in list(fragments.items()):
+                    if partial is not None:
+                        self._drop_partial(chanNo)
+            elif (len(msg) > 1 and
+                  self.channel_queues.get(msg[0]).__class__ is FrameQueue):
+                chanNo, control = msg[0], msg[1]
+                if control & CONTROL_START:
+                    # A new write, whatever happened to the one before.
+                    if fragments.pop(chanNo, None) is not None:
+                        self.channel_queues[chanNo].statistics[
+                            'partial_dropped'] += 1
+                    if control & CONTROL_MORE:
+                        fragments[chanNo] = [len(msg) - 2, [msg[2:]]]
+                        continue
+                    msg = bytes((chanNo, control & ~CONTROL_START)) + msg[2:]
                 else:
-                    targetQueue.extend(data, False)
+                    if chanNo not in fragments:
+                        # A fragment of a write whose start was lost.
+                        self._drop_partial(chanNo)
+                    partial = fragments[chanNo]
+                    if partial is None:
+                        if not control & CONTROL_MORE:
+                            del fragments[chanNo]
+                        continue
+                    partial[0] += len(msg) - 2
+                    partial[1].append(msg[2:])
+                    if control & CONTROL_MORE:
+                        if partial[0] > self.max_message:
+                            self._drop_partial(chanNo)
+                        continue
+                    del fragments[chanNo]
+                    msg = bytes(msg[:2]) + b''.join(partial[1])
+            whole.append(msg)
+            if times is not None:
+                whole_times.append(times[i])
+        return whole, whole_times
+
+    def _drop_partial(self, chanNo):
+        # Drop the write in progress on a datagram channel, and the rest of
+        # its fragments as they arrive, up to the start of the next write.
+        self.fragments[chanNo] = None
+        self.channel_queues[chanNo].statistics['partial_dropped'] += 1
 
     def _start_thread(self):
         t = threading.Thread(target = self._check_for_data)
-        t.setDaemon(True)
+        t.daemon = True
         t.start()
         return t
 